@@ -11,7 +11,7 @@ django_asgi_app = get_asgi_application()
 
 # 3. Now import Channels components
 from channels.routing import ProtocolTypeRouter, URLRouter
-from channels.auth import AuthMiddlewareStack
+from chat_app.ws_auth import WebSocketAuthMiddlewareStack
 
 # 4. Import your app-specific routing AFTER django.setup() / get_asgi_application()
 import chat_app.routing
@@ -19,7 +19,7 @@ import chat_app.routing
 application = ProtocolTypeRouter(
     {
         "http": django_asgi_app,
-        "websocket": AuthMiddlewareStack(
+        "websocket": WebSocketAuthMiddlewareStack(
             URLRouter(chat_app.routing.websocket_urlpatterns)
         ),
     }
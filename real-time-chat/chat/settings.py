@@ -69,6 +69,8 @@ ALLOWED_HOSTS = ["localhost", "127.0.0.1"]
 
 
 MIDDLEWARE = [
+    # First, so it times and counts the queries of the whole stack
+    "chat_app.middleware.MetricsMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -91,6 +93,7 @@ TEMPLATES = [
                 "django.template.context_processors.request",
                 "django.contrib.auth.context_processors.auth",
                 "django.contrib.messages.context_processors.messages",
+                "chat_app.context_processors.presence",
             ],
         },
     },
@@ -166,15 +169,149 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 ASGI_APPLICATION = "chat.asgi.application"
 
 # redis channel layer for production
+# Channel layer shards. Set CHAT_CHANNEL_HOSTS to a comma separated list of
+# redis:// URLs to spread room groups over several Redis instances; groups are
+# placed by consistent hashing (see chat_app/layers.py), so adding a shard
+# only moves the groups that land on it. For a local multi-shard setup run
+# "python manage.py run_redis_shards".
+CHANNEL_LAYER_HOSTS = os.environ.get(
+    "CHAT_CHANNEL_HOSTS", "redis://127.0.0.1:6379/0"
+).split(",")
+
+# capacity bounds both each worker's Redis inbox (one entry per group event,
+# however many of its sockets are in the group) and each consumer's
+# in-process buffer; beyond it channels_redis drops events silently, so it
+# is sized for bursts in busy rooms. expiry is how many seconds an
+# undelivered event is kept, group_expiry how long a group membership
+# lasts without being renewed (a socket open longer drops out of its room).
 CHANNEL_LAYERS = {
     "default": {
-        "BACKEND": "channels_redis.core.RedisChannelLayer",
+        "BACKEND": "chat_app.layers.ShardedRedisChannelLayer",
         "CONFIG": {
-            "hosts": [("127.0.0.1", 6379)],
+            "hosts": CHANNEL_LAYER_HOSTS,
+            "capacity": int(os.environ.get("CHAT_CHANNEL_CAPACITY", 1000)),
+            "expiry": int(os.environ.get("CHAT_CHANNEL_EXPIRY", 60)),
+            "group_expiry": int(os.environ.get("CHAT_GROUP_EXPIRY", 86400)),
         },
     },
 }
 
+# Write-behind message persistence: broadcast first, bulk insert in the
+# background. Message ids come from the PostgreSQL sequence; on SQLite only
+# a single worker may run with it (see chat_app/persistence.py)
+CHAT_WRITE_BEHIND = {
+    "ENABLED": False,
+    "FLUSH_SIZE": 200,
+    "FLUSH_INTERVAL": 0.25,
+}
+
+# Per-process membership/presence cache, invalidated over Redis pub/sub
+# (see chat_app/cache.py)
+CHAT_CACHE = {
+    "BACKEND": "redis",
+    "MEMBERSHIP_TTL": 60,
+    "PRESENCE_TTL": 10,
+    "MAX_ROOMS": 10000,
+    "USER_TTL": 300,
+    "MAX_USERS": 10000,
+}
+
+# Redis used by the chat app itself (presence etc.), separate db from Celery
+CHAT_REDIS_URL = "redis://127.0.0.1:6379/1"
+
+# Connection-counted presence in Redis; last_seen is written to Postgres
+# in batches (see chat_app/presence.py)
+CHAT_PRESENCE = {
+    "BACKEND": "redis",
+    "TTL": 90,
+    "HEARTBEAT_INTERVAL": 30,
+    "LAST_SEEN_FLUSH_INTERVAL": 60,
+    "WATCH_LIMIT": 500,
+    "BATCH_INTERVAL": 1.0,
+}
+
+# The newest messages of each room are kept in a Redis ring buffer, sent over
+# the socket on connect and used for the first page of the messages API
+# (see chat_app/history.py)
+CHAT_HISTORY = {
+    "BACKEND": "redis",
+    "BUFFER_SIZE": 200,
+    "BUFFER_TTL": 24 * 60 * 60,
+    "SIZE": 50,
+    "REPLAY_LIMIT": 500,
+}
+
+# Messages are numbered per room from Redis counters (chat:seq:{room}); a
+# reconnecting socket sends the last number it saw and is replayed the
+# messages it missed (see chat_app/sequence.py)
+CHAT_SEQUENCE = {
+    "BACKEND": "redis",
+}
+
+# Unread counts per user and room live in Redis hashes, incremented as
+# messages fan out and reset on read; workers checkpoint changed counters
+# to ReadState every CHECKPOINT_INTERVAL seconds (see chat_app/unread.py)
+CHAT_UNREAD = {
+    "BACKEND": "redis",
+    "CHECKPOINT_INTERVAL": 60,
+    "PUSH_INTERVAL": 1.0,
+}
+
+# Typing indicators are coalesced into one typing_set event per room and
+# worker at most every FLUSH_INTERVAL seconds (see chat_app/typing_indicators.py)
+CHAT_TYPING = {
+    "FLUSH_INTERVAL": 0.3,
+    "REFRESH_INTERVAL": 2,
+    "TTL": 5,
+}
+
+
+# Every socket gets its frames through a bounded queue, so a client that
+# reads slowly does not stall its consumer: typing and status frames are
+# coalesced, and past HIGH_WATER frames chat messages are dropped in favour
+# of a "resync" frame, or the socket is closed with 4008. The limits only
+# bound memory on ASGI servers whose send waits for the client (uvicorn);
+# under Daphne the queue never fills and a slow reader's frames pile up in
+# the Twisted transport (see chat_app/backpressure.py)
+CHAT_BACKPRESSURE = {
+    "HIGH_WATER": 256,
+    "LOW_WATER": 64,
+    "ON_OVERFLOW": "resync",
+    "STALL_TIMEOUT": 10,
+}
+
+# Timing histograms, connection gauges and query counts, served per worker on
+# /chat/metrics/ in the Prometheus text format (see chat_app/metrics.py)
+CHAT_METRICS = {
+    "ENABLED": os.environ.get("CHAT_METRICS_ENABLED") == "1",
+    "TOKEN": os.environ.get("CHAT_METRICS_TOKEN"),
+}
+
+# Messages older than AFTER_DAYS are moved into compressed monthly archive
+# batches by "python manage.py archive_messages" (run it daily from cron);
+# the messages API still pages through them (see chat_app/archive.py)
+CHAT_ARCHIVE = {
+    "AFTER_DAYS": 90,
+    "BATCH_SIZE": 1000,
+}
+
+# Sockets are only admitted to rooms the user may read, up to
+# MAX_SOCKETS_PER_USER per user; messages are rate limited per user and room
+# with token buckets in Redis (see chat_app/admission.py)
+CHAT_ADMISSION = {
+    "BACKEND": "redis",
+    "MESSAGE_RATE": 1.0,
+    "MESSAGE_BURST": 10,
+    "MAX_SOCKETS_PER_USER": 20,
+}
+
+# WebSocket handshakes authenticate with a short-lived signed ticket the
+# server hands each session-authenticated socket, without touching the
+# database; sockets without one fall back on the session with cached users
+# (see chat_app/ws_auth.py)
+CHAT_WS_AUTH = {
+    "TICKET_MAX_AGE": 300,
+}
 
 # Celery confguration (optional for async tasks)
 CELERY_BROKER_URL = "redis://localhost:6379/0"
@@ -0,0 +1,116 @@
+# chat_app/admission.py
+import threading
+import time
+
+from .cache import aget_room_member_ids, aget_room_type
+from .conf import chat_settings
+from .redis_client import get_async_redis
+
+# KEYS: bucket hash
+# ARGV: now, tokens per second, burst, key ttl
+TAKE_SCRIPT = """
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'at')
+local now = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local burst = tonumber(ARGV[3])
+local tokens = tonumber(bucket[1]) or burst
+local at = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - at) * rate)
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'at', ARGV[1])
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+return allowed
+"""
+
+
+async def can_join_room(user_id, room_id):
+    """Whether a user may open a socket on a room
+
+    The room has to exist; private and direct rooms are for their members
+    only. Both come from the per-worker caches, so admitting a socket
+    usually costs no query.
+    """
+    try:
+        room_id = int(room_id)
+    except ValueError:
+        return False
+    room_type = await aget_room_type(room_id)
+    if room_type is None:
+        return False
+    if room_type in ("private", "direct"):
+        return user_id in await aget_room_member_ids(room_id)
+    return True
+
+
+class RedisRateLimiter:
+    """Token buckets in ``ratelimit:{user}:{room}`` hashes, shared by workers
+
+    Each bucket holds up to ``burst`` tokens and refills at ``rate`` per
+    second; a message takes one.
+    """
+
+    def __init__(self, rate, burst, url=None):
+        self.rate = rate
+        self.burst = burst
+        self.url = url
+
+    def _key(self, user_id, room_id):
+        return f"ratelimit:{user_id}:{room_id}"
+
+    async def take(self, user_id, room_id):
+        """Take a token; returns False when the bucket is empty"""
+        allowed = await get_async_redis(self.url).eval(
+            TAKE_SCRIPT,
+            1,
+            self._key(user_id, room_id),
+            time.time(),
+            self.rate,
+            self.burst,
+            # A full bucket needs no key
+            int(self.burst / self.rate) + 1,
+        )
+        return bool(allowed)
+
+
+class LocalRateLimiter:
+    """In-process token buckets, for development and tests"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        # (user id, room id) -> (tokens, monotonic time)
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    async def take(self, user_id, room_id):
+        now = time.monotonic()
+        key = (user_id, str(room_id))
+        with self._lock:
+            tokens, at = self._buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - at) * self.rate)
+            allowed = tokens >= 1
+            self._buckets[key] = (tokens - 1 if allowed else tokens, now)
+        return allowed
+
+
+_rate_limiter = None
+
+
+def get_rate_limiter():
+    """Return the configured message rate limiter"""
+    global _rate_limiter
+    if _rate_limiter is None:
+        config = chat_settings("CHAT_ADMISSION")
+        if config["BACKEND"] == "redis":
+            _rate_limiter = RedisRateLimiter(
+                config["MESSAGE_RATE"], config["MESSAGE_BURST"], config["REDIS_URL"]
+            )
+        else:
+            _rate_limiter = LocalRateLimiter(
+                config["MESSAGE_RATE"], config["MESSAGE_BURST"]
+            )
+    return _rate_limiter
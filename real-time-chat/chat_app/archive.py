@@ -0,0 +1,193 @@
+# chat_app/archive.py
+import zlib
+from datetime import datetime, timedelta, timezone as dt_timezone
+from types import SimpleNamespace
+
+import msgpack
+from django.db import transaction
+
+from .models import ArchivedMessageBatch, Message
+from .pagination import BEFORE, encode_cursor, keyset_page
+
+
+class ArchivedMessage:
+    """A message read back from an archive batch
+
+    Has the attributes serialize_message uses, so archived and live
+    messages can be mixed in one page.
+    """
+
+    # Sequence numbers only matter for resuming recent messages
+    seq = None
+
+    def __init__(self, id, room_id, sender_id, sender_username, timestamp, content):
+        self.id = id
+        self.room_id = room_id
+        self.sender_id = sender_id
+        self.sender = SimpleNamespace(id=sender_id, username=sender_username)
+        self.timestamp = timestamp
+        self.content = content
+
+    @property
+    def key(self):
+        return (self.timestamp, self.id)
+
+
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+MICROSECOND = timedelta(microseconds=1)
+
+
+def _epoch_us(value):
+    # Integer arithmetic: a float timestamp can be off by a microsecond
+    return (value - EPOCH) // MICROSECOND
+
+
+def _from_epoch_us(value):
+    return EPOCH + value * MICROSECOND
+
+
+def pack_messages(rows):
+    """Compress (id, sender_id, username, timestamp, content) rows"""
+    return zlib.compress(
+        msgpack.packb(
+            [
+                [message_id, sender_id, username, _epoch_us(timestamp), content]
+                for message_id, sender_id, username, timestamp, content in rows
+            ]
+        )
+    )
+
+
+def unpack_batch(batch):
+    rows = msgpack.unpackb(zlib.decompress(bytes(batch.data)))
+    return [
+        ArchivedMessage(
+            message_id, batch.room_id, sender_id, username, _from_epoch_us(ts), content
+        )
+        for message_id, sender_id, username, ts, content in rows
+    ]
+
+
+def _period(timestamp):
+    """The calendar month a message is archived with"""
+    return (timestamp.year, timestamp.month)
+
+
+def archive_room(room_id, cutoff, batch_size=1000):
+    """Move a room's messages older than cutoff into archive batches
+
+    Each batch holds at most batch_size messages of a single month. Every
+    batch is written and its rows deleted in one transaction, so a message
+    is always in exactly one of the two tables. Returns how many messages
+    were archived.
+    """
+    archived = 0
+    while True:
+        rows = list(
+            Message.objects.filter(room_id=room_id, timestamp__lt=cutoff)
+            .order_by("timestamp", "id")
+            .values_list("id", "sender_id", "sender__username", "timestamp", "content")[
+                :batch_size
+            ]
+        )
+        if not rows:
+            return archived
+
+        period = _period(rows[0][3])
+        rows = [row for row in rows if _period(row[3]) == period]
+        ids = [row[0] for row in rows]
+
+        with transaction.atomic():
+            ArchivedMessageBatch.objects.create(
+                room_id=room_id,
+                start_at=rows[0][3],
+                end_at=rows[-1][3],
+                min_message_id=min(ids),
+                max_message_id=max(ids),
+                message_count=len(rows),
+                data=pack_messages(rows),
+            )
+            Message.objects.filter(id__in=ids).delete()
+        archived += len(rows)
+
+
+def archived_page(room_id, direction, timestamp=None, pk=None, limit=50):
+    """Read archived messages like pagination.keyset_page reads the table
+
+    Returns (items oldest first, has_more). Only the batches overlapping
+    the requested range are decompressed.
+    """
+    batches = ArchivedMessageBatch.objects.filter(room_id=room_id)
+    if direction == BEFORE:
+        if timestamp is not None:
+            batches = batches.filter(start_at__lte=timestamp)
+        batches = batches.order_by("-end_at", "-max_message_id")
+    else:
+        if timestamp is not None:
+            batches = batches.filter(end_at__gte=timestamp)
+        batches = batches.order_by("start_at", "min_message_id")
+
+    items = []
+    for batch in batches.iterator():
+        messages = unpack_batch(batch)
+        if direction == BEFORE:
+            messages = [
+                m for m in reversed(messages) if timestamp is None or m.key < (timestamp, pk)
+            ]
+        else:
+            messages = [m for m in messages if timestamp is None or m.key > (timestamp, pk)]
+        items.extend(messages)
+        if len(items) > limit:
+            break
+
+    has_more = len(items) > limit
+    items = items[:limit]
+    if direction == BEFORE:
+        items.reverse()
+    return items, has_more
+
+
+def keyset_page_with_archive(
+    queryset, room_id, direction, timestamp=None, pk=None, limit=50
+):
+    """pagination.keyset_page over a room's messages, falling through to the archive
+
+    Archived messages are all older than the ones in the table, so going
+    back in time the archive continues where the table runs out, and going
+    forward from an archived position it comes before the table.
+    """
+    if direction == BEFORE:
+        page, next_cursor = keyset_page(queryset, direction, timestamp, pk, limit)
+        if next_cursor is not None:
+            return page, next_cursor
+        if page:
+            timestamp, pk = page[0].timestamp, page[0].id
+        archived, has_more = archived_page(
+            room_id, direction, timestamp, pk, limit - len(page)
+        )
+        page = archived + page
+        first = page[0] if page else None
+        if has_more and first is not None:
+            return page, encode_cursor(direction, first.timestamp, first.id)
+        return page, None
+
+    archived, has_more = archived_page(room_id, direction, timestamp, pk, limit)
+    if len(archived) == limit:
+        if has_more or queryset.exists():
+            last = archived[-1]
+            return archived, encode_cursor(direction, last.timestamp, last.id)
+        return archived, None
+    page, next_cursor = keyset_page(queryset, direction, timestamp, pk, limit - len(archived))
+    return archived + page, next_cursor
+
+
+def find_archived(room_id, message_id):
+    """Return an archived message of a room by id, or None"""
+    batches = ArchivedMessageBatch.objects.filter(
+        room_id=room_id, min_message_id__lte=message_id, max_message_id__gte=message_id
+    )
+    for batch in batches:
+        for message in unpack_batch(batch):
+            if message.id == message_id:
+                return message
+    return None
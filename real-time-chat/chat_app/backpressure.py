@@ -0,0 +1,183 @@
+# chat_app/backpressure.py
+import asyncio
+import logging
+import time
+from collections import deque
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# Close code for sockets that could not keep up
+SLOW_CONSUMER_CLOSE_CODE = 4008
+
+# Frames that only carry the latest state of something: a newer frame with
+# the same key replaces a queued one, and under overflow they are dropped.
+# Frame type -> event field the key is taken from.
+COALESCED_FRAMES = {
+    "typing": "user_id",
+    "typing_set": "origin",
+    "user_status": "user_id",
+    "user_online_status": "user_id",
+    "read_receipt": "user_id",
+}
+
+
+class _Entry:
+    __slots__ = ("frame_type", "frame", "key", "message_id")
+
+    def __init__(self, frame_type, frame, key, message_id):
+        self.frame_type = frame_type
+        self.frame = frame
+        self.key = key
+        self.message_id = message_id
+
+
+class OutboundQueue:
+    """Frames waiting to be written to one socket, with a bounded length
+
+    Group events are handed over right away, so the consumer keeps draining
+    its channel layer channel however slowly the client reads; what the
+    client cannot take yet waits here. Once ``high_water`` frames are
+    queued:
+
+    * state frames (typing, status, read receipts) are dropped,
+    * with ``on_overflow="resync"`` the queued chat messages are dropped
+      and replaced by one ``resync`` frame carrying the id of the last
+      message the client got, so it fetches the rest over HTTP; messages
+      are dropped until the queue is back under ``low_water``,
+    * with ``on_overflow="disconnect"``, or when a resync does not drain
+      within ``stall_timeout`` seconds, the socket is closed with 4008.
+
+    The queue only fills when the ASGI server's ``send`` waits for the
+    client, as uvicorn's does. Daphne's returns as soon as the frame is
+    handed to Twisted, so under Daphne frames never wait here and a slow
+    reader's backlog grows in the server's transport buffer instead.
+    """
+
+    def __init__(
+        self,
+        send,
+        close,
+        encode_resync,
+        high_water=256,
+        low_water=64,
+        stall_timeout=10,
+        on_overflow="resync",
+    ):
+        self._send = send
+        self._close = close
+        self._encode_resync = encode_resync
+        self.high_water = high_water
+        self.low_water = low_water
+        self.stall_timeout = stall_timeout
+        self.on_overflow = on_overflow
+
+        self._entries = deque()
+        self._keyed = {}
+        self._ready = asyncio.Event()
+        self._task = None
+        self._close_task = None
+        self.closing = False
+        # Id of the last chat message taken off the queue for writing
+        self.last_message_id = None
+        # monotonic time the current resync started, None when not resyncing
+        self.resync_since = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    def put(self, frame_type, frame, event=None):
+        """Queue an encoded frame; never waits"""
+        if self.closing:
+            return
+
+        key = None
+        if frame_type in COALESCED_FRAMES and event is not None:
+            key = (frame_type, event.get(COALESCED_FRAMES[frame_type]))
+            queued = self._keyed.get(key)
+            if queued is not None:
+                queued.frame = frame
+                metrics.outbound_coalesced.inc(frame_type)
+                return
+
+        message_id = None
+        if frame_type == "message" and event is not None:
+            message_id = event.get("message_id")
+        if self.resync_since is not None:
+            if time.monotonic() - self.resync_since > self.stall_timeout:
+                self._give_up()
+                return
+            if message_id is not None or key is not None:
+                # The client fetches these once the resync frame arrives
+                metrics.outbound_dropped.inc(frame_type)
+                return
+
+        if len(self._entries) >= self.high_water:
+            if key is not None:
+                metrics.outbound_dropped.inc(frame_type)
+                return
+            if message_id is not None:
+                if self.on_overflow != "resync":
+                    self._give_up()
+                    return
+                self._start_resync()
+                metrics.outbound_dropped.inc(frame_type)
+                return
+            if len(self._entries) >= 2 * self.high_water:
+                # Even frames that cannot be dropped are piling up
+                self._give_up()
+                return
+
+        entry = _Entry(frame_type, frame, key, message_id)
+        self._entries.append(entry)
+        if key is not None:
+            self._keyed[key] = entry
+        self._ready.set()
+
+    def _start_resync(self):
+        dropped = [entry for entry in self._entries if entry.message_id is not None]
+        self._entries = deque(entry for entry in self._entries if entry.message_id is None)
+        for entry in dropped:
+            metrics.outbound_dropped.inc(entry.frame_type)
+        self.resync_since = time.monotonic()
+        self._entries.append(
+            _Entry("resync", self._encode_resync(self.last_message_id), None, None)
+        )
+        metrics.outbound_resyncs.inc()
+        self._ready.set()
+
+    def _give_up(self):
+        self.closing = True
+        self._entries.clear()
+        self._keyed.clear()
+        metrics.slow_consumer_closes.inc()
+        logger.info("Closing a socket that stopped reading")
+        self._close_task = asyncio.create_task(self._close(SLOW_CONSUMER_CLOSE_CODE))
+
+    async def _run(self):
+        while True:
+            if not self._entries:
+                self._ready.clear()
+                await self._ready.wait()
+                continue
+
+            entry = self._entries.popleft()
+            if entry.key is not None and self._keyed.get(entry.key) is entry:
+                del self._keyed[entry.key]
+            if entry.message_id is not None:
+                # Counts once it is being written: a resync queued meanwhile
+                # goes out after it
+                self.last_message_id = entry.message_id
+            await self._send(entry.frame)
+
+            if self.resync_since is not None and len(self._entries) <= self.low_water:
+                self.resync_since = None
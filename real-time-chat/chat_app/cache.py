@@ -0,0 +1,286 @@
+# chat_app/cache.py
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from django.db import transaction
+
+from .conf import chat_settings
+from .models import ChatRoom
+from .presence import get_presence
+from .redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+
+class TTLCache:
+    """A small thread-safe LRU cache whose entries expire after ``ttl`` seconds"""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+_config = chat_settings("CHAT_CACHE")
+
+# room id -> frozenset of participant ids
+room_members = TTLCache(_config["MAX_ROOMS"], _config["MEMBERSHIP_TTL"])
+# room id -> room type, "" for rooms that do not exist
+room_types = TTLCache(_config["MAX_ROOMS"], _config["MEMBERSHIP_TTL"])
+# single "ids" entry holding the frozenset of online user ids
+online_users = TTLCache(1, _config["PRESENCE_TTL"])
+# user id -> User, for WebSocket handshakes (see ws_auth.py)
+users = TTLCache(_config["MAX_USERS"], _config["USER_TTL"])
+
+
+# Room membership
+
+
+def get_room_member_ids(room_id):
+    """Return the participant ids of a room, from cache when possible"""
+    ensure_invalidation_listener()
+    room_id = int(room_id)
+    members = room_members.get(room_id)
+    if members is None:
+        members = frozenset(
+            ChatRoom.participants.through.objects.filter(
+                chatroom_id=room_id
+            ).values_list("user_id", flat=True)
+        )
+        room_members.set(room_id, members)
+    return members
+
+
+def is_room_member(room_id, user_id):
+    return user_id in get_room_member_ids(room_id)
+
+
+async def aget_room_member_ids(room_id):
+    """Async variant that only queries on a cache miss"""
+    ensure_invalidation_listener()
+    room_id = int(room_id)
+    members = room_members.get(room_id)
+    if members is None:
+        members = frozenset(
+            [
+                user_id
+                async for user_id in ChatRoom.participants.through.objects.filter(
+                    chatroom_id=room_id
+                ).values_list("user_id", flat=True)
+            ]
+        )
+        room_members.set(room_id, members)
+    return members
+
+
+async def ais_room_member(room_id, user_id):
+    return user_id in await aget_room_member_ids(room_id)
+
+
+def membership_changed(room_id):
+    """Drop cached membership for a room here and on every other worker"""
+    room_id = int(room_id)
+    room_members.delete(room_id)
+    transaction.on_commit(
+        lambda: publish_invalidation({"type": "membership.changed", "room_id": room_id})
+    )
+
+
+async def aget_room_type(room_id):
+    """A room's type, None if there is no such room; queries on a miss"""
+    ensure_invalidation_listener()
+    room_id = int(room_id)
+    room_type = room_types.get(room_id)
+    if room_type is None:
+        room_type = (
+            await ChatRoom.objects.filter(id=room_id)
+            .values_list("room_type", flat=True)
+            .afirst()
+        ) or ""
+        room_types.set(room_id, room_type)
+    return room_type or None
+
+
+def room_changed(room_id):
+    """Drop a room's cached type here and on every other worker"""
+    room_types.delete(room_id)
+    transaction.on_commit(
+        lambda: publish_invalidation({"type": "room.changed", "room_id": room_id})
+    )
+
+
+def user_changed(user_id):
+    """Drop a cached user here and on every other worker"""
+    users.delete(user_id)
+    transaction.on_commit(
+        lambda: publish_invalidation({"type": "user.changed", "user_id": user_id})
+    )
+
+
+# Presence
+
+
+def get_online_user_ids():
+    """Return the ids of online users, refreshed from presence every few seconds"""
+    ids = online_users.get("ids")
+    if ids is None:
+        ids = frozenset(get_presence().online_user_ids())
+        online_users.set("ids", ids)
+    return ids
+
+
+# Cross-worker invalidation
+#
+# Entries are dropped right away on the worker that made the change, and
+# again everywhere once the transaction commits, so nothing re-caches the
+# old rows meanwhile.
+
+
+def apply_invalidation(event):
+    if event["type"] == "membership.changed":
+        room_members.delete(event["room_id"])
+    elif event["type"] == "room.changed":
+        room_types.delete(event["room_id"])
+    elif event["type"] == "user.changed":
+        users.delete(event["user_id"])
+
+
+def clear_caches():
+    for cache in (room_members, room_types, users):
+        cache.clear()
+
+
+class RedisInvalidation:
+    """Invalidations over Redis pub/sub, heard by every process using the caches
+
+    Each process subscribes from a daemon thread, started by its first
+    cache read, so HTTP-only workers are invalidated like socket workers.
+    Events published while a subscriber is disconnected are lost; it
+    clears its caches whenever it (re)subscribes instead.
+    """
+
+    CHANNEL = "chat:cache_invalidation"
+
+    def __init__(self, ping_interval, url=None):
+        self.ping_interval = ping_interval
+        self.url = url
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def publish(self, event):
+        get_redis(self.url).publish(self.CHANNEL, json.dumps(event))
+
+    def _listening(self):
+        # Threads do not survive a fork, the pid tells a forked worker apart
+        return (
+            self._thread is not None
+            and self._pid == os.getpid()
+            and self._thread.is_alive()
+        )
+
+    def ensure_listening(self):
+        if self._listening():
+            return
+        with self._lock:
+            if not self._listening():
+                self._thread = threading.Thread(
+                    target=self._listen, name="chat-cache-invalidation", daemon=True
+                )
+                self._thread.start()
+                self._pid = os.getpid()
+
+    def _listen(self):
+        while True:
+            try:
+                self._subscribe_and_apply()
+            except Exception:
+                logger.exception("Cache invalidation listener lost its connection")
+                time.sleep(1)
+
+    def _subscribe_and_apply(self):
+        with get_redis(self.url).pubsub(ignore_subscribe_messages=True) as pubsub:
+            pubsub.subscribe(self.CHANNEL)
+            clear_caches()
+            while True:
+                message = pubsub.get_message(timeout=self.ping_interval)
+                if message is None:
+                    # Notices a dead connection instead of waiting forever
+                    pubsub.ping()
+                elif message["type"] == "message":
+                    apply_invalidation(json.loads(message["data"]))
+
+
+class LocalInvalidation:
+    """Invalidates this process only, for development and tests"""
+
+    def publish(self, event):
+        apply_invalidation(event)
+
+    def ensure_listening(self):
+        pass
+
+
+_invalidation = None
+
+
+def get_invalidation():
+    """Return the configured invalidation backend"""
+    global _invalidation
+    if _invalidation is None:
+        config = chat_settings("CHAT_CACHE")
+        if config["BACKEND"] == "redis":
+            _invalidation = RedisInvalidation(
+                config["LISTENER_PING_INTERVAL"], config["REDIS_URL"]
+            )
+        else:
+            _invalidation = LocalInvalidation()
+    return _invalidation
+
+
+def publish_invalidation(event):
+    try:
+        get_invalidation().publish(event)
+    except Exception:
+        # Other workers fall back on the TTL
+        logger.exception("Could not publish cache invalidation %s", event["type"])
+
+
+def ensure_invalidation_listener():
+    """Start this process's invalidation listener if it is not running yet"""
+    get_invalidation().ensure_listening()
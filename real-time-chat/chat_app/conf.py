@@ -0,0 +1,142 @@
+# chat_app/conf.py
+import os
+import socket
+
+from django.conf import settings
+
+# Identifies this worker process in events and metrics
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+# Defaults for the chat performance settings. Each group can be overridden
+# (partially) from settings.py, e.g. CHAT_WRITE_BEHIND = {"ENABLED": True}
+DEFAULTS = {
+    "CHAT_WRITE_BEHIND": {
+        "ENABLED": False,
+        # Flush once this many messages are pending...
+        "FLUSH_SIZE": 200,
+        # ...or after this many seconds, whichever comes first
+        "FLUSH_INTERVAL": 0.25,
+    },
+    "CHAT_CACHE": {
+        # Seconds before a cached room membership / presence entry is reloaded
+        "MEMBERSHIP_TTL": 60,
+        "PRESENCE_TTL": 10,
+        "MAX_ROOMS": 10000,
+        # Users resolved for WebSocket handshakes, reloaded after USER_TTL
+        # seconds or when the user is saved
+        "USER_TTL": 300,
+        "MAX_USERS": 10000,
+        # Invalidation between processes: "redis" publishes it over Redis
+        # pub/sub, "local" only invalidates this process
+        "BACKEND": "local",
+        "REDIS_URL": None,
+        # Seconds between pings of an idle invalidation subscription
+        "LISTENER_PING_INTERVAL": 30,
+    },
+    "CHAT_PRESENCE": {
+        # "redis" in production, "local" keeps presence in-process
+        "BACKEND": "local",
+        "REDIS_URL": None,
+        # A socket counts as connected this many seconds after its last
+        # heartbeat; consumers send one every HEARTBEAT_INTERVAL seconds
+        "TTL": 90,
+        "HEARTBEAT_INTERVAL": 30,
+        "LAST_SEEN_FLUSH_INTERVAL": 60,
+        # Most users one socket may watch, and seconds between the batched
+        # presence diffs it is sent
+        "WATCH_LIMIT": 500,
+        "BATCH_INTERVAL": 1.0,
+    },
+    "CHAT_HISTORY": {
+        # Ring buffer of the newest messages per room: "redis" in production,
+        # "local" keeps it in-process
+        "BACKEND": "local",
+        "REDIS_URL": None,
+        "BUFFER_SIZE": 200,
+        # Seconds an idle room's buffer is kept
+        "BUFFER_TTL": 24 * 60 * 60,
+        # Newest messages sent in the history frame when a socket connects
+        "SIZE": 50,
+        # A reconnecting socket missing more messages than this gets the
+        # newest history instead of a replay of everything it missed
+        "REPLAY_LIMIT": 500,
+    },
+    "CHAT_SEQUENCE": {
+        # Per-room message sequence numbers: "redis" in production, "local"
+        # counts in-process (single process only)
+        "BACKEND": "local",
+        "REDIS_URL": None,
+    },
+    "CHAT_UNREAD": {
+        # Per-user unread counters: "redis" in production, "local" counts
+        # in-process (single process only)
+        "BACKEND": "local",
+        "REDIS_URL": None,
+        # Seconds a user's counters are kept in Redis after their last change
+        "TTL": 30 * 24 * 60 * 60,
+        # Seconds between checkpoints of changed counters to ReadState
+        "CHECKPOINT_INTERVAL": 60,
+        # At most one unread frame per user in this many seconds
+        "PUSH_INTERVAL": 1.0,
+    },
+    "CHAT_TYPING": {
+        # At most one typing_set event per room and worker in this many seconds
+        "FLUSH_INTERVAL": 0.3,
+        # While someone types the set is re-sent this often, so clients can
+        # expire sets of workers that went quiet
+        "REFRESH_INTERVAL": 2,
+        # Typing without a stop frame ends on its own after this many seconds
+        "TTL": 5,
+    },
+    "CHAT_BACKPRESSURE": {
+        # Frames queued for one socket before overflow handling kicks in,
+        # and the length a resync has to drain to. Only reached on ASGI
+        # servers whose send waits for the client; Daphne's does not
+        "HIGH_WATER": 256,
+        "LOW_WATER": 64,
+        # "resync": drop chat messages and tell the client to fetch them;
+        # "disconnect": close the socket with 4008 right away
+        "ON_OVERFLOW": "resync",
+        # Seconds a resync may take to drain before the socket is closed
+        "STALL_TIMEOUT": 10,
+    },
+    "CHAT_METRICS": {
+        # Off, instrumented code only checks a flag
+        "ENABLED": False,
+        # Bearer token for scrapers of /chat/metrics/; staff can always read it
+        "TOKEN": None,
+    },
+    "CHAT_ADMISSION": {
+        # Message rate limits: "redis" shares them between workers, "local"
+        # limits per process
+        "BACKEND": "local",
+        "REDIS_URL": None,
+        # Token bucket per user and room: MESSAGE_RATE messages per second
+        # on average, bursts of up to MESSAGE_BURST
+        "MESSAGE_RATE": 1.0,
+        "MESSAGE_BURST": 10,
+        # Open sockets per user (chat and online, across workers) before
+        # new ones are rejected
+        "MAX_SOCKETS_PER_USER": 20,
+    },
+    "CHAT_WS_AUTH": {
+        # Seconds a signed WebSocket ticket stays valid; sockets the session
+        # logged in are sent a fresh one at least every half of it. Tickets
+        # travel in the query string and may end up in access logs, so
+        # keep this short
+        "TICKET_MAX_AGE": 300,
+    },
+    "CHAT_ARCHIVE": {
+        # archive_messages moves messages older than this many days into
+        # compressed per-month batches of at most BATCH_SIZE messages
+        "AFTER_DAYS": 90,
+        "BATCH_SIZE": 1000,
+    },
+}
+
+
+def chat_settings(name):
+    """Return a settings group merged over its defaults"""
+    merged = dict(DEFAULTS.get(name, {}))
+    merged.update(getattr(settings, name, {}))
+    return merged
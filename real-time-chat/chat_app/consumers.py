@@ -1,216 +1,528 @@
 # chat_app/consumers.py
-import json
-from channels.generic.websocket import AsyncWebsocketConsumer
+import asyncio
+import logging
+import time
+from urllib.parse import parse_qs
 from channels.db import database_sync_to_async
-from django.contrib.auth import get_user_model
-from asgiref.sync import sync_to_async
-from .models import ChatRoom, Message, DirectMessage, UserStatus
+from channels.generic.websocket import AsyncWebsocketConsumer
+from . import metrics
+from .admission import can_join_room, get_rate_limiter
+from .backpressure import OutboundQueue
+from .cache import aget_room_member_ids
+from .conf import chat_settings
+from .history import aget_history, aget_messages_after, push_message
+from .models import Message, ReadState
+from .persistence import get_message_writer
+from .presence import ensure_last_seen_flusher, get_presence, presence_group
+from .protocol import DecodeError, event_frame, negotiate, new_event
+from .sequence import get_sequences
+from .typing_indicators import typing_aggregator
+from .unread import amark_read, count_unread, ensure_unread_checkpointer, inbox_group
+from .ws_auth import issue_ticket, session_logs_in
+
+logger = logging.getLogger(__name__)
+
+
+def parse_user_ids(value, limit):
+    """The ids among the first ``limit`` entries of a client's ``user_ids``
+
+    Entries that are not ids are skipped, and anything but a list counts
+    as empty.
+    """
+    if not isinstance(value, list):
+        return set()
+    user_ids = set()
+    for user_id in value[:limit]:
+        try:
+            user_id = int(user_id)
+        except (TypeError, ValueError, OverflowError):
+            continue
+        # Out of range ids would make invalid group names
+        if 0 < user_id < 2**63:
+            user_ids.add(user_id)
+    return user_ids
+
+
+class PresenceMixin:
+    """Registers the socket with the presence engine and keeps it alive
+
+    When the user's overall state changes it is published to the sockets
+    watching them (``presence_{user_id}``), not to everyone.
+    """
+
+    heartbeat_task = None
+    # Set once the socket passed admission; rejected sockets skip the
+    # disconnect bookkeeping
+    admitted = False
+
+    async def over_socket_limit(self):
+        """Whether the user already has the most sockets allowed open"""
+        limit = chat_settings("CHAT_ADMISSION")["MAX_SOCKETS_PER_USER"]
+        return await get_presence().connection_count(self.user.id) >= limit
+
+    async def reject(self, reason):
+        """Refuse the handshake before joining any group"""
+        metrics.ws_rejected.inc(reason)
+        await self.close(code=4003)
+
+    async def update_user_status(self, is_online):
+        """Returns True when the user's overall online state changed"""
+        with metrics.consumer_seconds.time("update_user_status"):
+            return await self._update_user_status(is_online)
+
+    async def _update_user_status(self, is_online):
+        presence = get_presence()
+        if is_online:
+            ensure_last_seen_flusher()
+            changed = await presence.connect(self.user.id, self.channel_name)
+            self.heartbeat_task = asyncio.create_task(self.heartbeat())
+        else:
+            if self.heartbeat_task:
+                self.heartbeat_task.cancel()
+            changed = await presence.disconnect(self.user.id, self.channel_name)
+
+        if changed:
+            with metrics.group_send_seconds.time("presence_changed"):
+                await self.channel_layer.group_send(
+                    presence_group(self.user.id),
+                    {
+                        "type": "presence_changed",
+                        "user_id": self.user.id,
+                        "is_online": is_online,
+                    },
+                )
+        return changed
+
+    async def heartbeat(self):
+        interval = chat_settings("CHAT_PRESENCE")["HEARTBEAT_INTERVAL"]
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await get_presence().heartbeat(self.user.id, self.channel_name)
+            except Exception:
+                logger.exception("Presence heartbeat failed")
+            try:
+                await self.refresh_ticket()
+            except Exception:
+                logger.exception("Ticket refresh failed")
+
+    async def refresh_ticket(self):
+        # Long-lived sockets keep a valid ticket for their reconnect, as
+        # long as their session is still logged in
+        if not self.ticket_needs_refresh():
+            return
+        if await database_sync_to_async(session_logs_in)(self.scope["session"], self.user):
+            await self.send_ticket()
+        else:
+            self.ticket_sent_at = None
+
+
+class ProtocolMixin:
+    """Wire format negotiation and encode-once sending of group events
+
+    Clients that offer the ``chat.msgpack`` or ``chat.cbor`` subprotocol get
+    compact binary frames, everyone else gets JSON. Events built with
+    new_event carry their frames pre-encoded, which are forwarded as is.
+    Frames go out through the socket's bounded OutboundQueue.
+    """
+
+    codec = None
+    outbound = None
+    ticket_sent_at = None
+
+    async def accept_with_protocol(self):
+        self.codec = negotiate(self.scope.get("subprotocols"))
+        await self.accept(subprotocol=self.codec.subprotocol)
+
+        config = chat_settings("CHAT_BACKPRESSURE")
+        self.outbound = OutboundQueue(
+            self.send_frame,
+            lambda code: self.close(code=code),
+            lambda last_message_id: self.codec.encode(
+                "resync", {"last_message_id": last_message_id}
+            ),
+            high_water=config["HIGH_WATER"],
+            low_water=config["LOW_WATER"],
+            stall_timeout=config["STALL_TIMEOUT"],
+            on_overflow=config["ON_OVERFLOW"],
+        )
+        self.outbound.start()
+
+    async def websocket_disconnect(self, message):
+        try:
+            await super().websocket_disconnect(message)
+        finally:
+            if self.outbound:
+                self.outbound.stop()
+
+    async def send_event(self, frame_type, event):
+        self.outbound.put(frame_type, event_frame(self.codec, frame_type, event), event)
+
+    async def send_ticket(self):
+        """Send a signed ticket the client reconnects with (see ws_auth.py)
+
+        Only sockets the session logged in get one; a ticket never buys
+        its holder a fresh ticket.
+        """
+        if not self.scope.get("session_auth"):
+            return
+        self.ticket_sent_at = time.monotonic()
+        await self.send_event(
+            "ticket",
+            {
+                "ticket": issue_ticket(self.user),
+                "expires_in": chat_settings("CHAT_WS_AUTH")["TICKET_MAX_AGE"],
+            },
+        )
+
+    def ticket_needs_refresh(self):
+        max_age = chat_settings("CHAT_WS_AUTH")["TICKET_MAX_AGE"]
+        return (
+            self.ticket_sent_at is not None
+            and time.monotonic() - self.ticket_sent_at > max_age / 2
+        )
 
-User = get_user_model()
+    async def send_frame(self, frame):
+        if self.codec.binary:
+            await self.send(bytes_data=frame)
+        else:
+            await self.send(text_data=frame)
 
+    async def broadcast(self, group, event_type, **fields):
+        with metrics.group_send_seconds.time(event_type):
+            await self.channel_layer.group_send(group, new_event(event_type, **fields))
+
+
+class ChatConsumer(ProtocolMixin, PresenceMixin, AsyncWebsocketConsumer):
+    is_typing = False
+    typing_refreshed_at = 0.0
+    # Whether the connection gauges count this socket
+    counted = False
 
-class ChatConsumer(AsyncWebsocketConsumer):
     async def connect(self):
         self.room_id = self.scope["url_route"]["kwargs"]["room_id"]
         self.room_group_name = f"chat_{self.room_id}"
         self.user = self.scope["user"]
+        ensure_unread_checkpointer()
+
+        reason = await self.admission_error()
+        if reason:
+            await self.reject(reason)
+            return
+        self.admitted = True
 
         # Join room group
         await self.channel_layer.group_add(self.room_group_name, self.channel_name)
 
-        await self.accept()
+        await self.accept_with_protocol()
+        self.counted = True
+        metrics.ws_connections.inc("chat")
+        metrics.room_connections.inc(self.room_id)
+        with metrics.consumer_seconds.time("send_history"):
+            await self.send_history()
 
         # Update user status
         if self.user.is_authenticated:
+            await self.send_ticket()
             await self.update_user_status(True)
 
             # Notify others that user joined
-            await self.channel_layer.group_send(
+            await self.broadcast(
                 self.room_group_name,
-                {
-                    "type": "user_status",
-                    "user_id": self.user.id,
-                    "username": self.user.username,
-                    "is_online": True,
-                },
+                "user_status",
+                user_id=self.user.id,
+                username=self.user.username,
+                is_online=True,
             )
 
+    async def admission_error(self):
+        """Why the socket is rejected, None to admit it"""
+        if not self.user.is_authenticated:
+            return "anonymous"
+        if not await can_join_room(self.user.id, self.room_id):
+            return "forbidden"
+        if await self.over_socket_limit():
+            return "socket_limit"
+        return None
+
     async def disconnect(self, close_code):
+        if not self.admitted:
+            return
         # Leave room group
         await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
+        if self.counted:
+            metrics.ws_connections.dec("chat")
+            metrics.room_connections.dec(self.room_id)
 
-        # Update user status
-        if self.user.is_authenticated:
-            await self.update_user_status(False)
+        if self.is_typing:
+            self.set_typing(False)
 
+        # Update user status; other tabs may still keep the user online
+        if self.user.is_authenticated and await self.update_user_status(False):
             # Notify others that user left
-            await self.channel_layer.group_send(
+            await self.broadcast(
                 self.room_group_name,
-                {
-                    "type": "user_status",
-                    "user_id": self.user.id,
-                    "username": self.user.username,
-                    "is_online": False,
-                },
+                "user_status",
+                user_id=self.user.id,
+                username=self.user.username,
+                is_online=False,
             )
 
-    async def receive(self, text_data):
-        text_data_json = json.loads(text_data)
+    async def receive(self, text_data=None, bytes_data=None):
+        try:
+            text_data_json = self.codec.decode(text_data, bytes_data)
+        except DecodeError:
+            logger.debug("Ignoring malformed frame on %s", self.channel_name)
+            return
         message_type = text_data_json.get("type", "message")
 
         if message_type == "message":
-            message = text_data_json["message"]
-            sender_id = text_data_json["sender_id"]
-
-            # Save message to database
-            message_obj = await self.save_message(message, sender_id)
+            message = text_data_json.get("message")
+            if not isinstance(message, str):
+                return
+            # The sender is the socket's user, whatever the frame says
+            sender_id = self.user.id
+            limiter = get_rate_limiter()
+            if not await limiter.take(self.user.id, self.room_id):
+                metrics.messages_throttled.inc()
+                await self.send_event("throttled", {"retry_after": 1 / limiter.rate})
+                return
+
+            # Save message to database, or hand it to the write-behind
+            # buffer which assigns id and timestamp without a DB round trip
+            metrics.messages_total.inc()
+            writer = get_message_writer()
+            if writer is not None:
+                with metrics.consumer_seconds.time("enqueue_message"):
+                    message_obj = await writer.enqueue(self.room_id, sender_id, message)
+            else:
+                with metrics.consumer_seconds.time("save_message"):
+                    message_obj = await self.save_message(message, sender_id)
+
+            fields = {
+                "message": message,
+                "sender_id": sender_id,
+                "sender_username": self.user.username,
+                "timestamp": message_obj.timestamp.isoformat(),
+                "message_id": message_obj.id,
+                "seq": message_obj.seq,
+            }
+            await push_message(self.room_id, fields)
 
             # Send message to room group
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    "type": "chat_message",
-                    "message": message,
-                    "sender_id": sender_id,
-                    "sender_username": self.user.username,
-                    "timestamp": message_obj.timestamp.isoformat(),
-                    "message_id": message_obj.id,
-                },
-            )
-
-        elif message_type == "typing":
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    "type": "typing_indicator",
-                    "user_id": self.user.id,
-                    "username": self.user.username,
-                    "is_typing": text_data_json["is_typing"],
-                },
-            )
+            await self.broadcast(self.room_group_name, "chat_message", **fields)
+            await count_unread(self.room_id, sender_id)
+
+        elif message_type == "read" and self.user.is_authenticated:
+            # Advance the read watermark; one frame covers every message
+            # up to message_id
+            try:
+                message_id = int(text_data_json["message_id"])
+            except (KeyError, TypeError, ValueError):
+                return
+            message_id = await ReadState.aclamp(self.room_id, message_id)
+            if message_id is not None and await self.mark_read(message_id):
+                await amark_read(self.user.id, self.room_id, message_id)
+                await self.broadcast(
+                    self.room_group_name,
+                    "read_receipt",
+                    user_id=self.user.id,
+                    username=self.user.username,
+                    message_id=message_id,
+                )
+
+        elif message_type == "typing" and self.user.is_authenticated:
+            # Coalesced per room by the worker's typing aggregator
+            self.set_typing(bool(text_data_json.get("is_typing")))
+
+    async def send_history(self):
+        """Send the newest messages, which the page no longer renders
+
+        A reconnecting client passes the last sequence number it saw
+        (``?last_seq=``) and only gets the messages it missed, unless
+        that is more than the replay limit.
+        """
+        frame_type, messages = "history", None
+        resume_from = self.resume_seq()
+        if resume_from is not None:
+            messages = await aget_messages_after(self.room_id, resume_from)
+            if messages is not None:
+                frame_type = "replay"
+        if messages is None:
+            messages = await aget_history(self.room_id)
+        read_up_to = 0
+        if self.user.is_authenticated and messages:
+            read_up_to = await self.get_read_up_to()
+        await self.send_event(frame_type, {"messages": messages, "read_up_to": read_up_to})
+
+    def resume_seq(self):
+        query = parse_qs(self.scope.get("query_string", b"").decode())
+        try:
+            return int(query["last_seq"][0])
+        except (KeyError, ValueError):
+            return None
+
+    def set_typing(self, is_typing):
+        now = time.monotonic()
+        if is_typing == self.is_typing:
+            # Repeated "still typing" frames only need to keep the state from
+            # expiring, so at most one per half TTL reaches the aggregator
+            if not is_typing or now - self.typing_refreshed_at < typing_aggregator.ttl / 2:
+                return
+        self.is_typing = is_typing
+        self.typing_refreshed_at = now
+        typing_aggregator.update(
+            self.room_group_name, self.user.id, self.user.username, is_typing
+        )
 
     async def chat_message(self, event):
         # Send message to WebSocket
-        await self.send(
-            text_data=json.dumps(
-                {
-                    "type": "message",
-                    "message": event["message"],
-                    "sender_id": event["sender_id"],
-                    "sender_username": event["sender_username"],
-                    "timestamp": event["timestamp"],
-                    "message_id": event["message_id"],
-                }
-            )
-        )
+        await self.send_event("message", event)
 
     async def typing_indicator(self, event):
         # Send typing indicator to WebSocket
-        await self.send(
-            text_data=json.dumps(
-                {
-                    "type": "typing",
-                    "user_id": event["user_id"],
-                    "username": event["username"],
-                    "is_typing": event["is_typing"],
-                }
-            )
-        )
+        await self.send_event("typing", event)
+
+    async def typing_set(self, event):
+        # Send the room's coalesced typing set to WebSocket
+        await self.send_event("typing_set", event)
 
     async def user_status(self, event):
         # Send user status update to WebSocket
-        await self.send(
-            text_data=json.dumps(
-                {
-                    "type": "user_status",
-                    "user_id": event["user_id"],
-                    "username": event["username"],
-                    "is_online": event["is_online"],
-                }
-            )
-        )
-
-    @database_sync_to_async
-    def save_message(self, content, sender_id):
-        room = ChatRoom.objects.get(id=self.room_id)
-        sender = User.objects.get(id=sender_id)
-        message = Message.objects.create(room=room, sender=sender, content=content)
-        return message
+        await self.send_event("user_status", event)
 
-    @database_sync_to_async
-    def update_user_status(self, is_online):
-        status, created = UserStatus.objects.get_or_create(user=self.user)
-        status.is_online = is_online
-        status.save()
+    async def read_receipt(self, event):
+        # Send read receipt to WebSocket
+        await self.send_event("read_receipt", event)
 
-        # Update user model status
-        self.user.is_online = is_online
-        self.user.save()
+    async def get_read_up_to(self):
+        return await ReadState.aread_up_to(
+            self.room_id, self.user.id, await aget_room_member_ids(self.room_id)
+        )
 
+    async def mark_read(self, message_id):
+        return await ReadState.aadvance(self.user.id, self.room_id, message_id)
 
-class OnlineStatusConsumer(AsyncWebsocketConsumer):
-    """Consumer for tracking online users globally"""
+    async def save_message(self, content, sender_id):
+        """Store a message with a single INSERT
 
-    async def connect(self):
-        self.user = self.scope["user"]
+        Room and sender are set by id instead of being loaded first, and the
+        sequence number is drawn on the event loop, not the database thread.
+        """
+        seq = await get_sequences().anext(self.room_id)
+        with metrics.QueryCounter() as queries:
+            message = await Message.objects.acreate(
+                room_id=self.room_id, sender_id=sender_id, content=content, seq=seq
+            )
+        metrics.message_queries.observe(queries.count)
+        return message
 
-        if self.user.is_authenticated:
-            # Add user to online group
-            await self.channel_layer.group_add("online_users", self.channel_name)
 
-            await self.accept()
+class OnlineStatusConsumer(ProtocolMixin, PresenceMixin, AsyncWebsocketConsumer):
+    """Consumer for the presence of the users a page displays
 
-            # Update user status
-            await self.update_user_status(True)
+    Clients send ``watch``/``unwatch`` frames with the user ids they show
+    and get batched ``presence`` diffs for just those users, instead of
+    every status change of every user.
+    """
 
-            # Broadcast that user is online
-            await self.channel_layer.group_send(
-                "online_users",
-                {
-                    "type": "user_online_status",
-                    "user_id": self.user.id,
-                    "username": self.user.username,
-                    "is_online": True,
-                },
-            )
+    async def connect(self):
+        self.user = self.scope["user"]
+        self.watching = set()
+        self.pending = {}
+        self.flush_task = None
+
+        if not self.user.is_authenticated:
+            await self.reject("anonymous")
+            return
+        if await self.over_socket_limit():
+            await self.reject("socket_limit")
+            return
+        self.admitted = True
+
+        await self.accept_with_protocol()
+        await self.send_ticket()
+        metrics.ws_connections.inc("online")
+        # Unread counts of the user's rooms are pushed here
+        await self.channel_layer.group_add(inbox_group(self.user.id), self.channel_name)
+
+        # Update user status; watchers hear about it if this is the
+        # first connection of the user
+        await self.update_user_status(True)
 
     async def disconnect(self, close_code):
-        if self.user.is_authenticated:
-            # Remove from online group
-            await self.channel_layer.group_discard("online_users", self.channel_name)
-
-            # Update user status
-            await self.update_user_status(False)
-
-            # Broadcast that user is offline
-            await self.channel_layer.group_send(
-                "online_users",
-                {
-                    "type": "user_online_status",
-                    "user_id": self.user.id,
-                    "username": self.user.username,
-                    "is_online": False,
-                },
-            )
-
-    async def user_online_status(self, event):
-        # Send status update to WebSocket
-        await self.send(
-            text_data=json.dumps(
-                {
-                    "type": "user_online_status",
-                    "user_id": event["user_id"],
-                    "username": event["username"],
-                    "is_online": event["is_online"],
-                }
-            )
+        if not self.admitted:
+            return
+        await self.unwatch(set(self.watching))
+        await self.channel_layer.group_discard(inbox_group(self.user.id), self.channel_name)
+        if self.flush_task:
+            self.flush_task.cancel()
+        metrics.ws_connections.dec("online")
+
+        # Update user status; watchers hear about it once the last
+        # connection of the user is gone
+        await self.update_user_status(False)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        try:
+            data = self.codec.decode(text_data, bytes_data)
+        except DecodeError:
+            logger.debug("Ignoring malformed frame on %s", self.channel_name)
+            return
+        user_ids = parse_user_ids(
+            data.get("user_ids"), chat_settings("CHAT_PRESENCE")["WATCH_LIMIT"]
         )
 
-    @database_sync_to_async
-    def update_user_status(self, is_online):
-        status, created = UserStatus.objects.get_or_create(user=self.user)
-        status.is_online = is_online
-        status.save()
-
-        self.user.is_online = is_online
-        self.user.save()
+        if data.get("type") == "watch":
+            await self.watch(user_ids)
+        elif data.get("type") == "unwatch":
+            await self.unwatch(user_ids)
+
+    async def watch(self, user_ids):
+        config = chat_settings("CHAT_PRESENCE")
+        room = max(0, config["WATCH_LIMIT"] - len(self.watching))
+        new = sorted(user_ids - self.watching - {self.user.id})[:room]
+        for user_id in new:
+            await self.channel_layer.group_add(presence_group(user_id), self.channel_name)
+        self.watching.update(new)
+
+        # Send the current state of the newly watched users right away
+        online = await get_presence().are_online(new)
+        for user_id in new:
+            self.pending[user_id] = user_id in online
+        await self.flush_presence()
+
+    async def unwatch(self, user_ids):
+        for user_id in user_ids & self.watching:
+            await self.channel_layer.group_discard(presence_group(user_id), self.channel_name)
+            self.pending.pop(user_id, None)
+        self.watching -= user_ids
+
+    async def presence_changed(self, event):
+        # Collect changes and send them in one frame per batch interval
+        if event["user_id"] not in self.watching:
+            return
+        self.pending[event["user_id"]] = event["is_online"]
+        if self.flush_task is None:
+            self.flush_task = asyncio.create_task(self.flush_later())
+
+    async def unread_counts(self, event):
+        # Already batched per user by the unread notifier
+        await self.send_event("unread", event)
+
+    async def flush_later(self):
+        await asyncio.sleep(chat_settings("CHAT_PRESENCE")["BATCH_INTERVAL"])
+        self.flush_task = None
+        await self.flush_presence()
+
+    async def flush_presence(self):
+        pending, self.pending = self.pending, {}
+        if not pending:
+            return
+        await self.send_event(
+            "presence",
+            {
+                "online": [user_id for user_id, online in pending.items() if online],
+                "offline": [user_id for user_id, online in pending.items() if not online],
+            },
+        )
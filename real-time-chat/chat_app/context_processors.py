@@ -0,0 +1,9 @@
+# chat_app/context_processors.py
+from .cache import get_online_user_ids
+
+
+def presence(request):
+    """Whether the requesting user is online, for the navbar status dot"""
+    if not request.user.is_authenticated:
+        return {}
+    return {"user_is_online": request.user.id in get_online_user_ids()}
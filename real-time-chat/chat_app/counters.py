@@ -0,0 +1,203 @@
+# chat_app/counters.py
+from collections import Counter, defaultdict
+
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import Case, Count, F, OuterRef, Q, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce
+
+from .archive import unpack_batch
+from .models import ArchivedMessageBatch, ChatRoom, Message
+
+User = get_user_model()
+
+
+def preview(content):
+    return content[: ChatRoom.PREVIEW_LENGTH]
+
+
+def _if(condition, field, value):
+    """value where condition holds, else the field's current value"""
+    return Case(
+        When(condition, then=Value(value)),
+        default=F(field),
+        output_field=ChatRoom._meta.get_field(field),
+    )
+
+
+def record_messages(messages):
+    """Count newly stored messages on their rooms and senders
+
+    Runs in the transaction that stores them: one UPDATE per room and one
+    per sender. The last message summary only moves forward, so batches
+    written out of order still leave the newest message in it.
+    """
+    by_room = defaultdict(list)
+    for message in messages:
+        by_room[message.room_id].append(message)
+
+    for room_id, room_messages in by_room.items():
+        last = max(room_messages, key=lambda message: (message.timestamp, message.id))
+        newer = Q(last_message_at__isnull=True) | Q(last_message_at__lte=last.timestamp)
+        ChatRoom.objects.filter(id=room_id).update(
+            message_count=F("message_count") + len(room_messages),
+            last_message_id=_if(newer, "last_message_id", last.id),
+            last_message_at=_if(newer, "last_message_at", last.timestamp),
+            last_message_preview=_if(newer, "last_message_preview", preview(last.content)),
+        )
+
+    senders = Counter(message.sender_id for message in messages)
+    for sender_id, count in senders.items():
+        User.objects.filter(id=sender_id).update(message_count=F("message_count") + count)
+
+
+def _memberships():
+    return ChatRoom.participants.through.objects
+
+
+def _count(queryset, group_by):
+    """Correlated COUNT(*) of queryset, 0 when it is empty"""
+    return Coalesce(
+        Subquery(
+            queryset.order_by().values(group_by).annotate(n=Count("*")).values("n")
+        ),
+        0,
+    )
+
+
+def refresh_memberships(room_ids=(), user_ids=()):
+    """Recount the members of rooms and the rooms of users
+
+    Recounting instead of adding the number of ids passed to add() or
+    remove() stays right when some were already (or never were) members.
+    One UPDATE for the rooms and one for the users.
+    """
+    if room_ids:
+        ChatRoom.objects.filter(id__in=room_ids).update(
+            member_count=_count(_memberships().filter(chatroom=OuterRef("pk")), "chatroom")
+        )
+    if user_ids:
+        User.objects.filter(id__in=user_ids).update(
+            room_count=_count(_memberships().filter(user=OuterRef("pk")), "user"),
+            direct_room_count=_count(
+                _memberships().filter(user=OuterRef("pk"), chatroom__room_type="direct"),
+                "user",
+            ),
+        )
+
+
+# Reconciliation
+
+ROOM_COUNTERS = (
+    "member_count",
+    "message_count",
+    "last_message_id",
+    "last_message_at",
+    "last_message_preview",
+)
+USER_COUNTERS = ("message_count", "room_count", "direct_room_count")
+
+
+def archived_counts_by_sender():
+    """Archived messages per sender; reads every archive batch once"""
+    counts = Counter()
+    for batch in ArchivedMessageBatch.objects.iterator():
+        counts.update(message.sender_id for message in unpack_batch(batch))
+    return counts
+
+
+def _newest_archived(room_id):
+    batch = (
+        ArchivedMessageBatch.objects.filter(room_id=room_id).order_by("-end_at").first()
+    )
+    return unpack_batch(batch)[-1] if batch else None
+
+
+def _room_values(room_ids):
+    newest = Message.objects.filter(room=OuterRef("pk")).order_by("-timestamp", "-id")
+    archived = (
+        ArchivedMessageBatch.objects.filter(room=OuterRef("pk"))
+        .order_by()
+        .values("room")
+        .annotate(n=Sum("message_count"))
+        .values("n")
+    )
+    rows = ChatRoom.objects.filter(id__in=room_ids).values("id").annotate(
+        live_count=_count(Message.objects.filter(room=OuterRef("pk")), "room"),
+        archived_count=Coalesce(Subquery(archived), 0),
+        members=_count(_memberships().filter(chatroom=OuterRef("pk")), "chatroom"),
+        newest_id=Subquery(newest.values("id")[:1]),
+        newest_at=Subquery(newest.values("timestamp")[:1]),
+        newest_content=Subquery(newest.values("content")[:1]),
+    )
+    values = {}
+    for row in rows:
+        last_id, last_at = row["newest_id"], row["newest_at"]
+        content = row["newest_content"]
+        if last_id is None and row["archived_count"]:
+            message = _newest_archived(row["id"])
+            last_id, last_at, content = message.id, message.timestamp, message.content
+        values[row["id"]] = {
+            "member_count": row["members"],
+            "message_count": row["live_count"] + row["archived_count"],
+            "last_message_id": last_id,
+            "last_message_at": last_at,
+            "last_message_preview": preview(content or ""),
+        }
+    return values
+
+
+def _user_values(user_ids, archived_by_sender):
+    memberships = _memberships().filter(user=OuterRef("pk"))
+    rows = User.objects.filter(id__in=user_ids).values("id").annotate(
+        live_count=_count(Message.objects.filter(sender=OuterRef("pk")), "sender"),
+        rooms=_count(memberships, "user"),
+        direct_rooms=_count(memberships.filter(chatroom__room_type="direct"), "user"),
+    )
+    return {
+        row["id"]: {
+            "message_count": row["live_count"] + archived_by_sender.get(row["id"], 0),
+            "room_count": row["rooms"],
+            "direct_room_count": row["direct_rooms"],
+        }
+        for row in rows
+    }
+
+
+def _reconcile(model, fields, ids, expected_values, dry_run):
+    """Lock the rows, recount them and fix the ones that drifted
+
+    The rows stay locked while they are recounted, so a message stored or
+    a member added meanwhile waits and then applies its change on top.
+    """
+    with transaction.atomic():
+        rows = list(
+            model.objects.filter(id__in=ids).select_for_update().only("id", *fields)
+        )
+        expected = expected_values([row.id for row in rows])
+        drifted = []
+        for row in rows:
+            values = expected[row.id]
+            if any(getattr(row, field) != values[field] for field in fields):
+                for field in fields:
+                    setattr(row, field, values[field])
+                drifted.append(row)
+        if drifted and not dry_run:
+            model.objects.bulk_update(drifted, fields)
+    return [row.id for row in drifted]
+
+
+def reconcile_rooms(room_ids, dry_run=False):
+    """Recount rooms' members, messages and last message; returns drifted ids"""
+    return _reconcile(ChatRoom, ROOM_COUNTERS, room_ids, _room_values, dry_run)
+
+
+def reconcile_users(user_ids, archived_by_sender, dry_run=False):
+    """Recount users' messages and rooms; returns drifted ids"""
+    return _reconcile(
+        User,
+        USER_COUNTERS,
+        user_ids,
+        lambda ids: _user_values(ids, archived_by_sender),
+        dry_run,
+    )
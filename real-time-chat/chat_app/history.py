@@ -0,0 +1,306 @@
+# chat_app/history.py
+import json
+import logging
+import threading
+
+from channels.db import database_sync_to_async
+from redis.exceptions import WatchError
+
+from .conf import chat_settings
+from .models import Message
+from .redis_client import get_async_redis, get_redis
+
+logger = logging.getLogger(__name__)
+
+_config = chat_settings("CHAT_HISTORY")
+
+
+def _ordered(messages, size):
+    """Dedupe messages by id and keep the newest ``size``, oldest first"""
+    by_id = {message["message_id"]: message for message in messages}
+    ordered = sorted(by_id.values(), key=lambda m: (m["timestamp"], m["message_id"]))
+    return ordered[-size:]
+
+
+class RedisRecentMessages:
+    """The newest messages of each room in a capped Redis list
+
+    ``chat:recent:{room}`` holds serialized message frames, newest first,
+    pushed as they are sent. A list that was filled from Postgres while the
+    room had fewer messages than fit ends with an empty sentinel, so readers
+    know there is nothing older to fetch. A list that is shorter than the
+    cap without the sentinel only has the messages pushed since it expired
+    and is completed from Postgres on the next read.
+    """
+
+    END = b""
+
+    def __init__(self, size, ttl, url=None):
+        self.size = size
+        self.ttl = ttl
+        self.url = url
+
+    def _key(self, room_id):
+        return f"chat:recent:{room_id}"
+
+    async def push(self, room_id, message):
+        key = self._key(room_id)
+        client = get_async_redis(self.url)
+        async with client.pipeline(transaction=False) as pipe:
+            pipe.lpush(key, json.dumps(message))
+            pipe.ltrim(key, 0, self.size - 1)
+            pipe.expire(key, self.ttl)
+            await pipe.execute()
+
+    def get(self, room_id):
+        """Return (messages oldest first, exhaustive), or None on a miss"""
+        items = get_redis(self.url).lrange(self._key(room_id), 0, self.size - 1)
+        return self._parse(items)
+
+    async def aget(self, room_id):
+        items = await get_async_redis(self.url).lrange(
+            self._key(room_id), 0, self.size - 1
+        )
+        return self._parse(items)
+
+    def _parse(self, items):
+        exhaustive = bool(items) and items[-1] == self.END
+        if exhaustive:
+            items = items[:-1]
+        elif len(items) < self.size:
+            return None
+        return [json.loads(item) for item in reversed(items)], exhaustive
+
+    def fill(self, room_id, messages, exhaustive):
+        """Store messages loaded from Postgres, merged with any pushed meanwhile"""
+        key = self._key(room_id)
+        with get_redis(self.url).pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(key)
+                    pushed = [
+                        json.loads(item)
+                        for item in pipe.lrange(key, 0, -1)
+                        if item != self.END
+                    ]
+                    merged = _ordered(messages + pushed, self.size)
+                    items = [json.dumps(message) for message in reversed(merged)]
+                    if exhaustive and len(items) < self.size:
+                        items.append(self.END)
+
+                    pipe.multi()
+                    pipe.delete(key)
+                    pipe.rpush(key, *items)
+                    pipe.expire(key, self.ttl)
+                    pipe.execute()
+                    return merged, exhaustive and len(merged) < self.size
+                except WatchError:
+                    # A message was pushed while we merged; merge again
+                    continue
+
+
+class LocalRecentMessages:
+    """In-process ring buffers with the same semantics, for development and tests"""
+
+    def __init__(self, size):
+        self.size = size
+        # room id -> (messages oldest first, exhaustive); partial entries
+        # (pushed to before the first fill) have exhaustive None
+        self._rooms = {}
+        self._lock = threading.Lock()
+
+    async def push(self, room_id, message):
+        with self._lock:
+            messages, exhaustive = self._rooms.get(room_id, ([], None))
+            messages = (messages + [message])[-self.size :]
+            if exhaustive and len(messages) == self.size:
+                exhaustive = False
+            self._rooms[room_id] = (messages, exhaustive)
+
+    def get(self, room_id):
+        with self._lock:
+            entry = self._rooms.get(room_id)
+        if entry is None:
+            return None
+        messages, exhaustive = entry
+        if exhaustive is None and len(messages) < self.size:
+            return None
+        return list(messages), bool(exhaustive)
+
+    async def aget(self, room_id):
+        return self.get(room_id)
+
+    def fill(self, room_id, messages, exhaustive):
+        with self._lock:
+            pushed, _ = self._rooms.get(room_id, ([], None))
+            merged = _ordered(messages + pushed, self.size)
+            exhaustive = exhaustive and len(merged) < self.size
+            self._rooms[room_id] = (merged, exhaustive)
+        return list(merged), exhaustive
+
+
+_buffer = None
+
+
+def get_recent_buffer():
+    """Return the configured ring buffer backend"""
+    global _buffer
+    if _buffer is None:
+        config = chat_settings("CHAT_HISTORY")
+        if config["BACKEND"] == "redis":
+            _buffer = RedisRecentMessages(
+                config["BUFFER_SIZE"], config["BUFFER_TTL"], config["REDIS_URL"]
+            )
+        else:
+            _buffer = LocalRecentMessages(config["BUFFER_SIZE"])
+    return _buffer
+
+
+MESSAGE_COLUMNS = ("id", "sender_id", "sender__username", "timestamp", "content", "seq")
+
+
+def _message_frames(rows):
+    return [
+        {
+            "message_id": message_id,
+            "sender_id": sender_id,
+            "sender_username": username,
+            "timestamp": timestamp.isoformat(),
+            "message": content,
+            "seq": seq,
+        }
+        for message_id, sender_id, username, timestamp, content, seq in rows
+    ]
+
+
+def load_history(room_id, limit):
+    """The newest messages of a room with their senders, in one query"""
+    rows = (
+        Message.objects.filter(room_id=room_id)
+        .order_by("-timestamp", "-id")
+        .values_list(*MESSAGE_COLUMNS)[:limit]
+    )
+    return _message_frames(reversed(rows))
+
+
+def get_recent_messages(room_id):
+    """Return (newest messages oldest first, exhaustive) of a room
+
+    Served from the ring buffer; Postgres is only read to fill a missing or
+    partial buffer. ``exhaustive`` is True when the room has no older
+    messages than those returned.
+    """
+    room_id = int(room_id)
+    buffer = get_recent_buffer()
+    try:
+        recent = buffer.get(room_id)
+    except Exception:
+        logger.exception("Reading the recent messages of room %s failed", room_id)
+        recent = None
+    if recent is not None:
+        return recent
+
+    messages = load_history(room_id, buffer.size)
+    exhaustive = len(messages) < buffer.size
+    try:
+        return buffer.fill(room_id, messages, exhaustive)
+    except Exception:
+        logger.exception("Filling the recent messages of room %s failed", room_id)
+        return messages, exhaustive
+
+
+async def aget_recent_messages(room_id):
+    """Async variant that reads the ring buffer on the event loop
+
+    Only a missing or partial buffer is filled from Postgres, in a thread.
+    """
+    try:
+        recent = await get_recent_buffer().aget(int(room_id))
+    except Exception:
+        logger.exception("Reading the recent messages of room %s failed", room_id)
+        recent = None
+    if recent is not None:
+        return recent
+    return await database_sync_to_async(get_recent_messages)(room_id)
+
+
+async def push_message(room_id, message):
+    """Add a sent message (a message frame dict) to the room's ring buffer"""
+    try:
+        await get_recent_buffer().push(int(room_id), message)
+    except Exception:
+        # Readers fill the buffer from Postgres once it expires
+        logger.exception("Pushing to the recent messages of room %s failed", room_id)
+
+
+# History is read from the ring buffer every time: a per-worker copy only
+# sees the messages delivered to this worker's sockets and goes stale in
+# rooms it has no socket in.
+
+
+def get_history(room_id):
+    """Return the newest messages of a room as message frame dicts"""
+    messages, _ = get_recent_messages(room_id)
+    return messages[-_config["SIZE"] :]
+
+
+async def aget_history(room_id):
+    """Async variant that reads the ring buffer on the event loop"""
+    messages, _ = await aget_recent_messages(room_id)
+    return messages[-_config["SIZE"] :]
+
+
+def _missed(messages, seq):
+    """The messages after seq, if ``messages`` hold every one of them, else None
+
+    Sequence numbers are consecutive, so a gap means a message is missing
+    (e.g. a push to the ring buffer failed) and the table has to be read.
+    """
+    seqs = [message.get("seq") for message in messages]
+    if not seqs or None in seqs or min(seqs) > seq + 1:
+        return None
+    missed = sorted(
+        (message for message in messages if message["seq"] > seq), key=lambda m: m["seq"]
+    )
+    if [message["seq"] for message in missed] != list(
+        range(seq + 1, seq + 1 + len(missed))
+    ):
+        return None
+    return missed
+
+
+def _load_missed(room_id, seq):
+    """Messages after seq with one query on the (room, seq) index"""
+    rows = (
+        Message.objects.filter(room_id=room_id, seq__gt=seq)
+        .order_by("seq")
+        .values_list(*MESSAGE_COLUMNS)[: _config["REPLAY_LIMIT"] + 1]
+    )
+    return _message_frames(rows)
+
+
+def _replay(missed):
+    return None if len(missed) > _config["REPLAY_LIMIT"] else missed
+
+
+def get_messages_after(room_id, seq):
+    """Messages of a room after sequence number seq, oldest first
+
+    Returns None when more than REPLAY_LIMIT messages were missed. Served
+    from the ring buffer when it reaches back far enough, else with one
+    query on the (room, seq) index.
+    """
+    recent, _ = get_recent_messages(room_id)
+    missed = _missed(recent, seq)
+    if missed is None:
+        missed = _load_missed(room_id, seq)
+    return _replay(missed)
+
+
+async def aget_messages_after(room_id, seq):
+    """Async variant reading the ring buffer on the event loop"""
+    recent, _ = await aget_recent_messages(room_id)
+    missed = _missed(recent, seq)
+    if missed is None:
+        missed = await database_sync_to_async(_load_missed)(room_id, seq)
+    return _replay(missed)
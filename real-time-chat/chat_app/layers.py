@@ -0,0 +1,64 @@
+# chat_app/layers.py
+import binascii
+import bisect
+import hashlib
+
+from channels_redis.core import RedisChannelLayer
+
+
+class HashRing:
+    """Consistent hashing of keys onto nodes, with virtual nodes
+
+    Every node owns ``replicas`` points on a 32-bit ring and a key belongs to
+    the first point at or after its hash. Adding a node only moves the keys
+    that land on its new points (about 1/N of them) instead of remapping
+    nearly everything like a modulo would.
+    """
+
+    def __init__(self, nodes, replicas=160):
+        self.nodes = list(nodes)
+        self.replicas = replicas
+        points = []
+        for index, node in enumerate(self.nodes):
+            for replica in range(replicas):
+                digest = hashlib.md5(f"{node}#{replica}".encode()).digest()
+                points.append((int.from_bytes(digest[:4], "big"), index))
+        points.sort()
+        self._hashes = [point for point, _ in points]
+        self._indexes = [index for _, index in points]
+
+    def get_index(self, key):
+        """Return the index of the node that owns key"""
+        if len(self.nodes) == 1:
+            return 0
+        if isinstance(key, str):
+            key = key.encode("utf8")
+        position = bisect.bisect(self._hashes, binascii.crc32(key))
+        return self._indexes[position % len(self._indexes)]
+
+
+def host_name(host):
+    """A stable name for a decoded channels_redis host, used on the ring"""
+    if "address" in host:
+        return host["address"]
+    if "sentinels" in host:
+        return f"{host['master_name']}@{host['sentinels']}"
+    return f"{host.get('host', 'localhost')}:{host.get('port', 6379)}/{host.get('db', 0)}"
+
+
+class ShardedRedisChannelLayer(RedisChannelLayer):
+    """RedisChannelLayer that places groups and channels on a hash ring
+
+    channels_redis already spreads groups over several hosts, but by CRC
+    modulo the host count, so adding a shard moves almost every group (and
+    its members) to another instance. Here each ``chat_{room_id}`` and
+    ``presence_{user_id}`` group and every process channel keep their shard
+    when shards are added, apart from the ~1/N that move to the new one.
+    """
+
+    def __init__(self, *args, virtual_nodes=160, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.ring = HashRing([host_name(host) for host in self.hosts], virtual_nodes)
+
+    def consistent_hash(self, value):
+        return self.ring.get_index(value)
@@ -0,0 +1,42 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from chat_app.archive import archive_room
+from chat_app.conf import chat_settings
+from chat_app.models import Message
+
+
+class Command(BaseCommand):
+    help = "Move old messages out of the message table into archive batches"
+
+    def add_arguments(self, parser):
+        config = chat_settings("CHAT_ARCHIVE")
+        parser.add_argument("--older-than-days", type=int, default=config["AFTER_DAYS"])
+        parser.add_argument("--batch-size", type=int, default=config["BATCH_SIZE"])
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Only count the messages that would be archived",
+        )
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=options["older_than_days"])
+        old = Message.objects.filter(timestamp__lt=cutoff)
+        room_ids = list(old.values_list("room_id", flat=True).distinct().order_by("room_id"))
+
+        if options["dry_run"]:
+            self.stdout.write(
+                f"{old.count()} messages in {len(room_ids)} rooms are older than {cutoff:%Y-%m-%d}"
+            )
+            return
+
+        total = 0
+        for room_id in room_ids:
+            archived = archive_room(room_id, cutoff, options["batch_size"])
+            total += archived
+            self.stdout.write(f"Room {room_id}: archived {archived} messages")
+        self.stdout.write(
+            self.style.SUCCESS(f"Archived {total} messages from {len(room_ids)} rooms")
+        )
@@ -0,0 +1,197 @@
+import asyncio
+import json
+import time
+
+from channels.db import database_sync_to_async
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+
+from chat_app import sequence
+from chat_app.consumers import ChatConsumer
+from chat_app.management.commands.loadtest import QueryCounter
+from chat_app.models import ChatRoom, Message, ReadState
+from core.models import User
+
+
+class ThreadedConsumer(ChatConsumer):
+    """The consumer data access before it moved to the async ORM
+
+    Every operation is one database_sync_to_async hop, and a message
+    loads its room and sender before inserting it.
+    """
+
+    @database_sync_to_async
+    def mark_read(self, message_id):
+        return ReadState.advance(self.user.id, self.room_id, message_id)
+
+    @database_sync_to_async
+    def save_message(self, content, sender_id):
+        room = ChatRoom.objects.get(id=self.room_id)
+        sender = User.objects.get(id=sender_id)
+        return Message.objects.create(room=room, sender=sender, content=content)
+
+
+PATHS = {"thread": ThreadedConsumer, "async": ChatConsumer}
+
+
+def create_fixtures(senders, rooms):
+    prefix = f"benchdb-{int(time.time())}"
+    users = [
+        User.objects.create(
+            username=f"{prefix}-{i}", email=f"{prefix}-{i}@example.com", password="!"
+        )
+        for i in range(senders)
+    ]
+    room_objs = [
+        ChatRoom.objects.create(name=f"{prefix}-{i}", created_by=users[0])
+        for i in range(rooms)
+    ]
+    for i, user in enumerate(users):
+        room_objs[i % rooms].participants.add(user)
+    return users, room_objs
+
+
+async def run_path(consumer_class, users, rooms, messages, read_every):
+    """Send ``messages`` messages from every user at once; messages/sec"""
+    consumers = []
+    for i, user in enumerate(users):
+        consumer = consumer_class()
+        consumer.user = user
+        consumer.room_id = str(rooms[i % len(rooms)].id)
+        consumers.append(consumer)
+    remaining = messages
+
+    async def sender(consumer):
+        nonlocal remaining
+        sent = 0
+        while remaining > 0:
+            remaining -= 1
+            sent += 1
+            message = await consumer.save_message(
+                "Hello everyone, this is a fairly typical chat message.", consumer.user.id
+            )
+            if read_every and sent % read_every == 0:
+                await consumer.mark_read(message.id)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(sender(consumer) for consumer in consumers))
+    return messages / (time.perf_counter() - start)
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare consumer database throughput (messages/sec per worker) of "
+        "the async ORM paths against database_sync_to_async"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--messages", type=int, default=2000)
+        parser.add_argument(
+            "--concurrency",
+            default="1,10,50",
+            help="Comma separated numbers of sockets sending at once",
+        )
+        parser.add_argument("--rooms", type=int, default=10)
+        parser.add_argument(
+            "--read-every",
+            type=int,
+            default=5,
+            help="Each socket marks its room read after this many messages, 0 never",
+        )
+        parser.add_argument(
+            "--paths", default="thread,async", help="Comma separated: thread, async"
+        )
+        parser.add_argument(
+            "--sequence",
+            choices=["local", "configured"],
+            default="local",
+            help="In-process sequence numbers, or the configured (Redis) backend",
+        )
+        parser.add_argument(
+            "--current-db",
+            action="store_true",
+            help="Use the configured database instead of a throwaway test database",
+        )
+        parser.add_argument("--json", action="store_true", help="Print JSON results")
+
+    def handle(self, *args, **options):
+        try:
+            levels = [int(level) for level in options["concurrency"].split(",")]
+        except ValueError:
+            raise CommandError("--concurrency takes comma separated numbers")
+        paths = options["paths"].split(",")
+        unknown = set(paths) - set(PATHS)
+        if unknown:
+            raise CommandError(f"Unknown paths: {', '.join(sorted(unknown))}")
+        if min(levels) < 1 or options["rooms"] < 1:
+            raise CommandError("Need at least one socket and one room")
+
+        old_name = None
+        if not options["current_db"]:
+            old_name = connection.settings_dict["NAME"]
+            connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        sequences = (
+            {"CHAT_SEQUENCE": {"BACKEND": "local"}}
+            if options["sequence"] == "local"
+            else {}
+        )
+        try:
+            with override_settings(**sequences):
+                sequence._sequences = None
+                results = self.run(options, levels, paths)
+        finally:
+            sequence._sequences = None
+            if old_name is not None:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        if options["json"]:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+        self.stdout.write(
+            f"{options['messages']} messages per run, {connection.vendor}, "
+            f"one read per {options['read_every'] or 'no'} messages"
+        )
+        self.stdout.write(f"{'sockets':>8} {'path':>8} {'msg/s':>10} {'queries':>8}")
+        for row in results:
+            self.stdout.write(
+                f"{row['concurrency']:>8} {row['path']:>8} "
+                f"{row['messages_per_second']:>10} {row['queries_per_message']:>8}"
+            )
+
+    def run(self, options, levels, paths):
+        users, rooms = create_fixtures(max(levels), options["rooms"])
+        results = []
+        # One counter for every run: the executor thread's connection
+        # outlives each run and is only seen by a counter installed before
+        # it was opened
+        try:
+            with QueryCounter() as queries:
+                for level in levels:
+                    for path in paths:
+                        before = queries.count
+                        rate = asyncio.run(
+                            run_path(
+                                PATHS[path],
+                                users[:level],
+                                rooms,
+                                options["messages"],
+                                options["read_every"],
+                            )
+                        )
+                        results.append(
+                            {
+                                "concurrency": level,
+                                "path": path,
+                                "messages_per_second": round(rate, 1),
+                                "queries_per_message": round(
+                                    (queries.count - before) / options["messages"], 2
+                                ),
+                            }
+                        )
+        finally:
+            if options["current_db"]:
+                Message.objects.filter(room__in=rooms).delete()
+                ChatRoom.objects.filter(id__in=[room.id for room in rooms]).delete()
+                User.objects.filter(id__in=[user.id for user in users]).delete()
+        return results
@@ -0,0 +1,148 @@
+import asyncio
+import json
+import multiprocessing
+import random
+import time
+from contextlib import nullcontext
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chat_app.layers import ShardedRedisChannelLayer
+from chat_app.protocol import new_event
+from chat_app.redis_shards import local_redis_shards
+
+
+def make_layer(hosts, capacity):
+    return ShardedRedisChannelLayer(hosts=hosts, capacity=capacity, expiry=600)
+
+
+async def populate(hosts, groups, members, workers, capacity):
+    """Join ``members`` channels to each room group, spread over workers"""
+    layers = [make_layer(hosts, capacity) for _ in range(workers)]
+    for room_id in range(groups):
+        for _ in range(members):
+            layer = random.choice(layers)
+            channel = await layer.new_channel()
+            await layer.group_add(f"chat_{room_id}", channel)
+    for layer in layers:
+        await layer.close_pools()
+
+
+async def send_messages(hosts, groups, messages, concurrency, capacity):
+    layer = make_layer(hosts, capacity)
+    remaining = messages
+
+    async def sender():
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            await layer.group_send(
+                f"chat_{random.randrange(groups)}",
+                new_event(
+                    "chat_message",
+                    message="Hello everyone, this is a fairly typical chat message.",
+                    sender_id=42,
+                    sender_username="someone",
+                    timestamp="2025-01-01T12:00:00+00:00",
+                    message_id=remaining,
+                ),
+            )
+
+    await asyncio.gather(*(sender() for _ in range(concurrency)))
+    await layer.close_pools()
+
+
+def run_sender(args):
+    asyncio.run(send_messages(*args))
+
+
+async def flush(hosts, capacity):
+    layer = make_layer(hosts, capacity)
+    await layer.flush()
+
+
+class Command(BaseCommand):
+    help = "Measure channel layer group_send throughput as Redis shards are added"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--shards", default="1,2,4", help="Comma separated shard counts to compare"
+        )
+        parser.add_argument(
+            "--hosts",
+            default="",
+            help="Comma separated redis:// URLs to use instead of starting "
+            "local redis-server instances",
+        )
+        parser.add_argument("--base-port", type=int, default=6390)
+        parser.add_argument("--groups", type=int, default=500)
+        parser.add_argument("--members", type=int, default=4)
+        parser.add_argument("--workers", type=int, default=8)
+        parser.add_argument("--messages", type=int, default=10000)
+        parser.add_argument("--processes", type=int, default=4)
+        parser.add_argument("--concurrency", type=int, default=25)
+        parser.add_argument("--json", action="store_true", help="Print JSON results")
+
+    def handle(self, *args, **options):
+        counts = sorted(int(count) for count in options["shards"].split(","))
+        hosts = [host for host in options["hosts"].split(",") if host]
+        if hosts and len(hosts) < counts[-1]:
+            raise CommandError(f"{counts[-1]} shards need as many --hosts")
+
+        try:
+            shards = (
+                nullcontext(hosts)
+                if hosts
+                else local_redis_shards(counts[-1], options["base_port"])
+            )
+            with shards as urls:
+                results = [self.run_round(urls[:count], options) for count in counts]
+        except RuntimeError as exc:
+            raise CommandError(str(exc))
+
+        if options["json"]:
+            self.stdout.write(json.dumps({"results": results}))
+            return
+
+        self.stdout.write(
+            f"{options['messages']} group_send to {options['groups']} groups of "
+            f"{options['members']} from {options['processes']} processes"
+        )
+        self.stdout.write(f"{'shards':>6} {'msgs/s':>10} {'deliveries/s':>13} {'seconds':>8}")
+        for r in results:
+            self.stdout.write(
+                f"{r['shards']:>6} {r['messages_per_second']:>10.0f} "
+                f"{r['deliveries_per_second']:>13.0f} {r['seconds']:>8.2f}"
+            )
+
+    def run_round(self, hosts, options):
+        # Nothing is received, so channels must hold everything that is sent
+        capacity = options["messages"] * options["members"]
+        asyncio.run(flush(hosts, capacity))
+        asyncio.run(
+            populate(
+                hosts, options["groups"], options["members"], options["workers"], capacity
+            )
+        )
+
+        processes = options["processes"]
+        per_process = options["messages"] // processes
+        jobs = [
+            (hosts, options["groups"], per_process, options["concurrency"], capacity)
+            for _ in range(processes)
+        ]
+        with multiprocessing.Pool(processes) as pool:
+            start = time.perf_counter()
+            pool.map(run_sender, jobs)
+            elapsed = time.perf_counter() - start
+
+        asyncio.run(flush(hosts, capacity))
+
+        sent = per_process * processes
+        return {
+            "shards": len(hosts),
+            "messages": sent,
+            "seconds": elapsed,
+            "messages_per_second": sent / elapsed,
+            "deliveries_per_second": sent * options["members"] / elapsed,
+        }
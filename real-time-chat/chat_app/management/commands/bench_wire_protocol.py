@@ -0,0 +1,102 @@
+import json
+import time
+
+import msgpack
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from chat_app.protocol import CBOR, JSON, MSGPACK, FrameCache, event_frame, new_event
+
+
+class Command(BaseCommand):
+    help = "Compare frame size and fan-out CPU cost of the WebSocket wire formats"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--recipients", type=int, default=5000)
+        parser.add_argument("--events", type=int, default=20)
+        parser.add_argument("--json", action="store_true", help="Print JSON results")
+
+    def handle(self, *args, **options):
+        recipients = options["recipients"]
+        events = [
+            new_event(
+                "chat_message",
+                message="Hello everyone, this is a fairly typical chat message.",
+                sender_id=42,
+                sender_username="someone",
+                timestamp=timezone.now().isoformat(),
+                message_id=1000 + i,
+            )
+            for i in range(options["events"])
+        ]
+
+        results = []
+        for codec in (JSON, MSGPACK, CBOR):
+            # Every recipient encodes its own copy (the old behaviour)
+            start = time.process_time()
+            for event in events:
+                for _ in range(recipients):
+                    codec.encode("message", event)
+            per_recipient = (time.process_time() - start) / (len(events) * recipients)
+
+            # Recipients on the worker share one encoded frame
+            cache = FrameCache()
+            start = time.process_time()
+            for event in events:
+                for _ in range(recipients):
+                    cache.encode(codec, "message", event)
+            shared = (time.process_time() - start) / (len(events) * recipients)
+
+            # The sender attached the JSON frame; binary frames come from the
+            # worker's frame cache
+            start = time.process_time()
+            for event in events:
+                for _ in range(recipients):
+                    event_frame(codec, "message", event)
+            preencoded = (time.process_time() - start) / (len(events) * recipients)
+
+            results.append(
+                {
+                    "codec": codec.name,
+                    "bytes_per_frame": len(codec.encode("message", events[0])),
+                    "us_per_recipient_encode_each": per_recipient * 1e6,
+                    "us_per_recipient_shared": shared * 1e6,
+                    "ms_per_fanout_encode_each": per_recipient * recipients * 1e3,
+                    "ms_per_fanout_shared": shared * recipients * 1e3,
+                    "us_per_recipient_preencoded": preencoded * 1e6,
+                    "ms_per_fanout_preencoded": preencoded * recipients * 1e3,
+                }
+            )
+
+        # What the channel layer stores and ships per group event
+        event_bytes = len(msgpack.packb(events[0]))
+
+        if options["json"]:
+            self.stdout.write(
+                json.dumps(
+                    {
+                        "recipients": recipients,
+                        "event_bytes": event_bytes,
+                        "results": results,
+                    }
+                )
+            )
+            return
+
+        self.stdout.write(
+            f"Fan-out to {recipients} recipients per message, "
+            f"{event_bytes} bytes per channel layer event\n"
+        )
+        self.stdout.write(
+            f"{'codec':<8} {'bytes':>6} {'us/recip each':>14} {'us/recip shared':>16} "
+            f"{'ms/fanout each':>15} {'ms/fanout shared':>17} {'ms/fanout pre':>14}"
+        )
+        for r in results:
+            self.stdout.write(
+                f"{r['codec']:<8} {r['bytes_per_frame']:>6} "
+                f"{r['us_per_recipient_encode_each']:>14.2f} "
+                f"{r['us_per_recipient_shared']:>16.2f} "
+                f"{r['ms_per_fanout_encode_each']:>15.2f} "
+                f"{r['ms_per_fanout_shared']:>17.2f} "
+                f"{r['ms_per_fanout_preencoded']:>14.2f}"
+            )
@@ -0,0 +1,187 @@
+import asyncio
+import json
+import time
+
+from channels.auth import AuthMiddlewareStack
+from channels.generic.websocket import AsyncWebsocketConsumer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.urls import re_path
+
+from chat_app.cache import users as user_cache
+from chat_app.management.commands.loadtest import (
+    QueryCounter,
+    create_fixtures,
+    latency_summary,
+)
+from chat_app.models import ChatRoom
+from chat_app.ws_auth import WebSocketAuthMiddlewareStack, issue_ticket
+from core.models import User
+
+
+class HandshakeConsumer(AsyncWebsocketConsumer):
+    """Accepts authenticated sockets and nothing else, like the chat consumers"""
+
+    async def connect(self):
+        if self.scope["user"].is_authenticated:
+            await self.accept()
+        else:
+            await self.close()
+
+
+def application(stack):
+    return stack(URLRouter([re_path(r"ws/online/$", HandshakeConsumer.as_asgi())]))
+
+
+# mode -> (application, uses the ticket instead of the session cookie)
+MODES = {
+    # channels.auth: a session read and a user query per handshake
+    "session": (application(AuthMiddlewareStack), False),
+    # The session read, users cached per worker
+    "cached": (application(WebSocketAuthMiddlewareStack), False),
+    # Signed ticket checked against the cached user, no session read
+    "ticket": (application(WebSocketAuthMiddlewareStack), True),
+}
+
+
+async def run_mode(mode, cookies, tickets, connections, concurrency):
+    """Open and close ``connections`` sockets, ``concurrency`` at a time"""
+    app, use_ticket = MODES[mode]
+    remaining = connections
+    latencies = []
+    failed = 0
+
+    async def client(i):
+        nonlocal remaining, failed
+        while remaining > 0:
+            remaining -= 1
+            user = remaining % len(cookies)
+            if use_ticket:
+                communicator = WebsocketCommunicator(
+                    app, f"/ws/online/?ticket={tickets[user]}"
+                )
+            else:
+                communicator = WebsocketCommunicator(
+                    app, "/ws/online/", headers=[(b"cookie", cookies[user])]
+                )
+            start = time.perf_counter()
+            connected, _ = await communicator.connect(timeout=30)
+            latencies.append(time.perf_counter() - start)
+            if connected:
+                await communicator.disconnect()
+            else:
+                failed += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client(i) for i in range(concurrency)))
+    return connections / (time.perf_counter() - start), latencies, failed
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare WebSocket handshake cost (handshakes/sec, queries per "
+        "handshake) of session auth, cached users and signed tickets"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--connections", type=int, default=1000)
+        parser.add_argument(
+            "--concurrency",
+            default="1,50",
+            help="Comma separated numbers of handshakes in flight at once",
+        )
+        parser.add_argument(
+            "--users",
+            type=int,
+            default=200,
+            help="Distinct users; handshakes cycle through them",
+        )
+        parser.add_argument(
+            "--modes",
+            default="session,cached,ticket",
+            help="Comma separated: session, cached, ticket",
+        )
+        parser.add_argument(
+            "--current-db",
+            action="store_true",
+            help="Use the configured database instead of a throwaway test database",
+        )
+        parser.add_argument("--json", action="store_true", help="Print JSON results")
+
+    def handle(self, *args, **options):
+        try:
+            levels = [int(level) for level in options["concurrency"].split(",")]
+        except ValueError:
+            raise CommandError("--concurrency takes comma separated numbers")
+        modes = options["modes"].split(",")
+        unknown = set(modes) - set(MODES)
+        if unknown:
+            raise CommandError(f"Unknown modes: {', '.join(sorted(unknown))}")
+        if min(levels) < 1 or options["users"] < 1:
+            raise CommandError("Need at least one user and one handshake at a time")
+
+        old_name = None
+        if not options["current_db"]:
+            old_name = connection.settings_dict["NAME"]
+            connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            results = self.run(options, levels, modes)
+        finally:
+            if old_name is not None:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        if options["json"]:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+        self.stdout.write(
+            f"{options['connections']} handshakes per run, {options['users']} users, "
+            f"{connection.vendor}"
+        )
+        self.stdout.write(
+            f"{'in flight':>9} {'mode':>8} {'hs/s':>9} {'queries':>8} "
+            f"{'p50 ms':>8} {'p99 ms':>8} {'failed':>7}"
+        )
+        for row in results:
+            self.stdout.write(
+                f"{row['concurrency']:>9} {row['mode']:>8} "
+                f"{row['handshakes_per_second']:>9} {row['queries_per_handshake']:>8} "
+                f"{row['latency']['p50_ms']:>8} {row['latency']['p99_ms']:>8} "
+                f"{row['failed']:>7}"
+            )
+
+    def run(self, options, levels, modes):
+        users, rooms, cookies = create_fixtures(options["users"], 1)
+        tickets = [issue_ticket(user) for user in users]
+        results = []
+        # One counter for every run, see bench_consumer_db
+        try:
+            with QueryCounter() as queries:
+                for level in levels:
+                    for mode in modes:
+                        # Every run starts with cold user caches
+                        user_cache.clear()
+                        before = queries.count
+                        rate, latencies, failed = asyncio.run(
+                            run_mode(
+                                mode, cookies, tickets, options["connections"], level
+                            )
+                        )
+                        results.append(
+                            {
+                                "concurrency": level,
+                                "mode": mode,
+                                "handshakes_per_second": round(rate, 1),
+                                "queries_per_handshake": round(
+                                    (queries.count - before) / options["connections"], 2
+                                ),
+                                "latency": latency_summary(latencies),
+                                "failed": failed,
+                            }
+                        )
+        finally:
+            if options["current_db"]:
+                ChatRoom.objects.filter(id__in=[room.id for room in rooms]).delete()
+                User.objects.filter(id__in=[user.id for user in users]).delete()
+        return results
@@ -0,0 +1,416 @@
+import asyncio
+import json
+import random
+import statistics
+import threading
+import time
+import tracemalloc
+from contextlib import nullcontext
+
+from channels.testing import HttpCommunicator, WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.db.backends.signals import connection_created
+from django.test.utils import override_settings
+from django.urls import reverse
+
+from chat_app import admission, cache, history, presence, sequence, unread
+from chat_app.models import ChatRoom, Message
+from core.models import User
+
+# Settings for --layer memory: nothing outside this process is needed
+MEMORY_SETTINGS = {
+    "CHANNEL_LAYERS": {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}},
+    "CHAT_ADMISSION": {"BACKEND": "local"},
+    "CHAT_CACHE": {"BACKEND": "local"},
+    "CHAT_PRESENCE": {"BACKEND": "local"},
+    "CHAT_HISTORY": {"BACKEND": "local"},
+    "CHAT_SEQUENCE": {"BACKEND": "local"},
+    "CHAT_UNREAD": {"BACKEND": "local"},
+}
+
+
+class QueryCounter:
+    """Counts the queries of every database connection, in any thread
+
+    Consumers and views run their queries in executor threads, which
+    CaptureQueriesContext on the main thread would not see.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, execute, sql, params, many, context):
+        with self._lock:
+            self.count += 1
+        return execute(sql, params, many, context)
+
+    def install(self, connection, **kwargs):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+    def __enter__(self):
+        connection_created.connect(self.install)
+        for conn in connections.all():
+            self.install(conn)
+        return self
+
+    def __exit__(self, *exc):
+        connection_created.disconnect(self.install)
+        for conn in connections.all():
+            if self in conn.execute_wrappers:
+                conn.execute_wrappers.remove(self)
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def latency_summary(seconds):
+    return {
+        "p50_ms": _ms(percentile(seconds, 0.50)),
+        "p99_ms": _ms(percentile(seconds, 0.99)),
+        "max_ms": _ms(max(seconds)) if seconds else None,
+        "mean_ms": _ms(statistics.fmean(seconds)) if seconds else None,
+    }
+
+
+def _ms(value):
+    return None if value is None else round(value * 1000, 3)
+
+
+def create_fixtures(clients, rooms):
+    """Users with sessions, spread round robin over public rooms"""
+    prefix = f"loadtest-{int(time.time())}"
+    users = User.objects.bulk_create(
+        [
+            User(
+                username=f"{prefix}-{i}",
+                email=f"{prefix}-{i}@example.com",
+                password="!",
+            )
+            for i in range(clients)
+        ]
+    )
+    if not users or users[0].pk is None:
+        # Backends without RETURNING on bulk inserts
+        users = list(User.objects.filter(username__startswith=f"{prefix}-").order_by("id"))
+
+    room_objs = [
+        ChatRoom.objects.create(name=f"{prefix}-{i}", created_by=users[0])
+        for i in range(rooms)
+    ]
+    through = ChatRoom.participants.through
+    through.objects.bulk_create(
+        [
+            through(chatroom_id=room_objs[i % rooms].id, user_id=user.id)
+            for i, user in enumerate(users)
+        ]
+    )
+
+    cookies = []
+    for user in users:
+        session = SessionStore()
+        session[SESSION_KEY] = str(user.pk)
+        session[BACKEND_SESSION_KEY] = "django.contrib.auth.backends.ModelBackend"
+        session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+        session.create()
+        cookies.append(f"{settings.SESSION_COOKIE_NAME}={session.session_key}".encode())
+    return users, room_objs, cookies
+
+
+class Client:
+    """One simulated browser tab connected to a room socket"""
+
+    def __init__(self, application, user, room, cookie):
+        self.user = user
+        self.room = room
+        self.communicator = WebsocketCommunicator(
+            application, f"/ws/chat/{room.id}/", headers=[(b"cookie", cookie)]
+        )
+        self.received = {}
+
+    async def connect(self):
+        connected, _ = await self.communicator.connect(timeout=30)
+        return connected
+
+    async def read(self, expected, timeout):
+        """Record when each load test message arrives until all did"""
+        while len(self.received) < expected:
+            try:
+                frame = await self.communicator.receive_json_from(timeout=timeout)
+            except asyncio.TimeoutError:
+                return
+            if frame.get("type") == "message" and frame["message"].startswith("lt "):
+                self.received[int(frame["message"][3:])] = time.perf_counter()
+
+    async def send(self, seq):
+        await self.communicator.send_json_to(
+            {"type": "message", "message": f"lt {seq}", "sender_id": self.user.id}
+        )
+
+
+async def run_websockets(application, users, rooms, cookies, options, queries):
+    clients = [
+        Client(application, user, rooms[i % len(rooms)], cookie)
+        for i, (user, cookie) in enumerate(zip(users, cookies))
+    ]
+
+    # Connect in waves so the handshake queue stays bounded
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    queries_before = queries.count
+    start = time.perf_counter()
+    connected = []
+    wave = options["connect_concurrency"]
+    for offset in range(0, len(clients), wave):
+        batch = clients[offset : offset + wave]
+        results = await asyncio.gather(*(client.connect() for client in batch))
+        connected.extend(client for client, ok in zip(batch, results) if ok)
+    connect_seconds = time.perf_counter() - start
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    connect_queries = queries.count - queries_before
+
+    if not connected:
+        raise CommandError("No socket could connect")
+
+    # Drain the history and join frames so they do not count as latency
+    await asyncio.sleep(options["settle"])
+    for client in connected:
+        while not await client.communicator.receive_nothing(timeout=0.01):
+            await client.communicator.receive_output()
+
+    plan = [random.choice(connected) for _ in range(options["messages"])]
+    expected = {}
+    for sender in plan:
+        expected[sender.room.id] = expected.get(sender.room.id, 0) + 1
+
+    readers = [
+        asyncio.create_task(client.read(expected.get(client.room.id, 0), options["timeout"]))
+        for client in connected
+    ]
+
+    sent_at = {}
+    interval = 1 / options["rate"] if options["rate"] else 0
+    queries_before = queries.count
+    start = time.perf_counter()
+    for seq, sender in enumerate(plan):
+        sent_at[seq] = time.perf_counter()
+        await sender.send(seq)
+        if interval:
+            # Open loop: keep the rate whatever the latency
+            delay = start + (seq + 1) * interval - time.perf_counter()
+            await asyncio.sleep(max(delay, 0))
+    send_seconds = time.perf_counter() - start
+    await asyncio.gather(*readers)
+    total_seconds = time.perf_counter() - start
+    await asyncio.sleep(options["settle"])
+    send_queries = queries.count - queries_before
+
+    latencies = []
+    for client in connected:
+        latencies.extend(at - sent_at[seq] for seq, at in client.received.items())
+    deliveries_expected = sum(expected.get(client.room.id, 0) for client in connected)
+
+    for offset in range(0, len(connected), wave):
+        # Sockets whose reader timed out were already torn down
+        await asyncio.gather(
+            *(client.communicator.disconnect() for client in connected[offset : offset + wave]),
+            return_exceptions=True,
+        )
+
+    return {
+        "clients": len(clients),
+        "connected": len(connected),
+        "rooms": len(rooms),
+        "connect_seconds": round(connect_seconds, 3),
+        "connects_per_second": round(len(connected) / connect_seconds, 1),
+        "queries_per_connect": round(connect_queries / len(clients), 2),
+        "memory_per_connection_bytes": round((after - before) / len(connected)),
+        "messages": len(plan),
+        "send_seconds": round(send_seconds, 3),
+        "messages_per_second": round(len(plan) / total_seconds, 1),
+        "deliveries": len(latencies),
+        "deliveries_lost": deliveries_expected - len(latencies),
+        "deliveries_per_second": round(len(latencies) / total_seconds, 1),
+        "queries_per_message": round(send_queries / len(plan), 2) if plan else None,
+        "latency": latency_summary(latencies),
+    }
+
+
+async def run_http(application, rooms, cookie, options, queries):
+    room_id = rooms[0].id
+    paths = {
+        "chat_home": reverse("chat-home"),
+        "chat_room": reverse("chat-room", args=[room_id]),
+        "messages_first_page": reverse("get-messages", args=[room_id]) + "?cursor=",
+        "search": reverse("search-messages") + "?q=lt",
+        "online_users": reverse("online-users"),
+    }
+    host = (settings.ALLOWED_HOSTS or ["localhost"])[0].lstrip(".").encode()
+    headers = [(b"cookie", cookie), (b"host", host)]
+
+    results = {}
+    for name, path in paths.items():
+        durations = []
+        statuses = set()
+        queries_before = queries.count
+        start = time.perf_counter()
+        for _ in range(options["http_requests"]):
+            communicator = HttpCommunicator(application, "GET", path, headers=headers)
+            began = time.perf_counter()
+            response = await communicator.get_response(timeout=30)
+            durations.append(time.perf_counter() - began)
+            # Let Django's handler finish instead of leaving it pending
+            await communicator.send_input({"type": "http.disconnect"})
+            await communicator.wait(timeout=30)
+            statuses.add(response["status"])
+        elapsed = time.perf_counter() - start
+        requests = options["http_requests"]
+        results[name] = {
+            "path": path,
+            "status": sorted(statuses),
+            "requests_per_second": round(requests / elapsed, 1),
+            "queries_per_request": round((queries.count - queries_before) / requests, 2),
+            "latency": latency_summary(durations),
+        }
+    return results
+
+
+class Command(BaseCommand):
+    help = (
+        "Load test the ASGI application: room socket fan-out and the main HTTP "
+        "views, with latency percentiles, throughput, memory and queries"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--clients", type=int, default=1000)
+        parser.add_argument("--rooms", type=int, default=50)
+        parser.add_argument("--messages", type=int, default=2000)
+        parser.add_argument(
+            "--rate", type=float, default=500, help="Messages per second, 0 for no pacing"
+        )
+        parser.add_argument("--connect-concurrency", type=int, default=100)
+        parser.add_argument("--http-requests", type=int, default=200)
+        parser.add_argument(
+            "--layer",
+            choices=["memory", "redis"],
+            default="memory",
+            help="In-memory channel layer and presence/history backends, or "
+            "the configured (Redis) ones",
+        )
+        parser.add_argument(
+            "--timeout", type=float, default=10, help="Seconds to wait for a delivery"
+        )
+        parser.add_argument("--settle", type=float, default=0.5)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument(
+            "--current-db",
+            action="store_true",
+            help="Use the configured database instead of a throwaway test database",
+        )
+        parser.add_argument("--json", action="store_true", help="Print JSON results")
+        parser.add_argument("--output", help="Also write the JSON results to this file")
+
+    def handle(self, *args, **options):
+        if options["clients"] < 1 or options["rooms"] < 1:
+            raise CommandError("Need at least one client and one room")
+        random.seed(options["seed"])
+
+        old_name = None
+        if not options["current_db"]:
+            old_name = connection.settings_dict["NAME"]
+            connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        layer = (
+            override_settings(**MEMORY_SETTINGS)
+            if options["layer"] == "memory"
+            else nullcontext()
+        )
+        try:
+            with layer:
+                results = self.run(options)
+        finally:
+            if old_name is not None:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        report = json.dumps(results, indent=2)
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                f.write(report + "\n")
+        if options["json"]:
+            self.stdout.write(report)
+        else:
+            self.print_results(results)
+
+    def run(self, options):
+        # Backends are created on first use, after the settings above apply
+        admission._rate_limiter = None
+        cache._invalidation = None
+        history._buffer = None
+        presence._presence = None
+        sequence._sequences = None
+        unread._unread = None
+
+        # Imported here so the channel layer settings are already in place
+        from chat.asgi import application
+
+        users, rooms, cookies = create_fixtures(options["clients"], options["rooms"])
+        with QueryCounter() as queries:
+            websockets = asyncio.run(
+                run_websockets(application, users, rooms, cookies, options, queries)
+            )
+            http = asyncio.run(run_http(application, rooms, cookies[0], options, queries))
+
+        if options["current_db"]:
+            Message.objects.filter(room__in=rooms).delete()
+            ChatRoom.objects.filter(id__in=[room.id for room in rooms]).delete()
+            User.objects.filter(id__in=[user.id for user in users]).delete()
+
+        admission._rate_limiter = None
+        cache._invalidation = None
+        history._buffer = None
+        presence._presence = None
+        sequence._sequences = None
+        unread._unread = None
+        return {
+            "settings": {
+                key: options[key]
+                for key in ("clients", "rooms", "messages", "rate", "layer", "seed")
+            },
+            "database": connection.vendor,
+            "websocket": websockets,
+            "http": http,
+        }
+
+    def print_results(self, results):
+        ws = results["websocket"]
+        latency = ws["latency"]
+        self.stdout.write(
+            f"{ws['connected']}/{ws['clients']} sockets in {ws['rooms']} rooms "
+            f"({results['settings']['layer']} layer, {results['database']})\n"
+            f"  connect: {ws['connects_per_second']} /s, "
+            f"{ws['queries_per_connect']} queries, "
+            f"{ws['memory_per_connection_bytes'] / 1024:.1f} KiB per connection\n"
+            f"  messages: {ws['messages_per_second']} /s, "
+            f"{ws['deliveries_per_second']} deliveries/s, "
+            f"{ws['queries_per_message']} queries per message, "
+            f"{ws['deliveries_lost']} lost\n"
+            f"  latency: p50 {latency['p50_ms']} ms, p99 {latency['p99_ms']} ms, "
+            f"max {latency['max_ms']} ms\n"
+        )
+        self.stdout.write(
+            f"{'view':<22} {'req/s':>8} {'queries':>8} {'p50 ms':>8} {'p99 ms':>8}"
+        )
+        for name, r in results["http"].items():
+            self.stdout.write(
+                f"{name:<22} {r['requests_per_second']:>8} {r['queries_per_request']:>8} "
+                f"{r['latency']['p50_ms']:>8} {r['latency']['p99_ms']:>8}"
+            )
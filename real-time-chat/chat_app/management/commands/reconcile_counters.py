@@ -0,0 +1,54 @@
+from django.core.management.base import BaseCommand
+
+from chat_app.counters import archived_counts_by_sender, reconcile_rooms, reconcile_users
+from chat_app.models import ChatRoom
+from core.models import User
+
+
+def id_batches(queryset, size):
+    last = 0
+    while True:
+        ids = list(
+            queryset.filter(id__gt=last).order_by("id").values_list("id", flat=True)[:size]
+        )
+        if not ids:
+            return
+        yield ids
+        last = ids[-1]
+
+
+class Command(BaseCommand):
+    help = "Recount the denormalized room and user counters and fix any drift"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=500,
+            help="Rows locked and recounted per transaction",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Only report the rows whose counters are off",
+        )
+
+    def handle(self, *args, **options):
+        size, dry_run = options["batch_size"], options["dry_run"]
+        verb = "would fix" if dry_run else "fixed"
+
+        rooms = checked = 0
+        for ids in id_batches(ChatRoom.objects.all(), size):
+            checked += len(ids)
+            rooms += len(reconcile_rooms(ids, dry_run))
+        self.stdout.write(f"Rooms: checked {checked}, {verb} {rooms}")
+
+        archived = archived_counts_by_sender()
+        users = checked = 0
+        for ids in id_batches(User.objects.all(), size):
+            checked += len(ids)
+            users += len(reconcile_users(ids, archived, dry_run))
+        self.stdout.write(f"Users: checked {checked}, {verb} {users}")
+
+        if not dry_run:
+            self.stdout.write(self.style.SUCCESS("Counters reconciled"))
@@ -0,0 +1,28 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chat_app.redis_shards import local_redis_shards
+
+
+class Command(BaseCommand):
+    help = "Run several local Redis instances to use as channel layer shards"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--shards", type=int, default=3)
+        parser.add_argument("--base-port", type=int, default=6390)
+
+    def handle(self, *args, **options):
+        try:
+            with local_redis_shards(options["shards"], options["base_port"]) as urls:
+                self.stdout.write(
+                    "Shards are up. Start every daphne/runserver process with\n\n"
+                    f"    export CHAT_CHANNEL_HOSTS={','.join(urls)}\n\n"
+                    "Press Ctrl+C to stop them."
+                )
+                while True:
+                    time.sleep(3600)
+        except RuntimeError as exc:
+            raise CommandError(str(exc))
+        except KeyboardInterrupt:
+            self.stdout.write("Stopping shards")
@@ -0,0 +1,256 @@
+# chat_app/metrics.py
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+
+from django.db import connection
+from django.db.backends.signals import connection_created
+
+from .conf import WORKER_ID, chat_settings
+
+# Checked on every observation; with metrics off an instrumented call costs
+# one global lookup and nothing is recorded
+enabled = chat_settings("CHAT_METRICS")["ENABLED"]
+
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+registry = []
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names, values, extra=()):
+    pairs = [("worker", WORKER_ID), *zip(names, values), *extra]
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+class Metric:
+    """A named metric with one value per combination of label values
+
+    Values are per process: every worker serves its own and Prometheus
+    tells them apart by the ``worker`` label.
+    """
+
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for label_values, value in items:
+            lines.extend(self._samples(label_values, value))
+        return lines
+
+    def _samples(self, label_values, value):
+        return [f"{self.name}{_labels(self.label_names, label_values)} {value}"]
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, *labels, amount=1):
+        if not enabled:
+            return
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def inc(self, *labels, amount=1):
+        if not enabled:
+            return
+        with self._lock:
+            value = self._values.get(labels, 0) + amount
+            if value:
+                self._values[labels] = value
+            else:
+                # Drop label sets that went back to zero, e.g. empty rooms
+                self._values.pop(labels, None)
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def set(self, value, *labels):
+        if not enabled:
+            return
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=SECONDS_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        if not enabled:
+            return
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                # Per bucket counts (the last is +Inf), sum, count
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def time(self, *labels):
+        """Context manager observing the seconds its block takes"""
+        if not enabled:
+            return _NOOP
+        return _Timer(self, labels)
+
+    def _samples(self, label_values, value):
+        counts, total, count = value
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip((*self.buckets, "+Inf"), counts):
+            cumulative += bucket_count
+            labels = _labels(self.label_names, label_values, [("le", bound)])
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _labels(self.label_names, label_values)
+        lines.append(f"{self.name}_sum{labels} {total}")
+        lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+
+
+class _Noop:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NOOP = _Noop()
+
+
+# The QueryCounter of the running block; context variables follow awaits
+# into sync_to_async threads, so async ORM calls are counted too
+_query_counter = ContextVar("query_counter", default=None)
+
+
+def _count_query(execute, sql, params, many, context):
+    counter = _query_counter.get()
+    if counter is not None:
+        counter.count += 1
+    return execute(sql, params, many, context)
+
+
+def _install(sender=None, connection=connection, **kwargs):
+    if _count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_count_query)
+
+
+connection_created.connect(_install)
+
+
+class QueryCounter:
+    """Counts the queries run inside the block, on whichever thread they run"""
+
+    def __init__(self):
+        self.count = 0
+        self._token = None
+
+    def __enter__(self):
+        if enabled:
+            _install()
+            self._token = _query_counter.set(self)
+        return self
+
+    def __exit__(self, *exc):
+        if self._token is not None:
+            _query_counter.reset(self._token)
+            self._token = None
+
+
+def render():
+    """All metrics in the Prometheus text exposition format"""
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# Sockets and HTTP
+ws_connections = Gauge(
+    "chat_ws_connections", "Open WebSocket connections of this worker", ["consumer"]
+)
+room_connections = Gauge(
+    "chat_room_connections", "Open room sockets of this worker per room", ["room"]
+)
+http_request_seconds = Histogram(
+    "chat_http_request_seconds", "Time to respond to a request", ["view", "method", "status"]
+)
+http_request_queries = Histogram(
+    "chat_http_request_queries", "Database queries per request", ["view"], QUERY_BUCKETS
+)
+
+# Consumer hot paths
+consumer_seconds = Histogram(
+    "chat_consumer_seconds", "Time spent in consumer operations", ["operation"]
+)
+group_send_seconds = Histogram(
+    "chat_group_send_seconds", "Channel layer group_send latency", ["event"]
+)
+write_behind_depth = Gauge(
+    "chat_write_behind_depth", "Messages waiting for the write-behind flush"
+)
+outbound_coalesced = Counter(
+    "chat_outbound_coalesced_total",
+    "Queued frames replaced by a newer frame of the same state",
+    ["frame"],
+)
+outbound_dropped = Counter(
+    "chat_outbound_dropped_total", "Frames dropped for sockets that fell behind", ["frame"]
+)
+outbound_resyncs = Counter(
+    "chat_outbound_resyncs_total", "Sockets told to fetch the messages they missed"
+)
+slow_consumer_closes = Counter(
+    "chat_slow_consumer_closes_total", "Sockets closed for not reading their frames"
+)
+messages_total = Counter("chat_messages_total", "Chat messages received by this worker")
+messages_throttled = Counter(
+    "chat_messages_throttled_total", "Chat messages rejected by the rate limit"
+)
+ws_rejected = Counter(
+    "chat_ws_rejected_total", "Sockets rejected at connect", ["reason"]
+)
+message_queries = Histogram(
+    "chat_message_queries", "Database queries to store a message", buckets=QUERY_BUCKETS
+)
@@ -0,0 +1,30 @@
+# chat_app/middleware.py
+import time
+
+from . import metrics
+
+
+class MetricsMiddleware:
+    """Times every request and counts its queries, by URL name
+
+    Does nothing but call the next handler while metrics are disabled.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not metrics.enabled:
+            return self.get_response(request)
+
+        start = time.perf_counter()
+        with metrics.QueryCounter() as queries:
+            response = self.get_response(request)
+        match = request.resolver_match
+        # URL names, not paths, keep the label set bounded
+        view = match.view_name if match else "unmatched"
+        metrics.http_request_seconds.observe(
+            time.perf_counter() - start, view, request.method, response.status_code
+        )
+        metrics.http_request_queries.observe(queries.count, view)
+        return response
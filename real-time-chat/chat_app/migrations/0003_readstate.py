@@ -0,0 +1,54 @@
+# Generated by Django 5.2.9 on 2026-10-16 23:52
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def read_by_to_watermarks(apps, schema_editor):
+    """Seed each user's watermark with the newest message they marked read"""
+    Message = apps.get_model("chat_app", "Message")
+    ReadState = apps.get_model("chat_app", "ReadState")
+
+    latest = (
+        Message.read_by.through.objects.values("user_id", "message__room_id")
+        .annotate(last_read=Max("message_id"))
+        .iterator()
+    )
+    ReadState.objects.bulk_create(
+        (
+            ReadState(
+                user_id=row["user_id"],
+                room_id=row["message__room_id"],
+                last_read_message_id=row["last_read"],
+            )
+            for row in latest
+        ),
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat_app', '0002_message_timestamp_default'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReadState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_read_message_id', models.BigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_states', to='chat_app.chatroom')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_states', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('user', 'room')},
+            },
+        ),
+        migrations.RunPython(read_by_to_watermarks, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,45 @@
+from django.db import migrations
+
+# A stored generated column keeps the vector in step with content on every
+# insert and update, and the GIN index is maintained incrementally (new
+# entries go through its pending list), so nothing has to be rebuilt.
+ADD_SEARCH_VECTOR = [
+    """
+    ALTER TABLE chat_app_message
+    ADD COLUMN search_vector tsvector
+    GENERATED ALWAYS AS (to_tsvector('english'::regconfig, content)) STORED
+    """,
+    """
+    CREATE INDEX chat_app_message_search_vector_gin
+    ON chat_app_message USING GIN (search_vector)
+    """,
+]
+
+REMOVE_SEARCH_VECTOR = [
+    "DROP INDEX IF EXISTS chat_app_message_search_vector_gin",
+    "ALTER TABLE chat_app_message DROP COLUMN IF EXISTS search_vector",
+]
+
+
+def add_search_vector(apps, schema_editor):
+    # Other databases search with a plain LIKE, see views.search_messages
+    if schema_editor.connection.vendor == "postgresql":
+        for statement in ADD_SEARCH_VECTOR:
+            schema_editor.execute(statement)
+
+
+def remove_search_vector(apps, schema_editor):
+    if schema_editor.connection.vendor == "postgresql":
+        for statement in REMOVE_SEARCH_VECTOR:
+            schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chat_app", "0003_readstate"),
+    ]
+
+    operations = [
+        migrations.RunPython(add_search_vector, remove_search_vector),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.2.9 on 2026-10-17 00:07
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat_app', '0004_message_search_vector'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedMessageBatch',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('start_at', models.DateTimeField()),
+                ('end_at', models.DateTimeField()),
+                ('min_message_id', models.BigIntegerField()),
+                ('max_message_id', models.BigIntegerField()),
+                ('message_count', models.PositiveIntegerField()),
+                ('data', models.BinaryField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_batches', to='chat_app.chatroom')),
+            ],
+            options={
+                'ordering': ['room', 'start_at'],
+                'indexes': [models.Index(fields=['room', 'end_at'], name='chat_app_ar_room_id_d59c03_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,56 @@
+from django.db import migrations, models
+
+# Existing messages are numbered per room in timestamp order
+NUMBER_MESSAGES = """
+UPDATE chat_app_message AS m
+SET seq = numbered.seq
+FROM (
+    SELECT id, row_number() OVER (PARTITION BY room_id ORDER BY timestamp, id) AS seq
+    FROM chat_app_message
+) AS numbered
+WHERE m.id = numbered.id
+"""
+
+
+def number_messages(apps, schema_editor):
+    if schema_editor.connection.vendor == "postgresql":
+        schema_editor.execute(NUMBER_MESSAGES)
+        return
+
+    Message = apps.get_model("chat_app", "Message")
+    batch = []
+    room_id, seq = None, 0
+    for message in Message.objects.order_by("room_id", "timestamp", "id").only(
+        "id", "room_id"
+    ).iterator():
+        if message.room_id != room_id:
+            room_id, seq = message.room_id, 0
+        seq += 1
+        message.seq = seq
+        batch.append(message)
+        if len(batch) == 1000:
+            Message.objects.bulk_update(batch, ["seq"])
+            batch = []
+    Message.objects.bulk_update(batch, ["seq"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chat_app", "0005_archivedmessagebatch"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="message",
+            name="seq",
+            field=models.PositiveBigIntegerField(editable=False, null=True),
+        ),
+        migrations.RunPython(number_messages, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name="message",
+            constraint=models.UniqueConstraint(
+                fields=("room", "seq"), name="unique_message_seq"
+            ),
+        ),
+    ]
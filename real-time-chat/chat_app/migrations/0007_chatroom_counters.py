@@ -0,0 +1,92 @@
+# Generated by Django 5.2.9 on 2026-10-17 00:28
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce, Substr
+
+
+def _count(queryset, group_by):
+    return Coalesce(
+        Subquery(queryset.order_by().values(group_by).annotate(n=Count("*")).values("n")),
+        0,
+    )
+
+
+def fill_counters(apps, schema_editor):
+    """Count what is already there; archived messages only count for rooms
+
+    Run reconcile_counters afterwards to include archived messages in the
+    users' counts.
+    """
+    ChatRoom = apps.get_model("chat_app", "ChatRoom")
+    Message = apps.get_model("chat_app", "Message")
+    ArchivedMessageBatch = apps.get_model("chat_app", "ArchivedMessageBatch")
+    User = apps.get_model("core", "User")
+    memberships = ChatRoom.participants.through.objects
+    newest = Message.objects.filter(room=OuterRef("pk")).order_by("-timestamp", "-id")
+    preview = newest.annotate(preview=Substr("content", 1, 100)).values("preview")[:1]
+    archived = (
+        ArchivedMessageBatch.objects.filter(room=OuterRef("pk"))
+        .order_by()
+        .values("room")
+        .annotate(n=Sum("message_count"))
+        .values("n")
+    )
+
+    ChatRoom.objects.update(
+        member_count=_count(memberships.filter(chatroom=OuterRef("pk")), "chatroom"),
+        message_count=_count(Message.objects.filter(room=OuterRef("pk")), "room")
+        + Coalesce(Subquery(archived), 0),
+        last_message_id=Subquery(newest.values("id")[:1]),
+        last_message_at=Subquery(newest.values("timestamp")[:1]),
+        last_message_preview=Coalesce(Subquery(preview), models.Value("")),
+    )
+
+    User.objects.update(
+        message_count=_count(Message.objects.filter(sender=OuterRef("pk")), "sender"),
+        room_count=_count(memberships.filter(user=OuterRef("pk")), "user"),
+        direct_room_count=_count(
+            memberships.filter(user=OuterRef("pk"), chatroom__room_type="direct"), "user"
+        ),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat_app', '0006_message_seq'),
+        ('core', '0002_user_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatroom',
+            name='last_message_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='chatroom',
+            name='last_message_id',
+            field=models.BigIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='chatroom',
+            name='last_message_preview',
+            field=models.CharField(blank=True, editable=False, max_length=100),
+        ),
+        migrations.AddField(
+            model_name='chatroom',
+            name='member_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='chatroom',
+            name='message_count',
+            field=models.PositiveBigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='chatroom',
+            index=models.Index(fields=['room_type', 'last_message_at'], name='chat_app_ch_room_ty_f7b993_idx'),
+        ),
+        migrations.RunPython(fill_counters, migrations.RunPython.noop),
+    ]
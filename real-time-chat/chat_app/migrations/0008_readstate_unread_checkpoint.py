@@ -0,0 +1,66 @@
+# Generated by Django 5.2.9 on 2026-10-17 00:34
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def fill_checkpoints(apps, schema_editor):
+    """Count every member's unread messages from the read watermarks
+
+    The unread counters start from these checkpoints; members who never
+    read a room get a ReadState at 0 so they are counted too.
+    """
+    ChatRoom = apps.get_model("chat_app", "ChatRoom")
+    Message = apps.get_model("chat_app", "Message")
+    ReadState = apps.get_model("chat_app", "ReadState")
+    last_read = ReadState.objects.filter(
+        user=OuterRef("user_id"), room=OuterRef("chatroom_id")
+    ).values("last_read_message_id")[:1]
+    unread = (
+        Message.objects.filter(room=OuterRef("chatroom_id"), id__gt=OuterRef("last_read"))
+        .exclude(sender=OuterRef("user_id"))
+        .order_by()
+        .values("room")
+        .annotate(n=Count("*"))
+        .values("n")
+    )
+    rows = (
+        ChatRoom.participants.through.objects.annotate(
+            last_read=Coalesce(Subquery(last_read), 0)
+        )
+        .annotate(unread=Coalesce(Subquery(unread), 0))
+        .filter(unread__gt=0)
+        .values_list("user_id", "chatroom_id", "last_read", "unread")
+    )
+    ReadState.objects.bulk_create(
+        [
+            ReadState(
+                user_id=user_id,
+                room_id=room_id,
+                last_read_message_id=last_read,
+                unread_checkpoint=count,
+            )
+            for user_id, room_id, last_read, count in rows.iterator()
+        ],
+        batch_size=500,
+        update_conflicts=True,
+        unique_fields=["user", "room"],
+        update_fields=["unread_checkpoint"],
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat_app', '0007_chatroom_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='readstate',
+            name='unread_checkpoint',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(fill_checkpoints, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.9 on 2026-10-17 00:38
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import F
+
+
+def order_pairs(apps, schema_editor):
+    """Store any pair saved the other way round lower id first"""
+    DirectMessage = apps.get_model("chat_app", "DirectMessage")
+    DirectMessage.objects.filter(user1__gt=F("user2")).update(
+        user1=F("user2"), user2=F("user1")
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat_app', '0008_readstate_unread_checkpoint'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RunPython(order_pairs, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='directmessage',
+            constraint=models.CheckConstraint(condition=models.Q(('user1__lt', models.F('user2'))), name='direct_message_user_order'),
+        ),
+    ]
@@ -1,7 +1,7 @@
-from django.db import models
+from django.db import IntegrityError, models, transaction
 from django.conf import settings
 from django.utils import timezone
-from django.db.models import Q
+from django.db.models import F, Q
 
 
 class ChatRoom(models.Model):
@@ -12,6 +12,8 @@ class ChatRoom(models.Model):
         ("private", "Private Room"),
         ("direct", "Direct Message"),
     )
+    # Characters of the last message shown in room listings
+    PREVIEW_LENGTH = 100
 
     name = models.CharField(max_length=100)
     description = models.TextField(blank=True, null=True)
@@ -25,22 +27,30 @@ class ChatRoom(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     is_active = models.BooleanField(default=True)
 
+    # Kept up to date by counters.py where messages are stored and members
+    # join or leave; reconcile_counters recounts them
+    member_count = models.PositiveIntegerField(default=0, editable=False)
+    message_count = models.PositiveBigIntegerField(default=0, editable=False)
+    last_message_id = models.BigIntegerField(null=True, blank=True, editable=False)
+    last_message_at = models.DateTimeField(null=True, blank=True, editable=False)
+    last_message_preview = models.CharField(
+        max_length=PREVIEW_LENGTH, blank=True, editable=False
+    )
+
     class Meta:
         ordering = ["-created_at"]
 
         indexes = [
             models.Index(fields=["room_type", "is_active"]),
             models.Index(fields=["created_at"]),
+            models.Index(fields=["room_type", "last_message_at"]),
         ]
 
     def __str__(self):
         return f"{self.name ({self.room_type})}"
 
-    def get_online_participants(self):
-        return self.participants.filter(is_online=True)
-
     def get_recent_messages(self, limit=50):
-        return self.messages.all().order_by("-created_at")[:limit]
+        return self.messages.all().order_by("-timestamp", "-id")[:limit]
 
 
 class Message(models.Model):
@@ -53,7 +63,11 @@ class Message(models.Model):
         settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="sent_messages"
     )
     content = models.TextField()
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # Not auto_now_add: write-behind persistence stamps messages on receipt
+    timestamp = models.DateTimeField(default=timezone.now)
+    # Increases by one per message of the room, in the order they were
+    # accepted; clients resume from the last one they saw (see sequence.py)
+    seq = models.PositiveBigIntegerField(null=True, editable=False)
     is_read = models.BooleanField(default=False)
     read_by = models.ManyToManyField(
         settings.AUTH_USER_MODEL, related_name="read_messages", blank=True
@@ -65,16 +79,38 @@ class Message(models.Model):
             models.Index(fields=["room", "timestamp"]),
             models.Index(fields=["sender", "timestamp"]),
         ]
+        constraints = [
+            models.UniqueConstraint(fields=["room", "seq"], name="unique_message_seq"),
+        ]
 
     def __str__(self):
         return f"{self.sender.username}: {self.content[:50]}"
 
+    def save(self, *args, **kwargs):
+        """Insert or update; new messages are counted in the same transaction
+
+        A new message without a ``seq`` draws one from the sequence backend
+        (see sequence.py), which is a Redis round trip with the default
+        settings. Callers on the hot path draw it beforehand and pass it,
+        like ChatConsumer.save_message and write-behind persistence.
+        """
+        if self.seq is None and self._state.adding:
+            from .sequence import get_sequences
+
+            self.seq = get_sequences().next(self.room_id)
+        if not self._state.adding:
+            super().save(*args, **kwargs)
+            return
+
+        from .counters import record_messages
+
+        with transaction.atomic(using=kwargs.get("using")):
+            super().save(*args, **kwargs)
+            record_messages([self])
+
     def mark_as_read(self, user):
-        if user not in self.read_by.all():
-            self.read_by.add(user)
-            if self.read_by.count() == self.room.participants.count():
-                self.is_read = True
-                self.save()
+        # Read state is a per-room watermark, see ReadState
+        return ReadState.advance(user.id, self.room_id, self.id)
 
 
 class DirectMessage(models.Model):
@@ -92,7 +128,14 @@ class DirectMessage(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
 
     class Meta:
+        # The pair is stored lower id first, so (user1, user2) has exactly
+        # one row per pair and one index lookup finds it
         unique_together = ["user1", "user2"]
+        constraints = [
+            models.CheckConstraint(
+                condition=Q(user1__lt=F("user2")), name="direct_message_user_order"
+            )
+        ]
         ordering = ["-created_at"]
 
     def __str__(self):
@@ -100,34 +143,50 @@ class DirectMessage(models.Model):
 
     @classmethod
     def get_or_create_direct_room(cls, user1, user2):
-        """Get or create a direct message room between two users"""
-        # Ensure consistent ordering to avoid duplicate rooms
-        user1_id, user2_id = sorted([user1.id, user2.id])
+        """Get or create a direct message room between two users
 
-        if user1_id == user2_id:
+        An existing DM costs one indexed lookup. A missing one is created
+        with its room and participants in one transaction; when a
+        concurrent request created it first, that one is returned.
+        """
+        if user1.id == user2.id:
             raise ValueError("Cannot create DM room with same user")
+        # Ensure consistent ordering to avoid duplicate rooms
+        u1, u2 = sorted([user1, user2], key=lambda user: user.id)
 
-        # Get the actual user objects in correct order
-        if user1.id == user1_id:
-            u1, u2 = user1, user2
-        else:
-            u1, u2 = user2, user1
-
-        dm, created = cls.objects.get_or_create(
-            user1=u1,
-            user2=u2,
-            defaults={
-                "room": ChatRoom.objects.create(
+        dms = cls.objects.select_related("room")
+        dm = dms.filter(user1_id=u1.id, user2_id=u2.id).first()
+        if dm is not None:
+            return dm
+
+        try:
+            with transaction.atomic():
+                room = ChatRoom.objects.create(
                     name=f"{u1.username}-{u2.username}",
                     room_type="direct",
                     created_by=u1,
                 )
-            },
-        )
+                room.participants.add(u1, u2)
+                return cls.objects.create(user1=u1, user2=u2, room=room)
+        except IntegrityError:
+            # Lost the race; the room above was rolled back with it
+            return dms.get(user1_id=u1.id, user2_id=u2.id)
 
-        # Ensure both users are participants
-        dm.room.participants.add(u1, u2)
-        return dm
+    @classmethod
+    def room_ids_by_peer(cls, user, peer_ids):
+        """Room ids of the user's existing DMs with peer_ids, by peer id
+
+        One query for any number of peers; peers without a DM are left out.
+        """
+        peer_ids = set(peer_ids)
+        rows = cls.objects.filter(
+            Q(user1_id=user.id, user2_id__in=peer_ids)
+            | Q(user2_id=user.id, user1_id__in=peer_ids)
+        ).values_list("user1_id", "user2_id", "room_id")
+        return {
+            user2_id if user1_id == user.id else user1_id: room_id
+            for user1_id, user2_id, room_id in rows
+        }
 
 
 class UserStatus(models.Model):
@@ -148,3 +207,180 @@ class UserStatus(models.Model):
 
     def __str__(self):
         return f"{self.user.username} - {'Online' if self.is_online else 'Offline'}"
+
+
+class ReadState(models.Model):
+    """How far a user has read in a room ("read up to message id")"""
+
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="read_states"
+    )
+    room = models.ForeignKey(
+        ChatRoom, on_delete=models.CASCADE, related_name="read_states"
+    )
+    last_read_message_id = models.BigIntegerField(default=0)
+    # Last checkpoint of the user's unread counter for the room, which
+    # lives in Redis (see unread.py)
+    unread_checkpoint = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ["user", "room"]
+
+    def __str__(self):
+        return f"{self.user_id} read {self.room_id} up to {self.last_read_message_id}"
+
+    @classmethod
+    def _newest_id(cls, room_id):
+        return ChatRoom.objects.filter(id=room_id).values_list(
+            "last_message_id", flat=True
+        )
+
+    @staticmethod
+    def _clamp(message_id, newest_id):
+        if message_id < 1 or newest_id is None:
+            return None
+        return min(message_id, newest_id)
+
+    @classmethod
+    def clamp(cls, room_id, message_id):
+        """The watermark a client reporting message_id may set, or None
+
+        Clients send the highest id they have seen. Anything past the
+        room's newest message would mark messages read before they exist,
+        so it is cut back to that message.
+        """
+        return cls._clamp(message_id, cls._newest_id(room_id).first())
+
+    @classmethod
+    async def aclamp(cls, room_id, message_id):
+        """Async variant of clamp"""
+        return cls._clamp(message_id, await cls._newest_id(room_id).afirst())
+
+    @classmethod
+    def advance(cls, user_id, room_id, message_id):
+        """Move the watermark forward (never back); returns True if it moved"""
+        updated = cls.objects.filter(
+            user_id=user_id, room_id=room_id, last_read_message_id__lt=message_id
+        ).update(last_read_message_id=message_id, updated_at=timezone.now())
+        if updated:
+            return True
+
+        state, created = cls.objects.get_or_create(
+            user_id=user_id,
+            room_id=room_id,
+            defaults={"last_read_message_id": message_id},
+        )
+        return created
+
+    @classmethod
+    async def aadvance(cls, user_id, room_id, message_id):
+        """Async variant of advance"""
+        updated = await cls.objects.filter(
+            user_id=user_id, room_id=room_id, last_read_message_id__lt=message_id
+        ).aupdate(last_read_message_id=message_id, updated_at=timezone.now())
+        if updated:
+            return True
+
+        state, created = await cls.objects.aget_or_create(
+            user_id=user_id,
+            room_id=room_id,
+            defaults={"last_read_message_id": message_id},
+        )
+        return created
+
+    @classmethod
+    def read_checker(cls, room_id, member_ids):
+        """Return is_read(message) for messages of a room
+
+        A message is read once every participant other than its sender has
+        a watermark at or past it. That only needs the two lowest
+        watermarks, so this is one query however many messages are checked.
+        """
+        marks = dict(
+            cls.objects.filter(room_id=room_id).values_list(
+                "user_id", "last_read_message_id"
+            )
+        )
+        lowest = sorted((marks.get(user_id, 0), user_id) for user_id in member_ids)[:2]
+
+        def is_read(message):
+            others = [mark for mark, user_id in lowest if user_id != message.sender_id]
+            return bool(others) and message.id <= others[0]
+
+        return is_read
+
+    @classmethod
+    def read_up_to(cls, room_id, user_id, member_ids):
+        """Highest message id every other participant has read"""
+        others = [member_id for member_id in member_ids if member_id != user_id]
+        if not others:
+            return 0
+        marks = cls.objects.filter(room_id=room_id, user_id__in=others).values_list(
+            "last_read_message_id", flat=True
+        )
+        marks = list(marks)
+        if len(marks) < len(others):
+            # Someone has not read anything yet
+            return 0
+        return min(marks)
+
+    @classmethod
+    async def aread_up_to(cls, room_id, user_id, member_ids):
+        """Async variant of read_up_to"""
+        others = [member_id for member_id in member_ids if member_id != user_id]
+        if not others:
+            return 0
+        marks = [
+            mark
+            async for mark in cls.objects.filter(
+                room_id=room_id, user_id__in=others
+            ).values_list("last_read_message_id", flat=True)
+        ]
+        if len(marks) < len(others):
+            # Someone has not read anything yet
+            return 0
+        return min(marks)
+
+    @classmethod
+    def unread_count(cls, user_id, room_id):
+        last_read = (
+            cls.objects.filter(user_id=user_id, room_id=room_id)
+            .values_list("last_read_message_id", flat=True)
+            .first()
+        ) or 0
+        return (
+            Message.objects.filter(room_id=room_id, id__gt=last_read)
+            .exclude(sender_id=user_id)
+            .count()
+        )
+
+
+class ArchivedMessageBatch(models.Model):
+    """Cold messages of one room and time range, stored compressed
+
+    Written by the archive_messages command, which deletes the rows it
+    archives from Message so the hot table and its indexes stay small.
+    See chat_app/archive.py for the format and the read path.
+    """
+
+    room = models.ForeignKey(
+        ChatRoom, on_delete=models.CASCADE, related_name="archived_batches"
+    )
+    start_at = models.DateTimeField()
+    end_at = models.DateTimeField()
+    min_message_id = models.BigIntegerField()
+    max_message_id = models.BigIntegerField()
+    message_count = models.PositiveIntegerField()
+    # zlib-compressed msgpack rows, oldest first
+    data = models.BinaryField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ["room", "start_at"]
+        indexes = [
+            models.Index(fields=["room", "end_at"]),
+        ]
+
+    def __str__(self):
+        return f"{self.room_id}: {self.message_count} messages up to {self.end_at}"
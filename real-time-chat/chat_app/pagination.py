@@ -0,0 +1,99 @@
+# chat_app/pagination.py
+import base64
+import binascii
+
+from django.utils.dateparse import parse_datetime
+
+BEFORE = "b"
+AFTER = "a"
+RANKED = "r"
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def _pack(*parts):
+    raw = "|".join(str(part) for part in parts).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def _unpack(token):
+    padded = token + "=" * (-len(token) % 4)
+    return base64.urlsafe_b64decode(padded.encode()).decode().split("|")
+
+
+def encode_cursor(direction, timestamp, pk):
+    """Build an opaque token pointing just past (timestamp, pk)"""
+    return _pack(direction, timestamp.isoformat(), pk)
+
+
+def decode_cursor(token):
+    """Return (direction, timestamp, pk) from a token made by encode_cursor"""
+    try:
+        direction, timestamp, pk = _unpack(token)
+        timestamp = parse_datetime(timestamp)
+        pk = int(pk)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise InvalidCursor(token)
+
+    if direction not in (BEFORE, AFTER) or timestamp is None:
+        raise InvalidCursor(token)
+    return direction, timestamp, pk
+
+
+def encode_rank_cursor(rank, pk):
+    """Token pointing just past (rank, pk) in results ordered by both, descending"""
+    return _pack(RANKED, repr(rank), pk)
+
+
+def decode_rank_cursor(token):
+    """Return (rank, pk) from a token made by encode_rank_cursor"""
+    try:
+        kind, rank, pk = _unpack(token)
+        rank = float(rank)
+        pk = int(pk)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise InvalidCursor(token)
+
+    if kind != RANKED:
+        raise InvalidCursor(token)
+    return rank, pk
+
+
+def keyset_page(queryset, direction, timestamp=None, pk=None, limit=50):
+    """Fetch one page of a queryset ordered by (timestamp, id) without OFFSET
+
+    With BEFORE the page holds the ``limit`` items older than the position
+    (the newest ones when no position is given); with AFTER the items newer
+    than it. Returns (items oldest first, next cursor or None). The next
+    cursor keeps going in the same direction.
+    """
+    if direction == BEFORE:
+        if timestamp is not None:
+            # Phrased as a range plus an exclusion so the (room, timestamp)
+            # index can be scanned instead of OR-ing two conditions
+            queryset = queryset.filter(timestamp__lte=timestamp).exclude(
+                timestamp=timestamp, id__gte=pk
+            )
+        queryset = queryset.order_by("-timestamp", "-id")
+    else:
+        if timestamp is not None:
+            queryset = queryset.filter(timestamp__gte=timestamp).exclude(
+                timestamp=timestamp, id__lte=pk
+            )
+        queryset = queryset.order_by("timestamp", "id")
+
+    # One extra row tells us whether there is another page, without COUNT(*)
+    items = list(queryset[: limit + 1])
+    has_more = len(items) > limit
+    items = items[:limit]
+
+    next_cursor = None
+    if has_more:
+        last = items[-1]
+        next_cursor = encode_cursor(direction, last.timestamp, last.id)
+
+    if direction == BEFORE:
+        items.reverse()
+    return items, next_cursor
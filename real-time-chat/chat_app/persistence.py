@@ -0,0 +1,238 @@
+# chat_app/persistence.py
+import asyncio
+import atexit
+import fcntl
+import logging
+
+from channels.db import database_sync_to_async
+from django.core.exceptions import ImproperlyConfigured
+from django.db import IntegrityError, connection, transaction
+from django.utils import timezone
+
+from . import metrics
+from .conf import chat_settings
+from .counters import record_messages
+from .models import Message
+from .sequence import get_sequences
+
+logger = logging.getLogger(__name__)
+
+
+class MessageIdAllocator:
+    """Draws message ids from the table's sequence as messages are sent
+
+    Ids are never reserved ahead, so across workers they follow send order
+    as plain INSERTs would; read watermarks and unread counts compare ids
+    and rely on that. Messages sent while a draw is in flight are served
+    together by the next one, one round trip for all of them.
+    """
+
+    def __init__(self):
+        self._waiting = []
+        self._lock = asyncio.Lock()
+        self._high_water = 0
+        self._lock_file = None
+
+    async def allocate(self):
+        future = asyncio.get_running_loop().create_future()
+        self._waiting.append(future)
+        async with self._lock:
+            # An earlier draw may have served us while we waited
+            if not future.done():
+                batch, self._waiting = self._waiting, []
+                try:
+                    ids = await database_sync_to_async(self._draw)(len(batch))
+                except Exception as exc:
+                    for waiter in batch:
+                        waiter.set_exception(exc)
+                else:
+                    for waiter, message_id in zip(batch, ids):
+                        waiter.set_result(message_id)
+        return await future
+
+    def _draw(self, count):
+        table = Message._meta.db_table
+        with connection.cursor() as cursor:
+            if connection.vendor == "postgresql":
+                cursor.execute(
+                    "SELECT nextval(pg_get_serial_sequence(%s, 'id')) "
+                    "FROM generate_series(1, %s)",
+                    [table, count],
+                )
+                return sorted(row[0] for row in cursor.fetchall())
+            if connection.vendor != "sqlite":
+                raise ImproperlyConfigured(
+                    "Write-behind needs PostgreSQL, or SQLite with a single worker"
+                )
+
+            # No sequence to draw from (SQLite in development): count up from
+            # the current maximum, which is only unique within one process
+            self._claim_database()
+            cursor.execute(
+                f"SELECT COALESCE(MAX(id), 0) FROM {connection.ops.quote_name(table)}"
+            )
+            start = max(cursor.fetchone()[0], self._high_water) + 1
+            self._high_water = start + count - 1
+            return list(range(start, start + count))
+
+    def _claim_database(self):
+        """Refuse to share an SQLite database file with another worker"""
+        if self._lock_file is not None or connection.is_in_memory_db():
+            return
+        lock_file = open(f"{connection.settings_dict['NAME']}.write-behind.lock", "w")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            raise ImproperlyConfigured(
+                "Write-behind on SQLite only works with a single worker, and "
+                "another process is already writing to this database"
+            )
+        # Held, and the lock with it, until the process exits
+        self._lock_file = lock_file
+
+
+class MessageWriteBehind:
+    """Buffers messages in memory and persists them with bulk_create
+
+    Messages get their id and timestamp when they are enqueued, so they can
+    be broadcast straight away. A background task flushes the buffer every
+    ``flush_interval`` seconds, or as soon as ``flush_size`` messages are
+    pending. Anything still buffered is written synchronously at exit.
+    """
+
+    def __init__(self, flush_size, flush_interval):
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.allocator = MessageIdAllocator()
+        self._pending = []
+        self._wakeup = None
+        self._task = None
+        self.flushed_total = 0
+        self.failed_flushes = 0
+
+    @property
+    def queue_depth(self):
+        return len(self._pending)
+
+    def stats(self):
+        return {
+            "queue_depth": self.queue_depth,
+            "flushed_total": self.flushed_total,
+            "failed_flushes": self.failed_flushes,
+        }
+
+    async def enqueue(self, room_id, sender_id, content):
+        message = Message(
+            id=await self.allocator.allocate(),
+            seq=await get_sequences().anext(room_id),
+            room_id=room_id,
+            sender_id=sender_id,
+            content=content,
+            timestamp=timezone.now(),
+        )
+        self._pending.append(message)
+        metrics.write_behind_depth.set(self.queue_depth)
+        self._ensure_task()
+        if len(self._pending) >= self.flush_size:
+            self._wakeup.set()
+        return message
+
+    def _ensure_task(self):
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        """Write the pending batch; on failure it is kept for the next try"""
+        if not self._pending:
+            return 0
+
+        batch, self._pending = self._pending, []
+        try:
+            with metrics.consumer_seconds.time("flush_messages"):
+                written = await database_sync_to_async(self._write)(batch)
+        except Exception:
+            self.failed_flushes += 1
+            logger.exception("Write-behind flush of %d messages failed", len(batch))
+            self._pending[:0] = batch
+            return 0
+        finally:
+            # Set on failure too: a growing queue is how an outage shows
+            metrics.write_behind_depth.set(self.queue_depth)
+            if self.queue_depth > self.flush_size * 10:
+                logger.warning("Write-behind queue depth is %d", self.queue_depth)
+
+        self.flushed_total += written
+        return written
+
+    def flush_sync(self):
+        """Persist whatever is still pending; registered to run at exit"""
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        try:
+            self.flushed_total += self._write(batch)
+        except Exception:
+            logger.exception("Lost %d buffered messages at shutdown", len(batch))
+        metrics.write_behind_depth.set(self.queue_depth)
+
+    def _write(self, batch):
+        """Insert a batch and count it; returns the number of rows written
+
+        Room and sender counters are updated in the same transaction, so a
+        row is only counted if it was inserted.
+        """
+        try:
+            with transaction.atomic():
+                Message.objects.bulk_create(batch, batch_size=self.flush_size)
+                record_messages(batch)
+            return len(batch)
+        except IntegrityError:
+            pass
+
+        # One bad row (e.g. its room was deleted meanwhile) must not keep the
+        # whole batch in the buffer forever
+        written = 0
+        for message in batch:
+            try:
+                with transaction.atomic():
+                    Message.objects.bulk_create([message])
+                    record_messages([message])
+                written += 1
+            except IntegrityError:
+                if Message.objects.filter(id=message.id).exists():
+                    # Written by an earlier flush whose result was lost
+                    logger.warning("Message %s was already written", message.id)
+                else:
+                    logger.exception("Dropping unwritable message %s", message.id)
+        return written
+
+
+_writer = None
+
+
+def get_message_writer():
+    """Return the process-wide write-behind writer, or None when disabled"""
+    global _writer
+
+    config = chat_settings("CHAT_WRITE_BEHIND")
+    if not config["ENABLED"]:
+        return None
+
+    if _writer is None:
+        _writer = MessageWriteBehind(
+            flush_size=config["FLUSH_SIZE"],
+            flush_interval=config["FLUSH_INTERVAL"],
+        )
+        atexit.register(_writer.flush_sync)
+    return _writer
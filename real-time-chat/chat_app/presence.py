@@ -0,0 +1,297 @@
+# chat_app/presence.py
+import asyncio
+import logging
+import threading
+import time
+from datetime import datetime, timezone as dt_timezone
+
+from channels.db import database_sync_to_async
+from django.contrib.auth import get_user_model
+
+from .conf import chat_settings
+from .redis_client import get_async_redis, get_redis
+
+logger = logging.getLogger(__name__)
+
+User = get_user_model()
+
+# KEYS: user's connection set, online set
+# ARGV: channel name, now, expires at, user id, key ttl
+CONNECT_SCRIPT = """
+local previous = redis.call('ZSCORE', KEYS[2], ARGV[4])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[2])
+redis.call('ZADD', KEYS[1], ARGV[3], ARGV[1])
+redis.call('EXPIRE', KEYS[1], ARGV[5])
+redis.call('ZADD', KEYS[2], 'GT', ARGV[3], ARGV[4])
+if (not previous) or tonumber(previous) < tonumber(ARGV[2]) then
+    return 1
+end
+return 0
+"""
+
+# KEYS: user's connection set, online set, pending last_seen hash
+# ARGV: channel name, now, user id
+DISCONNECT_SCRIPT = """
+redis.call('ZREM', KEYS[1], ARGV[1])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[2])
+if redis.call('ZCARD', KEYS[1]) == 0 then
+    redis.call('ZREM', KEYS[2], ARGV[3])
+    redis.call('HSET', KEYS[3], ARGV[3], ARGV[2])
+    return 1
+end
+return 0
+"""
+
+# KEYS: online set, pending last_seen hash
+# ARGV: now, ttl
+# Moves users whose every connection expired to the pending hash and takes
+# it; atomic, so a user reconnecting meanwhile is never dropped
+POP_LAST_SEEN_SCRIPT = """
+local expired = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'WITHSCORES')
+for i = 1, #expired, 2 do
+    redis.call('ZREM', KEYS[1], expired[i])
+    local seen = tonumber(expired[i + 1]) - tonumber(ARGV[2])
+    redis.call('HSETNX', KEYS[2], expired[i], tostring(seen))
+end
+local pending = redis.call('HGETALL', KEYS[2])
+redis.call('DEL', KEYS[2])
+return pending
+"""
+
+
+class RedisPresence:
+    """Connection-counted presence kept in Redis
+
+    Every socket registers its channel name under the user with an expiry
+    that the consumer refreshes on a heartbeat, so a user stays online while
+    any tab is open and drops off by themselves if a worker dies. Going
+    offline records a pending ``last_seen`` that is written to Postgres in
+    batches by ``flush_last_seen``.
+    """
+
+    ONLINE_KEY = "presence:online"
+    LAST_SEEN_KEY = "presence:last_seen"
+
+    def __init__(self, ttl, url=None):
+        self.ttl = ttl
+        self.url = url
+
+    def _conns_key(self, user_id):
+        return f"presence:conns:{user_id}"
+
+    async def connect(self, user_id, channel_name):
+        """Register a socket; returns True if the user just came online"""
+        now = time.time()
+        client = get_async_redis(self.url)
+        came_online = await client.eval(
+            CONNECT_SCRIPT,
+            2,
+            self._conns_key(user_id),
+            self.ONLINE_KEY,
+            channel_name,
+            now,
+            now + self.ttl,
+            user_id,
+            int(self.ttl * 2),
+        )
+        return bool(came_online)
+
+    async def heartbeat(self, user_id, channel_name):
+        expires_at = time.time() + self.ttl
+        client = get_async_redis(self.url)
+        async with client.pipeline(transaction=False) as pipe:
+            pipe.zadd(self._conns_key(user_id), {channel_name: expires_at})
+            pipe.expire(self._conns_key(user_id), int(self.ttl * 2))
+            pipe.zadd(self.ONLINE_KEY, {user_id: expires_at}, gt=True)
+            await pipe.execute()
+
+    async def disconnect(self, user_id, channel_name):
+        """Drop a socket; returns True if it was the user's last one"""
+        client = get_async_redis(self.url)
+        went_offline = await client.eval(
+            DISCONNECT_SCRIPT,
+            3,
+            self._conns_key(user_id),
+            self.ONLINE_KEY,
+            self.LAST_SEEN_KEY,
+            channel_name,
+            time.time(),
+            user_id,
+        )
+        return bool(went_offline)
+
+    async def connection_count(self, user_id):
+        """Live sockets of a user, on every worker"""
+        return await get_async_redis(self.url).zcount(
+            self._conns_key(user_id), time.time(), "+inf"
+        )
+
+    def online_user_ids(self):
+        ids = get_redis(self.url).zrangebyscore(self.ONLINE_KEY, time.time(), "+inf")
+        return {int(user_id) for user_id in ids}
+
+    async def are_online(self, user_ids):
+        """Return which of user_ids are online, without reading the whole set"""
+        user_ids = list(user_ids)
+        if not user_ids:
+            return set()
+        now = time.time()
+        scores = await get_async_redis(self.url).zmscore(self.ONLINE_KEY, user_ids)
+        return {
+            user_id
+            for user_id, expires_at in zip(user_ids, scores)
+            if expires_at is not None and expires_at >= now
+        }
+
+    async def aonline_user_ids(self):
+        client = get_async_redis(self.url)
+        ids = await client.zrangebyscore(self.ONLINE_KEY, time.time(), "+inf")
+        return {int(user_id) for user_id in ids}
+
+    def pop_last_seen(self):
+        """Take the pending last_seen values, including expired users"""
+        reply = get_redis(self.url).eval(
+            POP_LAST_SEEN_SCRIPT,
+            2,
+            self.ONLINE_KEY,
+            self.LAST_SEEN_KEY,
+            time.time(),
+            self.ttl,
+        )
+        return {
+            int(user_id): float(seen) for user_id, seen in zip(reply[::2], reply[1::2])
+        }
+
+    def restore_last_seen(self, pending):
+        """Put back values that could not be written; newer ones win"""
+        with get_redis(self.url).pipeline(transaction=False) as pipe:
+            for user_id, seen in pending.items():
+                pipe.hsetnx(self.LAST_SEEN_KEY, user_id, seen)
+            pipe.execute()
+
+
+class LocalPresence:
+    """In-process presence with the same semantics, for development and tests"""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._conns = {}
+        self._last_seen = {}
+        self._lock = threading.Lock()
+
+    def _expire(self, user_id, now):
+        conns = self._conns.get(user_id, {})
+        for channel_name in [c for c, exp in conns.items() if exp < now]:
+            del conns[channel_name]
+        if not conns:
+            self._conns.pop(user_id, None)
+        return conns
+
+    async def connect(self, user_id, channel_name):
+        now = time.time()
+        with self._lock:
+            came_online = not self._expire(user_id, now)
+            self._conns.setdefault(user_id, {})[channel_name] = now + self.ttl
+        return came_online
+
+    async def heartbeat(self, user_id, channel_name):
+        with self._lock:
+            self._conns.setdefault(user_id, {})[channel_name] = time.time() + self.ttl
+
+    async def disconnect(self, user_id, channel_name):
+        now = time.time()
+        with self._lock:
+            self._conns.get(user_id, {}).pop(channel_name, None)
+            if self._expire(user_id, now):
+                return False
+            self._last_seen[user_id] = now
+            return True
+
+    async def connection_count(self, user_id):
+        with self._lock:
+            return len(self._expire(user_id, time.time()))
+
+    def online_user_ids(self):
+        now = time.time()
+        with self._lock:
+            return {user_id for user_id in list(self._conns) if self._expire(user_id, now)}
+
+    async def aonline_user_ids(self):
+        return self.online_user_ids()
+
+    async def are_online(self, user_ids):
+        now = time.time()
+        with self._lock:
+            return {user_id for user_id in user_ids if self._expire(user_id, now)}
+
+    def pop_last_seen(self):
+        with self._lock:
+            pending, self._last_seen = self._last_seen, {}
+        return pending
+
+    def restore_last_seen(self, pending):
+        with self._lock:
+            for user_id, seen in pending.items():
+                self._last_seen.setdefault(user_id, seen)
+
+
+def presence_group(user_id):
+    """Channel layer group of the sockets watching a user's presence"""
+    return f"presence_{user_id}"
+
+
+_presence = None
+
+
+def get_presence():
+    """Return the configured presence backend"""
+    global _presence
+    if _presence is None:
+        config = chat_settings("CHAT_PRESENCE")
+        if config["BACKEND"] == "redis":
+            _presence = RedisPresence(config["TTL"], config["REDIS_URL"])
+        else:
+            _presence = LocalPresence(config["TTL"])
+    return _presence
+
+
+def flush_last_seen():
+    """Write pending last_seen values to the users table in one batch
+
+    Values that fail to write are put back for the next flush.
+    """
+    presence = get_presence()
+    pending = presence.pop_last_seen()
+    if not pending:
+        return 0
+
+    users = [
+        User(id=user_id, last_seen=datetime.fromtimestamp(seen, tz=dt_timezone.utc))
+        for user_id, seen in pending.items()
+    ]
+    try:
+        User.objects.bulk_update(users, ["last_seen"], batch_size=500)
+    except Exception:
+        presence.restore_last_seen(pending)
+        raise
+    return len(users)
+
+
+_flusher = None
+
+
+def ensure_last_seen_flusher():
+    """Start this worker's periodic last_seen writer if it is not running"""
+    global _flusher
+    if _flusher is None or _flusher.done():
+        _flusher = asyncio.get_running_loop().create_task(_flush_periodically())
+
+
+async def _flush_periodically():
+    interval = chat_settings("CHAT_PRESENCE")["LAST_SEEN_FLUSH_INTERVAL"]
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await database_sync_to_async(flush_last_seen)()
+        except Exception:
+            logger.exception("Flushing last_seen failed")
@@ -0,0 +1,219 @@
+# chat_app/protocol.py
+import json
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+
+import cbor2
+import msgpack
+
+# Server -> client frames. Binary codecs send [tag, *fields] so the key
+# names never go over the wire; JSON keeps the original named objects.
+SERVER_FRAMES = {
+    "message": (
+        1,
+        ("message_id", "sender_id", "sender_username", "timestamp", "message", "seq"),
+    ),
+    "typing": (2, ("user_id", "username", "is_typing")),
+    "user_status": (3, ("user_id", "username", "is_online")),
+    "user_online_status": (4, ("user_id", "username", "is_online")),
+    "read_receipt": (5, ("user_id", "username", "message_id")),
+    # typing is a list of [user_id, username] pairs
+    "typing_set": (6, ("origin", "typing")),
+    # messages are message frames without their type, oldest first
+    "history": (7, ("messages", "read_up_to")),
+    # Batched changes of the watched users: lists of user ids
+    "presence": (8, ("online", "offline")),
+    # The socket fell behind and chat messages after last_message_id (null:
+    # none received yet) were dropped; fetch them from the messages API
+    "resync": (9, ("last_message_id",)),
+    # The messages a reconnecting socket missed, oldest first, in place of
+    # the history frame
+    "replay": (10, ("messages", "read_up_to")),
+    # Current unread counts of the rooms that changed: [room_id, count] pairs
+    "unread": (11, ("rooms",)),
+    # Signed ticket to reconnect with (?ticket=), valid expires_in seconds
+    "ticket": (12, ("ticket", "expires_in")),
+    # A message was not sent because of the rate limit; retry after this
+    # many seconds
+    "throttled": (13, ("retry_after",)),
+}
+
+# Client -> server frames
+CLIENT_FRAMES = {
+    1: ("message", ("message", "sender_id")),
+    2: ("typing", ("is_typing",)),
+    3: ("read", ("message_id",)),
+    4: ("watch", ("user_ids",)),
+    5: ("unwatch", ("user_ids",)),
+}
+
+
+def _epoch_ms(value):
+    return int(datetime.fromisoformat(value).timestamp() * 1000)
+
+
+def _message_values(message):
+    # Messages buffered before sequence numbers existed have no seq
+    values = [message.get(f) for f in SERVER_FRAMES["message"][1]]
+    # Milliseconds since the epoch instead of an ISO string
+    values[3] = _epoch_ms(values[3])
+    return values
+
+
+class DecodeError(ValueError):
+    """A client frame the socket's codec cannot read; consumers ignore it"""
+
+
+def _decode_json(text_data):
+    try:
+        data = json.loads(text_data)
+    except ValueError as exc:
+        raise DecodeError(str(exc)) from exc
+    if not isinstance(data, dict):
+        raise DecodeError("Frames must be JSON objects")
+    return data
+
+
+class JSONCodec:
+    name = "json"
+    subprotocol = None
+    binary = False
+
+    def encode(self, frame_type, event):
+        fields = SERVER_FRAMES[frame_type][1]
+        # .get: messages from before sequence numbers have no seq
+        return json.dumps({"type": frame_type, **{f: event.get(f) for f in fields}})
+
+    def decode(self, text_data=None, bytes_data=None):
+        return _decode_json(text_data if text_data is not None else bytes_data)
+
+
+class BinaryCodec:
+    """Positional frames packed with msgpack or CBOR"""
+
+    binary = True
+
+    def __init__(self, name, subprotocol, dumps, loads, errors=(ValueError,)):
+        self.name = name
+        self.subprotocol = subprotocol
+        self._dumps = dumps
+        self._loads = loads
+        # What loads raises on malformed input
+        self._errors = errors
+
+    def encode(self, frame_type, event):
+        tag, fields = SERVER_FRAMES[frame_type]
+        if frame_type == "message":
+            values = _message_values(event)
+        elif frame_type in ("history", "replay"):
+            values = [
+                [_message_values(message) for message in event["messages"]],
+                event["read_up_to"],
+            ]
+        else:
+            values = [event[f] for f in fields]
+        return self._dumps([tag, *values])
+
+    def decode(self, text_data=None, bytes_data=None):
+        if bytes_data is None:
+            # Clients may still fall back to JSON text frames
+            return _decode_json(text_data)
+        try:
+            frame = self._loads(bytes_data)
+        except self._errors as exc:
+            raise DecodeError(str(exc)) from exc
+        if not isinstance(frame, list) or not frame:
+            raise DecodeError("Frames must be non-empty arrays")
+        tag, *values = frame
+        try:
+            frame_type, fields = CLIENT_FRAMES[tag]
+        except (KeyError, TypeError):
+            raise DecodeError(f"Unknown frame tag {tag!r}") from None
+        if len(values) < len(fields):
+            raise DecodeError(f"{frame_type} frames need {len(fields)} fields")
+        return {"type": frame_type, **dict(zip(fields, values))}
+
+
+JSON = JSONCodec()
+MSGPACK = BinaryCodec("msgpack", "chat.msgpack", msgpack.packb, msgpack.unpackb)
+CBOR = BinaryCodec(
+    "cbor", "chat.cbor", cbor2.dumps, cbor2.loads, errors=(cbor2.CBORDecodeError,)
+)
+
+CODECS = {codec.subprotocol: codec for codec in (MSGPACK, CBOR)}
+
+
+def negotiate(subprotocols):
+    """Pick the first binary subprotocol offered by the client, else JSON"""
+    for subprotocol in subprotocols or ():
+        if subprotocol in CODECS:
+            return CODECS[subprotocol]
+    return JSON
+
+
+class FrameCache:
+    """Encoded frames by (event id, codec), shared by a worker's consumers
+
+    Every consumer on a worker receives its own copy of a group event; the
+    first one to send it encodes the frame and the others reuse the bytes.
+    """
+
+    def __init__(self, maxsize=2048):
+        self.maxsize = maxsize
+        self._frames = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def encode(self, codec, frame_type, event):
+        event_id = event.get("event_id")
+        if event_id is None:
+            return codec.encode(frame_type, event)
+
+        key = (event_id, codec.name)
+        frame = self._frames.get(key)
+        if frame is not None:
+            self.hits += 1
+            return frame
+
+        self.misses += 1
+        frame = codec.encode(frame_type, event)
+        self._frames[key] = frame
+        if len(self._frames) > self.maxsize:
+            self._frames.popitem(last=False)
+        return frame
+
+
+frame_cache = FrameCache()
+
+# Channel layer event type -> frame sent to the client
+EVENT_FRAMES = {
+    "chat_message": "message",
+    "typing_indicator": "typing",
+    "user_status": "user_status",
+    "user_online_status": "user_online_status",
+    "read_receipt": "read_receipt",
+    "typing_set": "typing_set",
+}
+
+
+def new_event(event_type, **fields):
+    """Build a channel layer event carrying its JSON frame already encoded
+
+    JSON sockets forward the sender's bytes as they are. Binary frames are
+    not sent along, which would multiply the bytes of every group event in
+    Redis; each receiving worker encodes them once (see FrameCache).
+    """
+    event = {"type": event_type, "event_id": uuid.uuid4().hex, **fields}
+    frame_type = EVENT_FRAMES.get(event_type)
+    if frame_type is not None:
+        event["frames"] = {JSON.name: JSON.encode(frame_type, event)}
+    return event
+
+
+def event_frame(codec, frame_type, event):
+    """Return the frame for an event, pre-encoded by the sender if possible"""
+    frames = event.get("frames")
+    if frames and codec.name in frames:
+        return frames[codec.name]
+    return frame_cache.encode(codec, frame_type, event)
@@ -0,0 +1,28 @@
+# chat_app/redis_client.py
+import asyncio
+import weakref
+
+import redis
+import redis.asyncio
+from django.conf import settings
+
+_clients = {}
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def get_redis(url=None):
+    """Return a shared synchronous Redis client"""
+    url = url or settings.CHAT_REDIS_URL
+    if url not in _clients:
+        _clients[url] = redis.Redis.from_url(url)
+    return _clients[url]
+
+
+def get_async_redis(url=None):
+    """Return an asyncio Redis client bound to the running event loop"""
+    url = url or settings.CHAT_REDIS_URL
+    loop = asyncio.get_running_loop()
+    clients = _async_clients.setdefault(loop, {})
+    if url not in clients:
+        clients[url] = redis.asyncio.Redis.from_url(url)
+    return clients[url]
@@ -0,0 +1,54 @@
+# chat_app/redis_shards.py
+import shutil
+import subprocess
+import time
+from contextlib import contextmanager
+
+import redis
+
+
+def wait_until_ready(url, timeout=5):
+    client = redis.Redis.from_url(url)
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            client.ping()
+            return
+        except redis.ConnectionError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+        finally:
+            client.close()
+
+
+@contextmanager
+def local_redis_shards(count, base_port=6390, server="redis-server"):
+    """Run ``count`` throwaway redis-server instances; yields their URLs
+
+    Nothing is persisted and the servers are stopped on exit, so they can
+    back a local multi-shard channel layer or a benchmark run.
+    """
+    if shutil.which(server) is None:
+        raise RuntimeError(f"{server} not found on PATH")
+
+    ports = [base_port + i for i in range(count)]
+    processes = []
+    try:
+        for port in ports:
+            processes.append(
+                subprocess.Popen(
+                    [server, "--port", str(port), "--save", "", "--appendonly", "no"],
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL,
+                )
+            )
+        urls = [f"redis://127.0.0.1:{port}/0" for port in ports]
+        for url in urls:
+            wait_until_ready(url)
+        yield urls
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
@@ -0,0 +1,87 @@
+# chat_app/search.py
+from django.contrib.postgres.search import (
+    SearchHeadline,
+    SearchQuery,
+    SearchRank,
+    SearchVectorField,
+)
+from django.db import connection
+from django.db.models import F, FloatField, Q, Value
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Cast
+from django.utils.html import escape
+
+from .models import ChatRoom, Message
+
+# Highlight markers that cannot occur in the HTML-escaped snippet
+START_SEL = "\x02"
+STOP_SEL = "\x03"
+
+
+def accessible_messages(user, room_id=None):
+    """Messages of public rooms and of the rooms the user takes part in"""
+    rooms = ChatRoom.objects.filter(
+        Q(room_type="public") | Q(id__in=user.chat_rooms.values("id"))
+    )
+    if room_id is not None:
+        rooms = rooms.filter(id=room_id)
+    return Message.objects.filter(room__in=rooms.values("id"))
+
+
+def find_messages(user, text, room_id=None, after=None, limit=20):
+    """One page of messages matching ``text``, best matches first
+
+    On PostgreSQL this matches the GIN-indexed ``search_vector`` column
+    (added by migration 0004) with websearch syntax and ranks with ts_rank;
+    elsewhere it falls back to an unranked, case-insensitive LIKE. Results
+    are ordered by (rank, id) descending and ``after`` is the (rank, id) of
+    the last result of the previous page. Returns (messages, has_more);
+    each message has ``rank`` and an HTML-safe ``snippet``.
+    """
+    messages = accessible_messages(user, room_id).select_related("sender", "room")
+
+    if connection.vendor == "postgresql":
+        query = SearchQuery(text, config="english", search_type="websearch")
+        messages = (
+            messages.alias(
+                search_vector=RawSQL(
+                    f"{Message._meta.db_table}.search_vector",
+                    [],
+                    output_field=SearchVectorField(),
+                )
+            )
+            # search_vector @@ query, answered from the GIN index
+            .filter(search_vector=query)
+            .annotate(
+                # float8, so the value in a cursor compares equal to the column
+                rank=Cast(SearchRank(F("search_vector"), query), FloatField()),
+                headline=SearchHeadline(
+                    "content",
+                    query,
+                    config="english",
+                    start_sel=START_SEL,
+                    stop_sel=STOP_SEL,
+                    max_words=30,
+                    min_words=10,
+                ),
+            )
+        )
+    else:
+        messages = messages.filter(content__icontains=text).annotate(
+            rank=Value(0.0, output_field=FloatField()), headline=F("content")
+        )
+
+    if after is not None:
+        rank, pk = after
+        messages = messages.filter(Q(rank__lt=rank) | Q(rank=rank, id__lt=pk))
+
+    page = list(messages.order_by("-rank", "-id")[: limit + 1])
+    has_more = len(page) > limit
+    page = page[:limit]
+    for message in page:
+        message.snippet = (
+            escape(message.headline)
+            .replace(START_SEL, "<mark>")
+            .replace(STOP_SEL, "</mark>")
+        )
+    return page, has_more
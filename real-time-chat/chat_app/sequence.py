@@ -0,0 +1,98 @@
+# chat_app/sequence.py
+import threading
+
+from channels.db import database_sync_to_async
+from django.db.models import Max
+
+from .conf import chat_settings
+from .redis_client import get_async_redis, get_redis
+
+# INCR only if the counter exists, so a lost counter is seeded from the
+# table instead of restarting at 1
+INCR_EXISTING = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return redis.call('INCR', KEYS[1])
+end
+return false
+"""
+
+
+def last_seq(room_id):
+    """Highest sequence number stored for a room, 0 if none"""
+    from .models import Message
+
+    return (
+        Message.objects.filter(room_id=room_id).aggregate(last=Max("seq"))["last"] or 0
+    )
+
+
+class RedisSequences:
+    """Per-room message sequence numbers from ``chat:seq:{room}`` counters
+
+    Every worker draws from the same counter, so numbers follow the order
+    messages were accepted in across the cluster, without a database round
+    trip (write-behind messages get theirs before they are stored).
+    """
+
+    def __init__(self, url=None):
+        self.url = url
+
+    def _key(self, room_id):
+        return f"chat:seq:{room_id}"
+
+    def next(self, room_id):
+        key = self._key(room_id)
+        client = get_redis(self.url)
+        seq = client.eval(INCR_EXISTING, 1, key)
+        if seq is None:
+            client.set(key, last_seq(room_id), nx=True)
+            seq = client.incr(key)
+        return seq
+
+    async def anext(self, room_id):
+        key = self._key(room_id)
+        client = get_async_redis(self.url)
+        seq = await client.eval(INCR_EXISTING, 1, key)
+        if seq is None:
+            await client.set(key, await database_sync_to_async(last_seq)(room_id), nx=True)
+            seq = await client.incr(key)
+        return seq
+
+
+class LocalSequences:
+    """In-process counters for development and tests; single process only"""
+
+    def __init__(self):
+        self._last = {}
+        self._lock = threading.Lock()
+
+    def next(self, room_id):
+        room_id = int(room_id)
+        with self._lock:
+            if room_id not in self._last:
+                self._last[room_id] = last_seq(room_id)
+            self._last[room_id] += 1
+            return self._last[room_id]
+
+    async def anext(self, room_id):
+        room_id = int(room_id)
+        if room_id not in self._last:
+            seeded = await database_sync_to_async(last_seq)(room_id)
+            with self._lock:
+                self._last.setdefault(room_id, seeded)
+        return self.next(room_id)
+
+
+_sequences = None
+
+
+def get_sequences():
+    """Return the configured sequence backend"""
+    global _sequences
+    if _sequences is None:
+        config = chat_settings("CHAT_SEQUENCE")
+        if config["BACKEND"] == "redis":
+            _sequences = RedisSequences(config["REDIS_URL"])
+        else:
+            _sequences = LocalSequences()
+    return _sequences
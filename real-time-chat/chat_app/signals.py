@@ -0,0 +1,55 @@
+# chat_app/signals.py
+from django.contrib.auth import get_user_model
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from .cache import membership_changed, room_changed, user_changed
+from .counters import refresh_memberships
+from .models import ChatRoom
+
+
+@receiver(m2m_changed, sender=ChatRoom.participants.through)
+def participants_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """Invalidate cached membership whenever room participants change
+
+    Member and room counts are recounted in the same transaction.
+    """
+    if not reverse:
+        if action in ("post_add", "post_remove") and pk_set:
+            membership_changed(instance.pk)
+            refresh_memberships([instance.pk], pk_set)
+        elif action == "pre_clear":
+            instance._cleared_member_ids = list(
+                instance.participants.values_list("id", flat=True)
+            )
+        elif action == "post_clear":
+            membership_changed(instance.pk)
+            refresh_memberships(
+                [instance.pk], instance.__dict__.pop("_cleared_member_ids", ())
+            )
+    elif action in ("post_add", "post_remove") and pk_set:
+        # Changed from the user side (user.chat_rooms.add(...))
+        for room_id in pk_set:
+            membership_changed(room_id)
+        refresh_memberships(pk_set, [instance.pk])
+    elif action == "pre_clear":
+        # user.chat_rooms.clear() only names the rooms before they are gone
+        instance._cleared_room_ids = list(instance.chat_rooms.values_list("id", flat=True))
+        for room_id in instance._cleared_room_ids:
+            membership_changed(room_id)
+    elif action == "post_clear":
+        refresh_memberships(instance.__dict__.pop("_cleared_room_ids", ()), [instance.pk])
+
+
+@receiver(post_save, sender=ChatRoom)
+@receiver(post_delete, sender=ChatRoom)
+def room_saved(sender, instance, **kwargs):
+    """Drop the room's cached type, which admits sockets (see admission.py)"""
+    room_changed(instance.pk)
+
+
+@receiver(post_save, sender=get_user_model())
+@receiver(post_delete, sender=get_user_model())
+def user_saved(sender, instance, **kwargs):
+    """Drop the user from the WebSocket handshake cache"""
+    user_changed(instance.pk)
@@ -1,3 +1,1848 @@
-from django.test import TestCase
+import asyncio
+import json
+import os
+import tempfile
+import time
+from datetime import timedelta
+from html.parser import HTMLParser
+from io import StringIO
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from asgiref.sync import async_to_sync, sync_to_async
+from django.contrib.auth.models import AnonymousUser
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.db import DatabaseError, IntegrityError, connection
+from django.db.models.query import QuerySet
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncWebsocketConsumer
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.test import (
+    SimpleTestCase,
+    TestCase,
+    TransactionTestCase,
+    override_settings,
+    tag,
+)
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from core.models import User
+
+try:
+    # Optional: runs the Redis backends against an in-process fake server
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+from . import metrics, unread
+from .admission import LocalRateLimiter, can_join_room
+from .archive import archive_room, find_archived
+from .backpressure import OutboundQueue
+from .cache import (
+    LocalInvalidation,
+    RedisInvalidation,
+    TTLCache,
+    get_room_member_ids,
+    room_members,
+    room_types,
+    users as user_cache,
+)
+from .conf import WORKER_ID
+from .models import ChatRoom, DirectMessage, Message, ReadState
+from .pagination import encode_rank_cursor
+from .persistence import MessageIdAllocator, MessageWriteBehind
+from .presence import LocalPresence, RedisPresence, flush_last_seen
+from .sequence import LocalSequences
+from .history import (
+    LocalRecentMessages,
+    aget_history,
+    aget_messages_after,
+    get_history,
+    get_messages_after,
+    push_message,
+)
+from .consumers import ChatConsumer, OnlineStatusConsumer, parse_user_ids
+from .layers import HashRing, ShardedRedisChannelLayer
+from .protocol import (
+    CBOR,
+    JSON,
+    MSGPACK,
+    DecodeError,
+    event_frame,
+    frame_cache,
+    new_event,
+)
+from .typing_indicators import TypingAggregator
+from .ws_auth import (
+    WebSocketAuthMiddlewareStack,
+    issue_ticket,
+    read_ticket,
+    session_logs_in,
+)
+from .unread import (
+    LocalUnread,
+    UnreadNotifier,
+    checkpoint_unread,
+    count_unread,
+    get_unread,
+    inbox_group,
+)
+
+
+IN_MEMORY_LAYERS = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+
+
+class ChatTestCase(TestCase):
+    """Runs on the in-process backends, so the suite needs no Redis server
+
+    They are swapped in before setUpTestData, which already draws message
+    sequence numbers. Tests that need a fresh backend patch their own.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        layers = override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYERS)
+        layers.enable()
+        cls.addClassCleanup(layers.disable)
+        for name, backend in (
+            ("chat_app.admission._rate_limiter", LocalRateLimiter(1.0, 10)),
+            ("chat_app.cache._invalidation", LocalInvalidation()),
+            ("chat_app.history._buffer", LocalRecentMessages(200)),
+            ("chat_app.presence._presence", LocalPresence(90)),
+            ("chat_app.sequence._sequences", LocalSequences()),
+            ("chat_app.unread._unread", LocalUnread()),
+        ):
+            patcher = mock.patch(name, backend)
+            patcher.start()
+            cls.addClassCleanup(patcher.stop)
+        super().setUpClass()
+
+
+class ChatHomeQueryBudgetTest(ChatTestCase):
+    """The dashboard must not issue queries per room, member or message"""
+
+    # session + user, public rooms, DM rooms + peers prefetch, online users,
+    # user status (+1 spare); counts come from the user row
+    QUERY_BUDGET = 8
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            username="alice", email="alice@example.com", password="secret"
+        )
+        cls.others = [
+            User.objects.create_user(
+                username=f"user{i}", email=f"user{i}@example.com", password="secret"
+            )
+            for i in range(5)
+        ]
+
+    def create_rooms(self, count):
+        for i in range(count):
+            room = ChatRoom.objects.create(
+                name=f"room-{ChatRoom.objects.count()}", created_by=self.user
+            )
+            room.participants.add(self.user, *self.others)
+            Message.objects.create(room=room, sender=self.user, content="hello")
+
+    def create_dms(self):
+        for other in self.others:
+            dm = DirectMessage.get_or_create_direct_room(self.user, other)
+            Message.objects.create(room=dm.room, sender=other, content="hi")
+
+    def count_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse("chat-home"))
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    @mock.patch("chat_app.views.get_online_user_ids")
+    @mock.patch("chat_app.unread._unread", LocalUnread())
+    def test_query_budget(self, online_user_ids):
+        online_user_ids.return_value = frozenset(u.id for u in self.others[:2])
+        self.client.force_login(self.user)
+        # The first visit also creates the user's UserStatus row
+        self.count_queries()
+
+        self.create_rooms(3)
+        self.create_dms()
+        small = self.count_queries()
+
+        self.create_rooms(20)
+        large = self.count_queries()
+
+        self.assertLessEqual(large, self.QUERY_BUDGET)
+        self.assertEqual(small, large)
+
+    @mock.patch("chat_app.views.get_online_user_ids")
+    def test_lists_only_own_direct_messages(self, online_user_ids):
+        online_user_ids.return_value = frozenset()
+        self.create_dms()
+        outsider_dm = DirectMessage.get_or_create_direct_room(
+            self.others[0], self.others[1]
+        )
+
+        self.client.force_login(self.user)
+        response = self.client.get(reverse("chat-home"))
+
+        dm_rooms = list(response.context["dm_groups"])
+        self.assertEqual(len(dm_rooms), len(self.others))
+        self.assertNotIn(outsider_dm.room, dm_rooms)
+        for room in dm_rooms:
+            self.assertEqual(len(room.peers), 1)
+
+
+class MembershipCacheTest(ChatTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice, cls.bob = [
+            User.objects.create_user(
+                username=name, email=f"{name}@example.com", password="secret"
+            )
+            for name in ("alice", "bob")
+        ]
+        cls.room = ChatRoom.objects.create(name="room", created_by=cls.alice)
+        cls.room.participants.add(cls.alice)
+
+    def setUp(self):
+        room_members.clear()
+        self.addCleanup(room_members.clear)
+
+    def test_members_are_cached_until_they_change(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(get_room_member_ids(self.room.id), {self.alice.id})
+            self.assertEqual(get_room_member_ids(self.room.id), {self.alice.id})
+
+        self.room.participants.add(self.bob)
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                get_room_member_ids(self.room.id), {self.alice.id, self.bob.id}
+            )
+
+        self.bob.chat_rooms.remove(self.room)
+        self.assertEqual(get_room_member_ids(self.room.id), {self.alice.id})
+
+    def test_changes_are_published_once_committed(self):
+        event = {"type": "membership.changed", "room_id": self.room.id}
+        with mock.patch("chat_app.cache._invalidation") as invalidation:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.room.participants.add(self.bob)
+                invalidation.publish.assert_not_called()
+        invalidation.publish.assert_called_once_with(event)
+
+        # What another worker does with it
+        room_members.set(self.room.id, frozenset([self.alice.id]))
+        LocalInvalidation().publish(event)
+        self.assertIsNone(room_members.get(self.room.id))
+
+    def test_entries_expire(self):
+        cache = TTLCache(maxsize=10, ttl=60)
+        with mock.patch("chat_app.cache.time.monotonic", return_value=100):
+            cache.set("room", 1)
+        with mock.patch("chat_app.cache.time.monotonic", return_value=159):
+            self.assertEqual(cache.get("room"), 1)
+        with mock.patch("chat_app.cache.time.monotonic", return_value=161):
+            self.assertIsNone(cache.get("room"))
+        self.assertEqual(len(cache), 0)
+
+    def test_redis_listener_starts_clean_and_applies_events(self):
+        room_members.set(self.room.id, frozenset())
+        event = {"type": "room.changed", "room_id": self.room.id}
+
+        def get_message(timeout):
+            if pubsub.get_message.call_count == 1:
+                # Cached after subscribing, dropped by the event
+                room_types.set(self.room.id, "public")
+                return {"type": "message", "data": json.dumps(event)}
+            raise ConnectionError
+
+        pubsub = mock.MagicMock()
+        pubsub.__enter__.return_value = pubsub
+        pubsub.get_message.side_effect = get_message
+        with mock.patch("chat_app.cache.get_redis") as get_redis:
+            get_redis.return_value.pubsub.return_value = pubsub
+            with self.assertRaises(ConnectionError):
+                RedisInvalidation(ping_interval=30)._subscribe_and_apply()
+
+        pubsub.subscribe.assert_called_once_with(RedisInvalidation.CHANNEL)
+        self.assertIsNone(room_members.get(self.room.id))
+        self.assertIsNone(room_types.get(self.room.id))
+
+
+class DirectMessageTest(ChatTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice, cls.bob, cls.carol = [
+            User.objects.create_user(
+                username=name, email=f"{name}@example.com", password="secret"
+            )
+            for name in ("alice", "bob", "carol")
+        ]
+        cls.dm = DirectMessage.get_or_create_direct_room(cls.bob, cls.alice)
+
+    def test_existing_dm_is_one_lookup(self):
+        rooms = ChatRoom.objects.count()
+        with self.assertNumQueries(1):
+            dm = DirectMessage.get_or_create_direct_room(self.alice, self.bob)
+        self.assertEqual(dm, self.dm)
+        self.assertEqual(ChatRoom.objects.count(), rooms)
+        self.assertEqual((dm.user1, dm.user2), (self.alice, self.bob))
+        self.assertEqual(set(dm.room.participants.all()), {self.alice, self.bob})
+
+    def test_losing_the_creation_race_returns_the_other_dm(self):
+        rooms = ChatRoom.objects.count()
+        # The lookup misses as if the DM was created right after it
+        with mock.patch.object(QuerySet, "first", return_value=None):
+            dm = DirectMessage.get_or_create_direct_room(self.bob, self.alice)
+        self.assertEqual(dm, self.dm)
+        self.assertEqual(ChatRoom.objects.count(), rooms)
+
+    def test_pairs_are_stored_in_order(self):
+        with self.assertRaises(IntegrityError):
+            DirectMessage.objects.create(
+                user1=self.carol,
+                user2=self.alice,
+                room=ChatRoom.objects.create(name="dm", created_by=self.carol),
+            )
+
+    def test_rooms_of_many_peers_in_one_query(self):
+        carol_dm = DirectMessage.get_or_create_direct_room(self.carol, self.bob)
+        with self.assertNumQueries(1):
+            rooms = DirectMessage.room_ids_by_peer(
+                self.bob, [self.alice.id, self.carol.id, 999]
+            )
+        self.assertEqual(
+            rooms, {self.alice.id: self.dm.room_id, self.carol.id: carol_dm.room_id}
+        )
+
+    def test_starting_a_dm_again_rejoins_its_room(self):
+        self.dm.room.participants.remove(self.alice)
+        self.client.force_login(self.alice)
+        response = self.client.post(reverse("start-dm"), {"username": "bob"})
+        self.assertRedirects(response, reverse("chat-room", args=[self.dm.room_id]))
+        self.assertIn(self.alice, self.dm.room.participants.all())
+
+
+class ReadStateTest(ChatTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice, cls.bob, cls.carol = [
+            User.objects.create_user(
+                username=name, email=f"{name}@example.com", password="secret"
+            )
+            for name in ("alice", "bob", "carol")
+        ]
+        cls.room = ChatRoom.objects.create(name="room", created_by=cls.alice)
+        cls.room.participants.add(cls.alice, cls.bob, cls.carol)
+        cls.messages = [
+            Message.objects.create(room=cls.room, sender=cls.alice, content=str(i))
+            for i in range(3)
+        ]
+
+    def test_watermark_only_moves_forward(self):
+        first, second, _ = self.messages
+        self.assertTrue(ReadState.advance(self.bob.id, self.room.id, second.id))
+        self.assertFalse(ReadState.advance(self.bob.id, self.room.id, first.id))
+        state = ReadState.objects.get(user=self.bob, room=self.room)
+        self.assertEqual(state.last_read_message_id, second.id)
+        self.assertEqual(ReadState.unread_count(self.bob.id, self.room.id), 1)
+
+    def test_read_once_every_other_participant_has_read(self):
+        first, second, third = self.messages
+        members = [self.alice.id, self.bob.id, self.carol.id]
+        ReadState.advance(self.bob.id, self.room.id, third.id)
+        ReadState.advance(self.carol.id, self.room.id, first.id)
+
+        with self.assertNumQueries(1):
+            is_read = ReadState.read_checker(self.room.id, members)
+        self.assertTrue(is_read(first))
+        self.assertFalse(is_read(second))
+
+    @mock.patch("chat_app.metrics.enabled", True)
+    @mock.patch("chat_app.sequence._sequences", LocalSequences())
+    def test_consumer_uses_the_async_orm(self):
+        metrics.message_queries.clear()
+        room_members.delete(self.room.id)
+        consumer = ChatConsumer()
+        consumer.room_id = str(self.room.id)
+        consumer.user = self.bob
+
+        message = async_to_sync(consumer.save_message)("hi", self.bob.id)
+        self.assertEqual(message.seq, self.messages[-1].seq + 1)
+        # The INSERT and the room and sender counter UPDATEs, counted although
+        # they ran in the ORM's executor thread
+        self.assertGreaterEqual(metrics.message_queries._values[()][1], 3)
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.last_message_id, message.id)
+
+        self.assertTrue(async_to_sync(consumer.mark_read)(message.id))
+        self.assertFalse(async_to_sync(consumer.mark_read)(self.messages[0].id))
+        self.assertEqual(async_to_sync(consumer.get_read_up_to)(), 0)
+        for user in (self.alice, self.carol):
+            ReadState.advance(user.id, self.room.id, self.messages[1].id)
+        with self.assertNumQueries(1):
+            read_up_to = async_to_sync(consumer.get_read_up_to)()
+        self.assertEqual(read_up_to, self.messages[1].id)
+
+    def test_batched_endpoint(self):
+        self.client.force_login(self.bob)
+        with mock.patch("chat_app.views.notify_read") as notify_read:
+            response = self.client.post(
+                reverse("mark-room-read", args=[self.room.id]),
+                {"message_id": self.messages[-1].id},
+                content_type="application/json",
+            )
+        self.assertEqual(response.status_code, 200)
+        notify_read.assert_called_once()
+        self.assertEqual(ReadState.unread_count(self.bob.id, self.room.id), 0)
+
+    def test_reported_ids_are_clamped_to_the_newest_message(self):
+        newest = self.messages[-1].id
+        self.assertEqual(ReadState.clamp(self.room.id, 10**30), newest)
+        first = self.messages[0].id
+        self.assertEqual(ReadState.clamp(self.room.id, first), first)
+        self.assertIsNone(ReadState.clamp(self.room.id, 0))
+        empty = ChatRoom.objects.create(name="empty", created_by=self.alice)
+        self.assertIsNone(async_to_sync(ReadState.aclamp)(empty.id, 1))
+
+        self.client.force_login(self.bob)
+        url = reverse("mark-room-read", args=[self.room.id])
+        with mock.patch("chat_app.views.notify_read") as notify_read:
+            response = self.client.post(
+                url, {"message_id": 10**30}, content_type="application/json"
+            )
+            self.assertEqual(response.json()["last_read_message_id"], newest)
+            notify_read.assert_called_once_with(self.room.id, self.bob, newest)
+            for message_id in (0, -1):
+                response = self.client.post(
+                    url, {"message_id": message_id}, content_type="application/json"
+                )
+                self.assertEqual(response.status_code, 400)
+        state = ReadState.objects.get(user=self.bob, room=self.room)
+        self.assertEqual(state.last_read_message_id, newest)
+
+
+class HistoryTest(ChatTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice, cls.bob = [
+            User.objects.create_user(
+                username=name, email=f"{name}@example.com", password="secret"
+            )
+            for name in ("alice", "bob")
+        ]
+        cls.room = ChatRoom.objects.create(name="room", created_by=cls.alice)
+        cls.room.participants.add(cls.alice, cls.bob)
+        cls.messages = [
+            Message.objects.create(
+                room=cls.room, sender=(cls.alice, cls.bob)[i % 2], content=str(i)
+            )
+            for i in range(60)
+        ]
+
+    def setUp(self):
+        # A fresh in-process ring buffer whatever CHAT_HISTORY says
+        patcher = mock.patch("chat_app.history._buffer", LocalRecentMessages(200))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_newest_messages_with_senders_in_one_query(self):
+        with self.assertNumQueries(1):
+            history = get_history(self.room.id)
+        with self.assertNumQueries(0):
+            # Served from the ring buffer
+            self.assertEqual(get_history(self.room.id), history)
+            self.assertEqual(async_to_sync(aget_history)(self.room.id), history)
+        self.assertEqual(len(history), 50)
+        self.assertEqual(history[-1]["message_id"], self.messages[-1].id)
+        self.assertEqual(history[0]["message_id"], self.messages[10].id)
+        self.assertEqual(history[-1]["sender_username"], "bob")
+
+    def test_messages_sent_through_other_workers_are_in_the_history(self):
+        get_history(self.room.id)
+        # Pushed by another worker; no socket here delivered it
+        event = {
+            "message_id": 10_000,
+            "sender_id": self.alice.id,
+            "sender_username": "alice",
+            "timestamp": "2099-01-01T12:00:00+00:00",
+            "message": "new",
+        }
+        async_to_sync(push_message)(self.room.id, event)
+
+        history = async_to_sync(aget_history)(self.room.id)
+        self.assertEqual(len(history), 50)
+        self.assertEqual(history[-1]["message"], "new")
+        self.assertEqual(history[-2]["message_id"], self.messages[-1].id)
+
+    def test_history_frame_encodes_in_every_codec(self):
+        event = {"messages": get_history(self.room.id), "read_up_to": 0}
+        frame = json.loads(event_frame(JSON, "history", event))
+        self.assertEqual(frame["messages"][-1]["message"], "59")
+        for codec in (MSGPACK, CBOR):
+            tag, messages, read_up_to = codec._loads(event_frame(codec, "history", event))
+            self.assertEqual((tag, len(messages), messages[-1][4]), (7, 50, "59"))
+
+    def test_first_page_comes_from_the_ring_buffer(self):
+        get_history(self.room.id)
+        self.client.force_login(self.alice)
+        url = reverse("get-messages", args=[self.room.id])
+
+        with CaptureQueriesContext(connection) as queries:
+            first = self.client.get(url, {"cursor": "", "limit": 20}).json()
+        self.assertFalse(
+            any("chat_app_message" in query["sql"] for query in queries.captured_queries)
+        )
+        self.assertEqual(
+            [m["id"] for m in first["messages"]], [m.id for m in self.messages[-20:]]
+        )
+
+        second = self.client.get(url, {"cursor": first["next_cursor"], "limit": 50}).json()
+        self.assertEqual(
+            [m["id"] for m in second["messages"]], [m.id for m in self.messages[:40]]
+        )
+        self.assertFalse(second["has_more"])
+
+    def test_ring_buffer_fill_keeps_messages_pushed_meanwhile(self):
+        buffer = LocalRecentMessages(size=3)
+        message = {
+            "message_id": 10_000,
+            "sender_id": self.alice.id,
+            "sender_username": "alice",
+            "timestamp": "2099-01-01T12:00:00+00:00",
+            "message": "new",
+        }
+        asyncio.run(buffer.push(self.room.id, message))
+        # A partial buffer is a miss
+        self.assertIsNone(buffer.get(self.room.id))
+
+        messages, exhaustive = buffer.fill(self.room.id, get_history(self.room.id), False)
+        self.assertEqual([m["message"] for m in messages], ["58", "59", "new"])
+        self.assertEqual(buffer.get(self.room.id), (messages, False))
+
+    def test_room_page_renders_without_messages(self):
+        self.client.force_login(self.alice)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse("chat-room", args=[self.room.id]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(rendered_message_ids(response.content.decode()), [])
+        self.assertFalse(
+            any("chat_app_message" in query["sql"] for query in queries.captured_queries)
+        )
+
+
+def rendered_message_ids(html):
+    """The data-message-id of every element in ``html``, ignoring script text."""
+    ids = []
+
+    class Parser(HTMLParser):
+        def handle_starttag(self, tag, attrs):
+            ids.extend(value for name, value in attrs if name == "data-message-id")
+
+    Parser().feed(html)
+    return ids
+
+
+class KeysetPaginationTest(ChatTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user(
+            username="alice", email="alice@example.com", password="secret"
+        )
+        cls.room, cls.other_room = [
+            ChatRoom.objects.create(name=name, created_by=cls.alice)
+            for name in ("room", "other")
+        ]
+        start = timezone.now() - timedelta(hours=1)
+        cls.ids = [
+            Message.objects.create(
+                room=cls.room,
+                sender=cls.alice,
+                content=str(i),
+                # Three messages per timestamp, ordered by id among themselves
+                timestamp=start + timedelta(seconds=i // 3),
+            ).id
+            for i in range(25)
+        ]
+        cls.foreign_id = Message.objects.create(
+            room=cls.other_room, sender=cls.alice, content="elsewhere"
+        ).id
+
+    def setUp(self):
+        patcher = mock.patch("chat_app.history._buffer", LocalRecentMessages(200))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client.force_login(self.alice)
+
+    def page(self, **params):
+        response = self.client.get(
+            reverse("get-messages", args=[self.room.id]), params
+        )
+        return response.status_code, response.json()
+
+    def ids_of(self, data):
+        return [message["id"] for message in data["messages"]]
+
+    def test_cursor_pages_cover_the_room_once(self):
+        seen = []
+        params = {"cursor": "", "limit": 7}
+        while True:
+            status, data = self.page(**params)
+            self.assertEqual(status, 200)
+            self.assertLessEqual(len(data["messages"]), 7)
+            seen[:0] = self.ids_of(data)
+            if not data["has_more"]:
+                self.assertIsNone(data["next_cursor"])
+                break
+            params["cursor"] = data["next_cursor"]
+        self.assertEqual(seen, self.ids)
+
+        seen = []
+        params = {"after_id": self.ids[0], "limit": 4}
+        while True:
+            status, data = self.page(**params)
+            seen += self.ids_of(data)
+            if not data["has_more"]:
+                break
+            params = {"cursor": data["next_cursor"], "limit": 4}
+        self.assertEqual(seen, self.ids[1:])
+
+    def test_before_and_after_id_bounds(self):
+        # Messages 9 to 11 share a timestamp, the id breaks the tie
+        _, data = self.page(before_id=self.ids[10], limit=5)
+        self.assertEqual(self.ids_of(data), self.ids[5:10])
+        self.assertTrue(data["has_more"])
+        _, data = self.page(after_id=self.ids[10], limit=5)
+        self.assertEqual(self.ids_of(data), self.ids[11:16])
+
+        _, data = self.page(before_id=self.ids[0])
+        self.assertEqual((data["messages"], data["has_more"]), ([], False))
+        _, data = self.page(after_id=self.ids[-1])
+        self.assertEqual((data["messages"], data["has_more"]), ([], False))
+
+    def test_bad_and_foreign_cursors(self):
+        for params in (
+            {"cursor": "not a cursor"},
+            {"cursor": encode_rank_cursor(0.5, self.ids[3])},
+            {"before_id": "abc"},
+        ):
+            with self.subTest(params=params):
+                self.assertEqual(self.page(**params)[0], 400)
+        for params in (
+            {"before_id": self.foreign_id},
+            {"after_id": self.ids[-1] + 1000},
+        ):
+            with self.subTest(params=params):
+                self.assertEqual(self.page(**params)[0], 404)
+
+
+class ArchiveTest(ChatTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user(
+            username="alice", email="alice@example.com", password="secret"
+        )
+        cls.room = ChatRoom.objects.create(name="room", created_by=cls.alice)
+        cls.messages = [
+            Message.objects.create(room=cls.room, sender=cls.alice, content=str(i))
+            for i in range(30)
+        ]
+        # 20 old messages spread over two months, 10 recent ones
+        start = timezone.now() - timedelta(days=200)
+        for i, message in enumerate(cls.messages[:20]):
+            message.timestamp = start + timedelta(days=3 * i, microseconds=7)
+            Message.objects.filter(id=message.id).update(timestamp=message.timestamp)
+
+    def setUp(self):
+        patcher = mock.patch("chat_app.history._buffer", LocalRecentMessages(200))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_archived_messages_keep_their_fields(self):
+        cutoff = timezone.now() - timedelta(days=90)
+        self.assertEqual(archive_room(self.room.id, cutoff, batch_size=8), 20)
+        self.assertEqual(Message.objects.filter(room=self.room).count(), 10)
+        batches = list(self.room.archived_batches.all())
+        self.assertEqual(sum(b.message_count for b in batches), 20)
+        for batch in batches:
+            self.assertEqual(batch.start_at.month, batch.end_at.month)
+
+        original = self.messages[5]
+        archived = find_archived(self.room.id, original.id)
+        self.assertEqual(
+            (archived.content, archived.sender.username, archived.timestamp),
+            (original.content, "alice", original.timestamp),
+        )
+
+    def test_pages_continue_into_the_archive(self):
+        call_command("archive_messages", "--batch-size", "8", stdout=StringIO())
+        self.client.force_login(self.alice)
+        url = reverse("get-messages", args=[self.room.id])
+
+        ids, cursor = [], ""
+        while cursor is not None:
+            page = self.client.get(url, {"cursor": cursor, "limit": 7}).json()
+            ids = [m["id"] for m in page["messages"]] + ids
+            cursor = page["next_cursor"]
+        self.assertEqual(ids, [m.id for m in self.messages])
+
+        newer = self.client.get(
+            url, {"after_id": self.messages[15].id, "limit": 7}
+        ).json()
+        self.assertEqual(
+            [m["id"] for m in newer["messages"]], [m.id for m in self.messages[16:23]]
+        )
+        self.assertTrue(newer["has_more"])
+
+
+class ResumeTest(ChatTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user(
+            username="alice", email="alice@example.com", password="secret"
+        )
+        cls.room, cls.other = [
+            ChatRoom.objects.create(name=name, created_by=cls.alice)
+            for name in ("room", "other")
+        ]
+
+    def setUp(self):
+        for name, backend in (
+            ("chat_app.history._buffer", LocalRecentMessages(20)),
+            ("chat_app.sequence._sequences", LocalSequences()),
+        ):
+            patcher = mock.patch(name, backend)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.messages = [
+            Message.objects.create(room=room, sender=self.alice, content=str(i))
+            for i in range(30)
+            for room in (self.room, self.other)
+        ][::2]
+
+    def test_messages_are_numbered_per_room(self):
+        self.assertEqual([m.seq for m in self.messages], list(range(1, 31)))
+        self.assertEqual(self.other.messages.order_by("seq").last().seq, 30)
+
+    def test_passed_sequence_numbers_are_kept(self):
+        with mock.patch("chat_app.sequence._sequences") as sequences:
+            message = Message.objects.create(
+                room=self.room, sender=self.alice, content="x", seq=31
+            )
+        sequences.next.assert_not_called()
+        message.refresh_from_db()
+        self.assertEqual(message.seq, 31)
+
+    def test_gap_comes_from_the_ring_buffer_or_one_query(self):
+        get_history(self.room.id)
+        with self.assertNumQueries(0):
+            missed = get_messages_after(self.room.id, 25)
+        self.assertEqual([m["seq"] for m in missed], [26, 27, 28, 29, 30])
+
+        # The buffer holds the newest 20 only
+        with self.assertNumQueries(1):
+            missed = get_messages_after(self.room.id, 5)
+        self.assertEqual([m["message"] for m in missed], [str(i) for i in range(5, 30)])
+
+        with mock.patch.dict("chat_app.history._config", {"REPLAY_LIMIT": 10}):
+            self.assertIsNone(get_messages_after(self.room.id, 5))
+
+    def send_elsewhere(self, content, pushed=True):
+        """A message sent through another worker: stored, maybe buffered"""
+        message = Message.objects.create(
+            room=self.room, sender=self.alice, content=content
+        )
+        if pushed:
+            async_to_sync(push_message)(
+                self.room.id,
+                {
+                    "message_id": message.id,
+                    "sender_id": self.alice.id,
+                    "sender_username": "alice",
+                    "timestamp": message.timestamp.isoformat(),
+                    "message": content,
+                    "seq": message.seq,
+                },
+            )
+        return message
+
+    def test_replay_includes_messages_sent_through_other_workers(self):
+        # This worker caches the room's history and delivers nothing after
+        get_history(self.room.id)
+        self.send_elsewhere("elsewhere")
+        with self.assertNumQueries(0):
+            missed = async_to_sync(aget_messages_after)(self.room.id, 30)
+        self.assertEqual([m["message"] for m in missed], ["elsewhere"])
+
+        # A message missing from the buffer sends the replay to the table
+        self.send_elsewhere("not buffered", pushed=False)
+        self.send_elsewhere("buffered")
+        with self.assertNumQueries(1):
+            missed = async_to_sync(aget_messages_after)(self.room.id, 31)
+        self.assertEqual([m["seq"] for m in missed], [32, 33])
+
+    def test_reconnecting_socket_gets_a_replay(self):
+        async def connect(query):
+            communicator = WebsocketCommunicator(
+                ChatConsumer.as_asgi(), f"/ws/chat/{self.room.id}/{query}"
+            )
+            communicator.scope["url_route"] = {"kwargs": {"room_id": str(self.room.id)}}
+            communicator.scope["user"] = self.alice
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            frame = await communicator.receive_json_from()
+            await communicator.disconnect()
+            return frame
+
+        replay = async_to_sync(connect)("?last_seq=28")
+        self.assertEqual(replay["type"], "replay")
+        self.assertEqual([m["seq"] for m in replay["messages"]], [29, 30])
+
+        history = async_to_sync(connect)("")
+        self.assertEqual(history["type"], "history")
+        self.assertEqual(len(history["messages"]), 20)
+
+
+class CounterTest(ChatTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice, cls.bob = [
+            User.objects.create_user(
+                username=name, email=f"{name}@example.com", password="secret"
+            )
+            for name in ("alice", "bob")
+        ]
+        cls.room = ChatRoom.objects.create(name="room", created_by=cls.alice)
+
+    def assertCounts(self, obj, **expected):
+        obj.refresh_from_db()
+        self.assertEqual({name: getattr(obj, name) for name in expected}, expected)
+
+    def test_joins_leaves_and_messages_are_counted(self):
+        self.room.participants.add(self.alice, self.bob)
+        self.room.participants.add(self.bob)
+        self.bob.chat_rooms.remove(self.room)
+        self.room.participants.remove(self.bob)
+        DirectMessage.get_or_create_direct_room(self.alice, self.bob)
+        self.assertCounts(self.room, member_count=1)
+        self.assertCounts(self.alice, room_count=2, direct_room_count=1)
+        self.assertCounts(self.bob, room_count=1, direct_room_count=1)
+
+        Message.objects.create(room=self.room, sender=self.alice, content="x" * 150)
+        last = Message.objects.create(room=self.room, sender=self.bob, content="hi")
+        self.assertCounts(
+            self.room,
+            message_count=2,
+            last_message_id=last.id,
+            last_message_preview="hi",
+        )
+        self.assertCounts(self.alice, message_count=1)
+
+    def test_batches_written_out_of_order_keep_the_newest_message(self):
+        now = timezone.now()
+        newer, older = [
+            Message(
+                id=10_000 + i,
+                seq=10_000 + i,
+                room=self.room,
+                sender=self.alice,
+                content=str(i),
+                timestamp=now - timedelta(minutes=i),
+            )
+            for i in range(2)
+        ]
+        writer = MessageWriteBehind(flush_size=10, flush_interval=1)
+        writer._write([newer])
+        writer._write([older])
+        self.assertCounts(
+            self.room, message_count=2, last_message_id=newer.id, last_message_preview="0"
+        )
+        self.assertCounts(self.alice, message_count=2)
+
+    def test_reconcile_fixes_drift_and_counts_archived_messages(self):
+        self.room.participants.add(self.alice)
+        for i in range(3):
+            Message.objects.create(
+                room=self.room,
+                sender=self.alice,
+                content=str(i),
+                timestamp=timezone.now() - timedelta(days=100 - i),
+            )
+        archive_room(self.room.id, timezone.now() - timedelta(days=98))
+        ChatRoom.objects.update(member_count=7, message_count=0, last_message_preview="")
+        User.objects.filter(id=self.alice.id).update(message_count=0)
+
+        out = StringIO()
+        call_command("reconcile_counters", "--dry-run", stdout=out)
+        self.assertIn("Rooms: checked 1, would fix 1", out.getvalue())
+        self.assertCounts(self.room, member_count=7)
+
+        call_command("reconcile_counters", stdout=StringIO())
+        self.assertCounts(
+            self.room, member_count=1, message_count=3, last_message_preview="2"
+        )
+        self.assertCounts(self.alice, message_count=3, room_count=1)
+        out = StringIO()
+        call_command("reconcile_counters", "--dry-run", stdout=out)
+        self.assertIn("Users: checked 2, would fix 0", out.getvalue())
+
+
+@mock.patch("chat_app.metrics.enabled", True)
+class WriteBehindTest(ChatTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user(
+            username="alice", email="alice@example.com", password="secret"
+        )
+        cls.room = ChatRoom.objects.create(name="room", created_by=cls.alice)
+
+    def setUp(self):
+        self.writer = MessageWriteBehind(flush_size=100, flush_interval=60)
+        metrics.write_behind_depth.clear()
+        self.addCleanup(metrics.write_behind_depth.clear)
+
+    def depth(self):
+        return metrics.write_behind_depth._values[()]
+
+    def run_async(self, coro):
+        async def run():
+            try:
+                return await coro
+            finally:
+                self.writer._task.cancel()
+
+        return async_to_sync(run)()
+
+    async def enqueue(self, *contents):
+        for content in contents:
+            await self.writer.enqueue(self.room.id, self.alice.id, content)
+
+    def test_flush_writes_and_counts_the_batch(self):
+        async def scenario():
+            await self.enqueue("a", "b", "c")
+            self.assertEqual(self.depth(), 3)
+            return await self.writer.flush()
+
+        self.assertEqual(self.run_async(scenario()), 3)
+        self.assertEqual(self.depth(), 0)
+        self.assertEqual(
+            list(Message.objects.values_list("content", flat=True)), ["a", "b", "c"]
+        )
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.message_count, 3)
+
+    def test_failed_flush_keeps_the_batch_in_order(self):
+        async def scenario():
+            await self.enqueue("a", "b")
+            with mock.patch.object(
+                Message.objects, "bulk_create", side_effect=DatabaseError("down")
+            ), self.assertLogs("chat_app.persistence", "ERROR"):
+                self.assertEqual(await self.writer.flush(), 0)
+            self.assertEqual(self.depth(), 2)
+            await self.enqueue("c")
+            self.assertEqual(self.depth(), 3)
+            return await self.writer.flush()
+
+        self.assertEqual(self.run_async(scenario()), 3)
+        self.assertEqual(self.writer.stats()["failed_flushes"], 1)
+        self.assertEqual(
+            list(Message.objects.values_list("content", flat=True)), ["a", "b", "c"]
+        )
+
+    def test_rewritten_messages_are_not_counted_twice(self):
+        self.run_async(self.enqueue("a", "b"))
+        batch = list(self.writer._pending)
+        self.assertEqual(self.writer._write(batch[:1]), 1)
+        with self.assertLogs("chat_app.persistence", "WARNING"):
+            self.assertEqual(self.writer._write(batch), 1)
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.message_count, 2)
+
+    def test_flush_sync_writes_what_is_pending(self):
+        self.run_async(self.enqueue("a", "b"))
+        self.writer.flush_sync()
+        self.assertEqual(self.writer.queue_depth, 0)
+        self.assertEqual(self.writer.flushed_total, 2)
+        self.assertEqual(Message.objects.count(), 2)
+
+    def test_concurrent_sends_share_one_draw_in_send_order(self):
+        allocator = MessageIdAllocator()
+
+        async def scenario():
+            return await asyncio.gather(*(allocator.allocate() for _ in range(5)))
+
+        with mock.patch.object(allocator, "_draw", wraps=allocator._draw) as draw:
+            ids = async_to_sync(scenario)()
+        self.assertEqual(ids, sorted(ids))
+        self.assertEqual(len(set(ids)), 5)
+        # The first send draws alone, the four queued behind it share a draw
+        self.assertEqual([call.args for call in draw.call_args_list], [(1,), (4,)])
+
+    def test_sqlite_database_files_take_a_single_worker(self):
+        with tempfile.TemporaryDirectory() as directory, mock.patch.object(
+            connection, "is_in_memory_db", return_value=False
+        ), mock.patch.dict(
+            connection.settings_dict, {"NAME": os.path.join(directory, "db.sqlite3")}
+        ):
+            first, second = MessageIdAllocator(), MessageIdAllocator()
+            first._claim_database()
+            with self.assertRaises(ImproperlyConfigured):
+                second._claim_database()
+            first._lock_file.close()
+
+
+@mock.patch("chat_app.unread.unread_notifier", UnreadNotifier(0.2))
+class UnreadTest(ChatTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice, cls.bob, cls.carol = [
+            User.objects.create_user(
+                username=name, email=f"{name}@example.com", password="secret"
+            )
+            for name in ("alice", "bob", "carol")
+        ]
+        cls.room = ChatRoom.objects.create(name="room", created_by=cls.alice)
+        cls.room.participants.add(cls.alice, cls.bob, cls.carol)
+        cls.quiet = ChatRoom.objects.create(name="quiet", created_by=cls.alice)
+        cls.quiet.participants.add(cls.alice, cls.bob)
+
+    def setUp(self):
+        patcher = mock.patch("chat_app.unread._unread", LocalUnread())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def send(self, room, sender, count=1):
+        """Store messages and count them as the consumer does; returns the
+        ``unread`` frames bob's online socket got"""
+
+        async def send():
+            layer = get_channel_layer()
+            channel = await layer.new_channel()
+            await layer.group_add(inbox_group(self.bob.id), channel)
+            messages = []
+            for i in range(count):
+                message = await Message.objects.acreate(
+                    room=room, sender=sender, content=str(i)
+                )
+                messages.append(message)
+                await count_unread(room.id, sender.id)
+            if unread.unread_notifier._task:
+                await unread.unread_notifier._task
+            frames = []
+            while True:
+                try:
+                    frames.append(await asyncio.wait_for(layer.receive(channel), 0.05))
+                except asyncio.TimeoutError:
+                    break
+            await layer.group_discard(inbox_group(self.bob.id), channel)
+            return messages, frames
+
+        return async_to_sync(send)()
+
+    def read(self, user, message):
+        self.client.force_login(user)
+        response = self.client.post(
+            reverse("mark-room-read", args=[message.room_id]),
+            {"message_id": message.id},
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 200)
+
+    def test_messages_count_for_other_members_until_read(self):
+        messages, frames = self.send(self.room, self.alice, count=3)
+        # One batched push for the three messages
+        self.assertEqual([frame["rooms"] for frame in frames], [[[self.room.id, 3]]])
+        self.assertEqual(get_unread().counts(self.alice.id), {})
+        self.assertEqual(get_unread().counts(self.carol.id), {self.room.id: 3})
+
+        self.read(self.bob, messages[0])
+        self.assertEqual(get_unread().counts(self.bob.id), {self.room.id: 2})
+        self.read(self.bob, messages[-1])
+        self.assertEqual(get_unread().counts(self.bob.id), {self.room.id: 0})
+
+    def test_checkpoint_survives_losing_the_counters(self):
+        self.send(self.room, self.alice, count=2)
+        self.assertEqual(checkpoint_unread(), 2)
+        self.assertEqual(checkpoint_unread(), 0)
+        state = ReadState.objects.get(user=self.bob, room=self.room)
+        self.assertEqual(state.unread_checkpoint, 2)
+
+        # The counters are lost; increments land on top of the checkpoint
+        with mock.patch("chat_app.unread._unread", LocalUnread()):
+            self.send(self.room, self.alice)
+            self.assertEqual(get_unread().counts(self.bob.id), {self.room.id: 3})
+
+    def test_inbox_lists_unread_rooms_first(self):
+        self.send(self.room, self.alice, count=2)
+        messages, _ = self.send(self.quiet, self.alice)
+        self.read(self.bob, messages[0])
+
+        with self.assertNumQueries(3):
+            response = self.client.get(reverse("inbox"))
+        data = response.json()
+        self.assertEqual(
+            [(room["id"], room["unread"]) for room in data["rooms"]],
+            [(self.room.id, 2), (self.quiet.id, 0)],
+        )
+        self.assertEqual(data["rooms"][1]["last_message_preview"], "0")
+        self.assertEqual(data["total_unread"], 2)
+
+
+class HashRingTest(SimpleTestCase):
+    GROUPS = [f"chat_{room_id}" for room_id in range(10000)]
+
+    def test_groups_are_spread_evenly(self):
+        ring = HashRing([f"redis://10.0.0.{i}:6379/0" for i in range(4)])
+        counts = [0] * 4
+        for group in self.GROUPS:
+            counts[ring.get_index(group)] += 1
+        for count in counts:
+            self.assertAlmostEqual(count / len(self.GROUPS), 0.25, delta=0.05)
+
+    def test_adding_a_shard_only_moves_groups_onto_it(self):
+        nodes = [f"redis://10.0.0.{i}:6379/0" for i in range(5)]
+        before, after = HashRing(nodes[:4]), HashRing(nodes)
+        moved = [g for g in self.GROUPS if before.get_index(g) != after.get_index(g)]
+        self.assertTrue(all(after.get_index(group) == 4 for group in moved))
+        self.assertAlmostEqual(len(moved) / len(self.GROUPS), 0.2, delta=0.05)
+
+    def test_layer_routes_groups_by_the_ring(self):
+        hosts = ["redis://10.0.0.1:6379/0", "redis://10.0.0.2:6379/0"]
+        layer = ShardedRedisChannelLayer(hosts=hosts)
+        ring = HashRing(hosts)
+        for group in ("online_users", "chat_1", "chat_2"):
+            self.assertEqual(layer.consistent_hash(group), ring.get_index(group))
+
+
+class SearchTest(ChatTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice, cls.bob = [
+            User.objects.create_user(
+                username=name, email=f"{name}@example.com", password="secret"
+            )
+            for name in ("alice", "bob")
+        ]
+        cls.public = ChatRoom.objects.create(name="public", created_by=cls.bob)
+        cls.private = ChatRoom.objects.create(
+            name="private", room_type="private", created_by=cls.bob
+        )
+        cls.private.participants.add(cls.bob)
+        for i in range(5):
+            Message.objects.create(
+                room=cls.public, sender=cls.bob, content=f"deploy <b>{i}</b> done"
+            )
+        Message.objects.create(room=cls.private, sender=cls.bob, content="deploy secret")
+
+    def search(self, **params):
+        response = self.client.get(reverse("search-messages"), params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_results_are_paginated_and_scoped_to_readable_rooms(self):
+        self.client.force_login(self.alice)
+        first = self.search(q="deploy", limit=3)
+        second = self.search(q="deploy", limit=3, cursor=first["next_cursor"])
+
+        results = first["results"] + second["results"]
+        self.assertEqual(len(results), 5)
+        self.assertEqual(len({r["id"] for r in results}), 5)
+        self.assertFalse(second["has_more"])
+        self.assertEqual({r["room"] for r in results}, {"public"})
+        # Message content is escaped in the snippet
+        self.assertNotIn("<b>", results[0]["snippet"])
+
+    def test_members_find_private_messages(self):
+        self.client.force_login(self.bob)
+        results = self.search(q="secret")["results"]
+        self.assertEqual([r["room"] for r in results], ["private"])
+
+    def test_rejects_bad_input(self):
+        self.client.force_login(self.alice)
+        url = reverse("search-messages")
+        self.assertEqual(self.client.get(url).status_code, 400)
+        self.assertEqual(self.client.get(url, {"q": "x", "cursor": "nope"}).status_code, 400)
+
+
+class AdmissionTest(ChatTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice, cls.bob = [
+            User.objects.create_user(
+                username=name, email=f"{name}@example.com", password="secret"
+            )
+            for name in ("alice", "bob")
+        ]
+        cls.public = ChatRoom.objects.create(name="public", created_by=cls.alice)
+        cls.private = ChatRoom.objects.create(
+            name="private", room_type="private", created_by=cls.alice
+        )
+        cls.private.participants.add(cls.alice)
+
+    def setUp(self):
+        for name, backend in (
+            ("chat_app.consumers.get_presence", mock.Mock(return_value=LocalPresence(90))),
+            ("chat_app.admission._rate_limiter", LocalRateLimiter(0.01, 2)),
+            ("chat_app.sequence._sequences", LocalSequences()),
+            ("chat_app.history._buffer", LocalRecentMessages(20)),
+        ):
+            patcher = mock.patch(name, backend)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def open(self, user, room_id):
+        communicator = WebsocketCommunicator(
+            ChatConsumer.as_asgi(), f"/ws/chat/{room_id}/"
+        )
+        communicator.scope["url_route"] = {"kwargs": {"room_id": str(room_id)}}
+        communicator.scope["user"] = user
+        return communicator
+
+    def admitted(self, user, room_id):
+        async def connect():
+            communicator = self.open(user, room_id)
+            connected, _ = await communicator.connect()
+            await communicator.disconnect()
+            return connected
+
+        return async_to_sync(connect)()
+
+    def test_rooms_are_authorized_from_the_cache(self):
+        self.assertTrue(self.admitted(self.bob, self.public.id))
+        self.assertTrue(self.admitted(self.alice, self.private.id))
+        self.assertFalse(self.admitted(self.bob, self.private.id))
+        self.assertFalse(self.admitted(self.bob, 999))
+        self.assertFalse(self.admitted(AnonymousUser(), self.public.id))
+        with self.assertNumQueries(0):
+            self.assertFalse(async_to_sync(can_join_room)(self.bob.id, self.private.id))
+
+        self.private.participants.add(self.bob)
+        self.assertTrue(self.admitted(self.bob, self.private.id))
+
+    @override_settings(CHAT_ADMISSION={"MAX_SOCKETS_PER_USER": 1})
+    def test_sockets_per_user_are_capped(self):
+        async def scenario():
+            first = self.open(self.alice, self.public.id)
+            second = self.open(self.alice, self.public.id)
+            self.assertTrue((await first.connect())[0])
+            self.assertFalse((await second.connect())[0])
+            await first.disconnect()
+
+        async_to_sync(scenario)()
+
+    def test_messages_are_rate_limited_and_sent_as_the_socket_user(self):
+        async def scenario():
+            communicator = self.open(self.alice, self.public.id)
+            await communicator.connect()
+            for i in range(3):
+                await communicator.send_json_to(
+                    {"type": "message", "message": str(i), "sender_id": self.bob.id}
+                )
+            frames = []
+            while not await communicator.receive_nothing(0.1):
+                frames.append(await communicator.receive_json_from())
+            await communicator.disconnect()
+            return frames
+
+        frames = async_to_sync(scenario)()
+        self.assertEqual(
+            [frame["type"] for frame in frames if frame["type"] in ("message", "throttled")],
+            ["message", "message", "throttled"],
+        )
+        messages = Message.objects.filter(room=self.public)
+        self.assertEqual([m.sender_id for m in messages], [self.alice.id] * 2)
+
+    def test_malformed_frames_are_ignored(self):
+        async def scenario():
+            communicator = self.open(self.alice, self.public.id)
+            await communicator.connect()
+            for frame in ("not json", "[1]", '{"type": "message"}', '{"type": "typing"}'):
+                await communicator.send_to(text_data=frame)
+            await communicator.send_json_to({"type": "message", "message": "hi"})
+            frames = []
+            while not await communicator.receive_nothing(0.1):
+                frames.append(await communicator.receive_json_from())
+            await communicator.disconnect()
+            return frames
+
+        frames = async_to_sync(scenario)()
+        self.assertEqual([f["message"] for f in frames if f["type"] == "message"], ["hi"])
+        self.assertEqual(
+            list(Message.objects.filter(room=self.public).values_list("content", flat=True)),
+            ["hi"],
+        )
+
+
+class WhoAmI(AsyncWebsocketConsumer):
+    async def connect(self):
+        await self.accept()
+        await self.send(
+            text_data=json.dumps(
+                {
+                    "user_id": self.scope["user"].id,
+                    "session_auth": self.scope["session_auth"],
+                }
+            )
+        )
+
+
+class StillLoggedIn(AsyncWebsocketConsumer):
+    """Answers every frame with whether the socket's session still logs in"""
+
+    async def receive(self, text_data=None, bytes_data=None):
+        logged_in = await database_sync_to_async(session_logs_in)(
+            self.scope["session"], self.scope["user"]
+        )
+        await self.send(text_data=json.dumps(logged_in))
+
+
+class WebSocketAuthTest(ChatTestCase):
+    application = WebSocketAuthMiddlewareStack(WhoAmI.as_asgi())
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user(
+            username="alice", email="alice@example.com", password="secret"
+        )
+
+    def setUp(self):
+        user_cache.clear()
+
+    def handshake(self, path="/ws/online/", headers=()):
+        async def connect():
+            communicator = WebsocketCommunicator(self.application, path, headers)
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            frame = await communicator.receive_json_from()
+            await communicator.disconnect()
+            return frame
+
+        return async_to_sync(connect)()
+
+    def session_headers(self):
+        self.client.force_login(self.alice)
+        return [(b"cookie", f"sessionid={self.client.cookies['sessionid'].value}".encode())]
+
+    def test_tickets_authenticate_cached_users_without_queries(self):
+        ticket = issue_ticket(self.alice)
+        path = f"/ws/online/?ticket={ticket}"
+        with self.assertNumQueries(1):
+            frame = self.handshake(path)
+        self.assertEqual(frame, {"user_id": self.alice.id, "session_auth": False})
+        with self.assertNumQueries(0):
+            self.assertEqual(self.handshake(path)["user_id"], self.alice.id)
+
+        self.assertIsNone(read_ticket(ticket[:-2] + "xx"))
+        with override_settings(CHAT_WS_AUTH={"TICKET_MAX_AGE": -1}):
+            self.assertIsNone(read_ticket(ticket))
+
+    def test_tickets_stop_working_after_a_password_change_or_deactivation(self):
+        path = f"/ws/online/?ticket={issue_ticket(self.alice)}"
+        self.assertEqual(self.handshake(path)["user_id"], self.alice.id)
+
+        self.alice.set_password("changed")
+        self.alice.save()
+        self.assertIsNone(self.handshake(path)["user_id"])
+
+        path = f"/ws/online/?ticket={issue_ticket(self.alice)}"
+        self.alice.is_active = False
+        self.alice.save()
+        self.assertIsNone(self.handshake(path)["user_id"])
+
+    def test_only_the_session_path_marks_sockets_session_authenticated(self):
+        headers = self.session_headers()
+        self.assertEqual(
+            self.handshake(headers=headers),
+            {"user_id": self.alice.id, "session_auth": True},
+        )
+        self.client.logout()
+        self.assertEqual(
+            self.handshake(headers=headers), {"user_id": None, "session_auth": False}
+        )
+
+    def test_logged_out_sessions_no_longer_log_in(self):
+        # Through the middleware, scope["session"] is channels' LazyObject
+        application = WebSocketAuthMiddlewareStack(StillLoggedIn.as_asgi())
+        headers = self.session_headers()
+
+        async def scenario():
+            communicator = WebsocketCommunicator(application, "/ws/online/", headers)
+            await communicator.connect()
+            answers = []
+            for _ in range(2):
+                await communicator.send_to(text_data="?")
+                answers.append(await communicator.receive_json_from())
+                await sync_to_async(self.client.logout)()
+            await communicator.disconnect()
+            return answers
+
+        self.assertEqual(async_to_sync(scenario)(), [True, False])
+
+    def test_session_users_are_cached_until_saved(self):
+        headers = self.session_headers()
+        self.assertEqual(self.handshake(headers=headers)["user_id"], self.alice.id)
+        # Only the session is read once the user is cached
+        with self.assertNumQueries(1):
+            self.assertEqual(self.handshake(headers=headers)["user_id"], self.alice.id)
+
+        self.alice.set_password("changed")
+        self.alice.save()
+        self.assertIsNone(self.handshake(headers=headers)["user_id"])
+
+
+def fake_redis(test, module):
+    """Point a module's Redis clients at a fresh fake server"""
+    server = fakeredis.FakeServer()
+    for name, client in (
+        ("get_redis", fakeredis.FakeRedis),
+        ("get_async_redis", fakeredis.FakeAsyncRedis),
+    ):
+        patcher = mock.patch(
+            f"{module}.{name}", lambda url=None, client=client: client(server=server)
+        )
+        patcher.start()
+        test.addCleanup(patcher.stop)
+
+
+class LastSeenTest(ChatTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user(
+            username="alice", email="alice@example.com", password="secret"
+        )
+
+    def test_failed_flush_keeps_the_values(self):
+        presence = LocalPresence(90)
+        async_to_sync(presence.connect)(self.alice.id, "a")
+        async_to_sync(presence.disconnect)(self.alice.id, "a")
+        with mock.patch("chat_app.presence._presence", presence):
+            with mock.patch.object(
+                User.objects, "bulk_update", side_effect=DatabaseError("down")
+            ), self.assertRaises(DatabaseError):
+                flush_last_seen()
+            self.assertEqual(flush_last_seen(), 1)
+        self.alice.refresh_from_db()
+        self.assertIsNotNone(self.alice.last_seen)
+
+    @mock.patch("chat_app.cache.get_presence")
+    def test_profile_reads_presence(self, get_presence):
+        get_presence.return_value.online_user_ids.return_value = set()
+        self.client.force_login(self.alice)
+        with mock.patch("chat_app.cache.online_users", TTLCache(1, 10)):
+            self.assertFalse(self.client.get(reverse("profile")).context["is_online"])
+        get_presence.return_value.online_user_ids.return_value = {self.alice.id}
+        with mock.patch("chat_app.cache.online_users", TTLCache(1, 10)):
+            self.assertTrue(self.client.get(reverse("profile")).context["is_online"])
+
+    @mock.patch("chat_app.cache.get_presence")
+    def test_navbar_reads_presence(self, get_presence):
+        get_presence.return_value.online_user_ids.return_value = set()
+        self.client.force_login(self.alice)
+        with mock.patch("chat_app.cache.online_users", TTLCache(1, 10)):
+            response = self.client.get(reverse("chat-home"))
+        self.assertFalse(response.context["user_is_online"])
+        get_presence.return_value.online_user_ids.return_value = {self.alice.id}
+        with mock.patch("chat_app.cache.online_users", TTLCache(1, 10)):
+            response = self.client.get(reverse("chat-home"))
+        self.assertTrue(response.context["user_is_online"])
+
+
+@skipUnless(fakeredis, "fakeredis is not installed")
+class RedisPresenceTest(ChatTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice, cls.bob = [
+            User.objects.create_user(
+                username=name, email=f"{name}@example.com", password="secret"
+            )
+            for name in ("alice", "bob")
+        ]
+
+    def setUp(self):
+        fake_redis(self, "chat_app.presence")
+        self.presence = RedisPresence(ttl=90)
+
+    def test_connections_are_counted_across_sockets(self):
+        async def scenario():
+            presence, alice = self.presence, self.alice.id
+            self.assertTrue(await presence.connect(alice, "a"))
+            self.assertFalse(await presence.connect(alice, "b"))
+            counts = [await presence.connection_count(alice)]
+            self.assertFalse(await presence.disconnect(alice, "a"))
+            counts.append(await presence.connection_count(alice))
+            self.assertEqual(await presence.are_online([alice, self.bob.id]), {alice})
+            self.assertTrue(await presence.disconnect(alice, "b"))
+            counts.append(await presence.connection_count(alice))
+            return counts
+
+        self.assertEqual(async_to_sync(scenario)(), [2, 1, 0])
+        self.assertEqual(self.presence.online_user_ids(), set())
+
+    def test_last_seen_is_flushed_for_disconnected_and_expired_users(self):
+        now = time.time()
+        async_to_sync(self.presence.connect)(self.alice.id, "a")
+        async_to_sync(self.presence.disconnect)(self.alice.id, "a")
+        # Bob's worker died: his connection expired without a disconnect
+        with mock.patch("chat_app.presence.time.time", return_value=now - 100):
+            async_to_sync(self.presence.connect)(self.bob.id, "b")
+
+        with mock.patch("chat_app.presence._presence", self.presence):
+            with mock.patch.object(
+                User.objects, "bulk_update", side_effect=DatabaseError("down")
+            ), self.assertRaises(DatabaseError):
+                flush_last_seen()
+            self.assertEqual(flush_last_seen(), 2)
+            self.assertEqual(flush_last_seen(), 0)
+
+        self.alice.refresh_from_db()
+        self.bob.refresh_from_db()
+        self.assertAlmostEqual(self.alice.last_seen.timestamp(), now, delta=5)
+        self.assertAlmostEqual(self.bob.last_seen.timestamp(), now - 100, delta=5)
+
+    def test_reconnected_users_stay_online(self):
+        now = time.time()
+        with mock.patch("chat_app.presence.time.time", return_value=now - 100):
+            async_to_sync(self.presence.connect)(self.alice.id, "a")
+        async_to_sync(self.presence.connect)(self.alice.id, "b")
+        self.assertEqual(self.presence.pop_last_seen(), {})
+        self.assertEqual(self.presence.online_user_ids(), {self.alice.id})
+
+
+@override_settings(
+    CHANNEL_LAYERS=IN_MEMORY_LAYERS,
+    CHAT_PRESENCE={"BATCH_INTERVAL": 0.05},
+)
+class ScopedPresenceTest(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch("chat_app.consumers.get_presence", return_value=LocalPresence(90))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.alice, self.bob, self.carol = [
+            User(id=user_id, username=name)
+            for user_id, name in enumerate(("alice", "bob", "carol"), start=1)
+        ]
+
+    async def open(self, user, session_auth=True):
+        communicator = WebsocketCommunicator(OnlineStatusConsumer.as_asgi(), "/ws/online/")
+        communicator.scope["user"] = user
+        communicator.scope["session_auth"] = session_auth
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        if session_auth:
+            # Every socket the session logged in first gets its reconnect ticket
+            ticket = await communicator.receive_json_from()
+            self.assertEqual(read_ticket(ticket["ticket"])[0], user.id)
+        return communicator
+
+    def test_ticket_sockets_get_no_new_ticket(self):
+        async def scenario():
+            alice = await self.open(self.alice, session_auth=False)
+            nothing = await alice.receive_nothing(0.1)
+            await alice.disconnect()
+            return nothing
+
+        self.assertTrue(async_to_sync(scenario)())
+
+    def test_only_watchers_get_batched_diffs(self):
+        async def scenario():
+            alice = await self.open(self.alice)
+            await alice.send_json_to({"type": "watch", "user_ids": [2]})
+            snapshot = await alice.receive_json_from()
+
+            bob = await self.open(self.bob)
+            carol = await self.open(self.carol)
+            came_online = await alice.receive_json_from()
+            # Carol is not watched and nobody watches Alice
+            self.assertTrue(await alice.receive_nothing(0.1))
+            self.assertTrue(await carol.receive_nothing(0.1))
+
+            await bob.disconnect()
+            went_offline = await alice.receive_json_from()
+            await alice.disconnect()
+            await carol.disconnect()
+            return snapshot, came_online, went_offline
+
+        snapshot, came_online, went_offline = asyncio.run(scenario())
+        self.assertEqual(snapshot, {"type": "presence", "online": [], "offline": [2]})
+        self.assertEqual(came_online, {"type": "presence", "online": [2], "offline": []})
+        self.assertEqual(went_offline, {"type": "presence", "online": [], "offline": [2]})
+
+
+    def test_malformed_watch_lists_are_ignored(self):
+        async def scenario():
+            alice = await self.open(self.alice)
+            await alice.send_json_to({"type": "watch", "user_ids": "2"})
+            await alice.send_json_to(
+                {"type": "watch", "user_ids": ["x", None, [3], float("inf"), -1, "2"]}
+            )
+            snapshot = await alice.receive_json_from()
+            await alice.disconnect()
+            return snapshot
+
+        self.assertEqual(
+            asyncio.run(scenario()), {"type": "presence", "online": [], "offline": [2]}
+        )
+        self.assertEqual(parse_user_ids(list(range(1, 10)), 3), {1, 2, 3})
+
+
+class TypingAggregatorTest(SimpleTestCase):
+    @mock.patch("chat_app.typing_indicators.get_channel_layer")
+    def test_bursts_are_coalesced_into_one_set(self, get_channel_layer):
+        layer = get_channel_layer.return_value
+        layer.group_send = mock.AsyncMock()
+        aggregator = TypingAggregator(flush_interval=0.01, refresh_interval=10, ttl=5)
+
+        async def burst():
+            for _ in range(5):
+                aggregator.update("chat_1", 1, "alice", True)
+                aggregator.update("chat_1", 2, "bob", True)
+            await asyncio.sleep(0.05)
+            aggregator.update("chat_1", 1, "alice", False)
+            aggregator.update("chat_1", 2, "bob", False)
+            await asyncio.sleep(0.05)
+
+        asyncio.run(burst())
+
+        sets = [call.args[1]["typing"] for call in layer.group_send.await_args_list]
+        self.assertEqual(sets, [[[1, "alice"], [2, "bob"]], []])
+        self.assertNotIn("chat_1", aggregator.rooms)
+
+
+class OutboundQueueTest(SimpleTestCase):
+    def run_queue(self, frames, **options):
+        """Queue frames for a client that reads nothing until they are all queued"""
+        sent, closed = [], []
+        reading = None
+
+        async def send(frame):
+            await reading.wait()
+            sent.append(frame)
+
+        async def close(code):
+            closed.append(code)
+
+        async def scenario():
+            nonlocal reading
+            reading = asyncio.Event()
+            queue = OutboundQueue(send, close, lambda last: ("resync", last), **options)
+            queue.start()
+            for frame_type, event in frames:
+                queue.put(frame_type, (frame_type, event.get("message_id")), event)
+                await asyncio.sleep(0)
+            reading.set()
+            await asyncio.sleep(0.01)
+            queue.stop()
+
+        asyncio.run(scenario())
+        return sent, closed
+
+    def test_state_frames_are_coalesced(self):
+        typing = [("typing", {"user_id": 1, "is_typing": i % 2}) for i in range(10)]
+        sent, closed = self.run_queue(typing + [("message", {"message_id": 1})])
+        # The first frame was already being written when the rest came in
+        self.assertEqual(sent, [("typing", None), ("typing", None), ("message", 1)])
+        self.assertEqual(closed, [])
+
+    def test_overflow_replaces_messages_with_a_resync(self):
+        messages = [("message", {"message_id": i}) for i in range(1, 21)]
+        sent, closed = self.run_queue(messages, high_water=5, low_water=2)
+        # Message 1 went out, 2-6 filled the queue, the rest is fetched later
+        self.assertEqual(sent, [("message", 1), ("resync", 1)])
+        self.assertEqual(closed, [])
+
+    def test_disconnect_policy_closes_slow_sockets(self):
+        messages = [("message", {"message_id": i}) for i in range(1, 21)]
+        sent, closed = self.run_queue(messages, high_water=5, on_overflow="disconnect")
+        self.assertEqual(closed, [4008])
+        self.assertEqual(sent, [("message", 1)])
+
+
+class MetricsTest(ChatTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user(
+            username="alice", email="alice@example.com", password="secret"
+        )
+        cls.admin = User.objects.create_user(
+            username="admin", email="admin@example.com", password="secret", is_staff=True
+        )
+
+    def setUp(self):
+        for metric in metrics.registry:
+            metric.clear()
+
+    def test_disabled_metrics_record_nothing(self):
+        metrics.messages_total.inc()
+        with metrics.consumer_seconds.time("save_message"):
+            pass
+        self.assertFalse(metrics.messages_total._values)
+        self.assertFalse(metrics.consumer_seconds._values)
+        self.client.force_login(self.admin)
+        self.assertEqual(self.client.get(reverse("metrics")).status_code, 404)
+
+    @mock.patch("chat_app.metrics.enabled", True)
+    def test_requests_are_timed_and_exposed(self):
+        self.client.force_login(self.alice)
+        self.client.get(reverse("chat-home"))
+        self.assertEqual(self.client.get(reverse("metrics")).status_code, 403)
+
+        self.client.force_login(self.admin)
+        body = self.client.get(reverse("metrics")).content.decode()
+        self.assertIn("# TYPE chat_http_request_seconds histogram", body)
+        home = f'worker="{WORKER_ID}",view="chat-home",method="GET",status="200"'
+        self.assertIn(f'chat_http_request_seconds_count{{{home}}} 1', body)
+        self.assertIn(f'chat_http_request_seconds_bucket{{{home},le="+Inf"}} 1', body)
+        self.assertIn('chat_http_request_queries_count{', body)
+
+    @mock.patch("chat_app.metrics.enabled", True)
+    def test_scrapers_authenticate_with_the_token(self):
+        with override_settings(CHAT_METRICS={"TOKEN": "s3cret"}):
+            url = reverse("metrics")
+            self.assertEqual(self.client.get(url).status_code, 403)
+            response = self.client.get(url, HTTP_AUTHORIZATION="Bearer s3cret")
+        self.assertEqual(response.status_code, 200)
+
+    @mock.patch("chat_app.metrics.enabled", True)
+    def test_histogram_buckets_are_cumulative(self):
+        for value in (0, 1, 2, 7):
+            metrics.message_queries.observe(value)
+        lines = "\n".join(metrics.message_queries.render())
+        self.assertIn('le="1"} 2', lines)
+        self.assertIn('le="5"} 3', lines)
+        self.assertIn('le="+Inf"} 4', lines)
+        self.assertIn("chat_message_queries_sum", lines)
+
+
+class LoadTestCommandTest(TransactionTestCase):
+    def test_reports_websocket_and_http_results(self):
+        out = StringIO()
+        call_command(
+            "loadtest",
+            "--current-db",
+            "--clients=6",
+            "--rooms=2",
+            "--messages=10",
+            "--rate=0",
+            "--http-requests=2",
+            "--settle=0.05",
+            "--json",
+            stdout=out,
+        )
+        results = json.loads(out.getvalue())
+        websocket = results["websocket"]
+        self.assertEqual(websocket["connected"], 6)
+        # Every message reaches the 3 sockets of its room
+        self.assertEqual((websocket["deliveries"], websocket["deliveries_lost"]), (30, 0))
+        self.assertIsNotNone(websocket["latency"]["p99_ms"])
+        self.assertGreater(websocket["queries_per_message"], 0)
+        self.assertEqual(results["http"]["chat_home"]["status"], [200])
+        # The fixtures are removed again
+        self.assertFalse(User.objects.exists())
+
+
+class ClientFrameTest(SimpleTestCase):
+    def test_binary_frames_decode_to_named_fields(self):
+        for codec in (MSGPACK, CBOR):
+            self.assertEqual(
+                codec.decode(bytes_data=codec._dumps([3, 42])),
+                {"type": "read", "message_id": 42},
+            )
+
+    def test_malformed_frames_raise_decode_error(self):
+        for codec in (MSGPACK, CBOR):
+            for frame in (b"", b"\xc1", codec._dumps(7), codec._dumps([])):
+                with self.subTest(codec=codec.name, frame=frame):
+                    with self.assertRaises(DecodeError):
+                        codec.decode(bytes_data=frame)
+            for values in ([99, 1], [[1], 1], [1]):
+                with self.subTest(codec=codec.name, values=values):
+                    with self.assertRaises(DecodeError):
+                        codec.decode(bytes_data=codec._dumps(values))
+        for text in ("{", "[1]", '"message"'):
+            with self.subTest(text=text), self.assertRaises(DecodeError):
+                JSON.decode(text_data=text)
+
+
+class GroupEventTest(SimpleTestCase):
+    def test_only_the_json_frame_travels_with_the_event(self):
+        event = new_event(
+            "chat_message",
+            message="hi",
+            sender_id=42,
+            sender_username="someone",
+            timestamp="2025-01-01T12:00:00+00:00",
+            message_id=1000,
+            seq=1,
+        )
+        self.assertEqual(list(event["frames"]), ["json"])
+        self.assertIs(event_frame(JSON, "message", event), event["frames"]["json"])
+
+        hits = frame_cache.hits
+        frames = [event_frame(MSGPACK, "message", event) for _ in range(3)]
+        # Encoded by the first recipient on the worker, reused by the others
+        self.assertEqual(frame_cache.hits - hits, 2)
+        self.assertEqual(
+            MSGPACK._loads(frames[0]),
+            [1, 1000, 42, "someone", 1735732800000, "hi", 1],
+        )
+        self.assertEqual(CBOR._loads(event_frame(CBOR, "message", event))[0], 1)
+
+
+@tag("benchmark")
+@skipUnless(os.environ.get("CHAT_BENCHMARKS"), "set CHAT_BENCHMARKS=1 to run")
+class FanOutSerializationBenchmark(SimpleTestCase):
+    """Serialization cost per recipient of one group event
+
+    Run alone with: CHAT_BENCHMARKS=1 python manage.py test chat_app --tag=benchmark
+    """
+
+    RECIPIENTS = 5000
+
+    def setUp(self):
+        self.event = new_event(
+            "chat_message",
+            message="Hello everyone, this is a fairly typical chat message.",
+            sender_id=42,
+            sender_username="someone",
+            timestamp="2025-01-01T12:00:00+00:00",
+            message_id=1000,
+            seq=1,
+        )
+
+    def per_recipient(self, send):
+        start = time.perf_counter()
+        for _ in range(self.RECIPIENTS):
+            send(self.event)
+        return (time.perf_counter() - start) / self.RECIPIENTS * 1e6
+
+    def test_preencoded_frames_are_cheaper_than_dumps_per_recipient(self):
+        def rebuild_and_dump(event):
+            # What every recipient used to do in chat_message
+            return json.dumps(
+                {
+                    "type": "message",
+                    "message": event["message"],
+                    "sender_id": event["sender_id"],
+                    "sender_username": event["sender_username"],
+                    "timestamp": event["timestamp"],
+                    "message_id": event["message_id"],
+                    "seq": event["seq"],
+                }
+            )
+
+        before = self.per_recipient(rebuild_and_dump)
+        after = self.per_recipient(lambda event: event_frame(JSON, "message", event))
+        binary = self.per_recipient(lambda event: event_frame(MSGPACK, "message", event))
+        print(
+            f"\nper recipient: json.dumps {before:.2f}us, "
+            f"pre-encoded json {after:.2f}us, pre-encoded msgpack {binary:.2f}us"
+        )
+
+        self.assertEqual(
+            json.loads(event_frame(JSON, "message", self.event)),
+            json.loads(rebuild_and_dump(self.event)),
+        )
+        self.assertLess(after, before)
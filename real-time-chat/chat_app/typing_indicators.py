@@ -0,0 +1,87 @@
+# chat_app/typing_indicators.py
+import asyncio
+import logging
+import time
+
+from channels.layers import get_channel_layer
+
+from .conf import WORKER_ID, chat_settings
+from .protocol import new_event
+
+logger = logging.getLogger(__name__)
+
+class TypingAggregator:
+    """Coalesces the typing state of this worker's sockets, per room
+
+    Instead of one group event per keystroke burst, each worker sends a
+    ``typing_set`` event with everyone typing in the room through it, at
+    most once per ``flush_interval``. Clients merge the sets by origin.
+    """
+
+    def __init__(self, flush_interval, refresh_interval, ttl):
+        self.flush_interval = flush_interval
+        self.refresh_interval = refresh_interval
+        self.ttl = ttl
+        # room group -> {user_id: (username, expires_at)}
+        self.rooms = {}
+        # room group -> (due, task) of its next flush
+        self._scheduled = {}
+
+    def update(self, group, user_id, username, is_typing):
+        typers = self.rooms.setdefault(group, {})
+        if is_typing:
+            changed = user_id not in typers
+            typers[user_id] = (username, time.monotonic() + self.ttl)
+        else:
+            changed = typers.pop(user_id, None) is not None
+
+        if changed:
+            self._schedule(group, self.flush_interval)
+
+    def _schedule(self, group, delay):
+        due = time.monotonic() + delay
+        scheduled = self._scheduled.get(group)
+        if scheduled is not None:
+            if scheduled[0] <= due:
+                # A flush is already due at least as soon as this one
+                return
+            # e.g. a pending refresh, while a change should go out now
+            scheduled[1].cancel()
+        task = asyncio.get_running_loop().create_task(self._flush_later(group, delay))
+        self._scheduled[group] = (due, task)
+
+    async def _flush_later(self, group, delay):
+        await asyncio.sleep(delay)
+        self._scheduled.pop(group, None)
+
+        now = time.monotonic()
+        typers = {
+            user_id: entry
+            for user_id, entry in self.rooms.get(group, {}).items()
+            if entry[1] > now
+        }
+        if typers:
+            self.rooms[group] = typers
+            # Keep the set alive on clients while anyone is typing
+            self._schedule(group, self.refresh_interval)
+        else:
+            self.rooms.pop(group, None)
+
+        event = new_event(
+            "typing_set",
+            origin=WORKER_ID,
+            typing=[[user_id, username] for user_id, (username, _) in typers.items()],
+        )
+        try:
+            await get_channel_layer().group_send(group, event)
+        except Exception:
+            logger.exception("Sending the typing set of %s failed", group)
+
+
+_config = chat_settings("CHAT_TYPING")
+
+typing_aggregator = TypingAggregator(
+    flush_interval=_config["FLUSH_INTERVAL"],
+    refresh_interval=_config["REFRESH_INTERVAL"],
+    ttl=_config["TTL"],
+)
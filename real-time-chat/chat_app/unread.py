@@ -0,0 +1,371 @@
+# chat_app/unread.py
+import asyncio
+import logging
+import threading
+
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+
+from .cache import aget_room_member_ids
+from .conf import chat_settings
+from .models import ChatRoom, Message, ReadState
+from .redis_client import get_async_redis, get_redis
+
+logger = logging.getLogger(__name__)
+
+# Hash field set once a user's checkpoint has been added to their counters
+LOADED = "loaded"
+
+# KEYS: user's unread hash
+# ARGV: room id, count pairs from the user's checkpoint
+LOAD_SCRIPT = """
+if redis.call('HSETNX', KEYS[1], 'loaded', 1) == 1 then
+    for i = 1, #ARGV, 2 do
+        redis.call('HINCRBY', KEYS[1], ARGV[i], ARGV[i + 1])
+    end
+end
+return redis.call('HGETALL', KEYS[1])
+"""
+
+# KEYS: user's unread hash, dirty set
+# ARGV: room id, count, user id, key ttl
+SET_SCRIPT = """
+if redis.call('HEXISTS', KEYS[1], 'loaded') == 0 then
+    return 0
+end
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+redis.call('SADD', KEYS[2], ARGV[3])
+return 1
+"""
+
+
+def stored_counts(user_id):
+    """A user's last checkpointed unread counts as (room id, count) pairs"""
+    return list(
+        ReadState.objects.filter(user_id=user_id, unread_checkpoint__gt=0).values_list(
+            "room_id", "unread_checkpoint"
+        )
+    )
+
+
+def _flat(pairs):
+    return [value for pair in pairs for value in pair]
+
+
+def _parse(fields):
+    return {
+        int(room_id): int(count)
+        for room_id, count in fields.items()
+        if room_id != LOADED.encode()
+    }
+
+
+class RedisUnread:
+    """Unread message counts per user and room, in ``unread:{user}`` hashes
+
+    New messages increment the counters of the room's other members, a
+    read sets the reader's counter to what is left. Users whose counters
+    changed are collected in a set and checkpointed to ReadState by
+    ``checkpoint_unread``. A hash that is lost or expired is rebuilt from
+    the checkpoint on its next read: increments that happened meanwhile
+    are added to it.
+    """
+
+    DIRTY_KEY = "unread:dirty"
+
+    def __init__(self, ttl, url=None):
+        self.ttl = ttl
+        self.url = url
+
+    def _key(self, user_id):
+        return f"unread:{user_id}"
+
+    async def increment(self, room_id, user_ids):
+        client = get_async_redis(self.url)
+        async with client.pipeline(transaction=False) as pipe:
+            for user_id in user_ids:
+                pipe.hincrby(self._key(user_id), room_id, 1)
+                pipe.expire(self._key(user_id), self.ttl)
+            pipe.sadd(self.DIRTY_KEY, *user_ids)
+            await pipe.execute()
+
+    def counts(self, user_id):
+        """Unread counts by room id, including rooms at zero"""
+        client = get_redis(self.url)
+        fields = client.hgetall(self._key(user_id))
+        if LOADED.encode() not in fields:
+            reply = client.eval(
+                LOAD_SCRIPT, 1, self._key(user_id), *_flat(stored_counts(user_id))
+            )
+            fields = dict(zip(reply[::2], reply[1::2]))
+        return _parse(fields)
+
+    async def acounts(self, user_id):
+        client = get_async_redis(self.url)
+        fields = await client.hgetall(self._key(user_id))
+        if LOADED.encode() not in fields:
+            stored = await database_sync_to_async(stored_counts)(user_id)
+            reply = await client.eval(
+                LOAD_SCRIPT, 1, self._key(user_id), *_flat(stored)
+            )
+            fields = dict(zip(reply[::2], reply[1::2]))
+        return _parse(fields)
+
+    def _set_args(self, user_id, room_id, count):
+        keys = (self._key(user_id), self.DIRTY_KEY)
+        return (SET_SCRIPT, 2, *keys, room_id, count, user_id, self.ttl)
+
+    def set(self, user_id, room_id, count):
+        client = get_redis(self.url)
+        if not client.eval(*self._set_args(user_id, room_id, count)):
+            # Load the checkpoint first, or it would be added on top later
+            self.counts(user_id)
+            client.eval(*self._set_args(user_id, room_id, count))
+
+    async def aset(self, user_id, room_id, count):
+        client = get_async_redis(self.url)
+        if not await client.eval(*self._set_args(user_id, room_id, count)):
+            await self.acounts(user_id)
+            await client.eval(*self._set_args(user_id, room_id, count))
+
+    def pop_dirty(self):
+        """Take the ids of the users whose counters changed"""
+        with get_redis(self.url).pipeline() as pipe:
+            pipe.smembers(self.DIRTY_KEY)
+            pipe.delete(self.DIRTY_KEY)
+            user_ids = pipe.execute()[0]
+        return {int(user_id) for user_id in user_ids}
+
+    def add_dirty(self, user_ids):
+        if user_ids:
+            get_redis(self.url).sadd(self.DIRTY_KEY, *user_ids)
+
+
+class LocalUnread:
+    """In-process counters with the same semantics, for development and tests"""
+
+    def __init__(self):
+        self._counts = {}
+        self._loaded = set()
+        self._dirty = set()
+        self._lock = threading.Lock()
+
+    def _load(self, user_id, stored):
+        with self._lock:
+            if user_id not in self._loaded:
+                self._loaded.add(user_id)
+                rooms = self._counts.setdefault(user_id, {})
+                for room_id, count in stored:
+                    rooms[room_id] = rooms.get(room_id, 0) + count
+            return dict(self._counts[user_id])
+
+    async def increment(self, room_id, user_ids):
+        with self._lock:
+            for user_id in user_ids:
+                rooms = self._counts.setdefault(user_id, {})
+                rooms[room_id] = rooms.get(room_id, 0) + 1
+            self._dirty.update(user_ids)
+
+    def counts(self, user_id):
+        if user_id in self._loaded:
+            with self._lock:
+                return dict(self._counts[user_id])
+        return self._load(user_id, stored_counts(user_id))
+
+    async def acounts(self, user_id):
+        if user_id in self._loaded:
+            return self.counts(user_id)
+        stored = await database_sync_to_async(stored_counts)(user_id)
+        return self._load(user_id, stored)
+
+    def set(self, user_id, room_id, count):
+        self.counts(user_id)
+        with self._lock:
+            self._counts[user_id][room_id] = count
+            self._dirty.add(user_id)
+
+    async def aset(self, user_id, room_id, count):
+        await self.acounts(user_id)
+        with self._lock:
+            self._counts[user_id][room_id] = count
+            self._dirty.add(user_id)
+
+    def pop_dirty(self):
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+        return dirty
+
+    def add_dirty(self, user_ids):
+        with self._lock:
+            self._dirty.update(user_ids)
+
+
+def inbox_group(user_id):
+    """Channel layer group of a user's sockets that show unread counts"""
+    return f"inbox_{user_id}"
+
+
+_unread = None
+
+
+def get_unread():
+    """Return the configured unread counter backend"""
+    global _unread
+    if _unread is None:
+        config = chat_settings("CHAT_UNREAD")
+        if config["BACKEND"] == "redis":
+            _unread = RedisUnread(config["TTL"], config["REDIS_URL"])
+        else:
+            _unread = LocalUnread()
+    return _unread
+
+
+# Counting
+
+
+class UnreadNotifier:
+    """Pushes changed unread counts to their users' sockets, batched
+
+    A busy room would otherwise send every member a frame per message; this
+    sends each user at most one ``unread`` frame per ``interval``, with the
+    current counts of the rooms that changed.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        # user id -> room ids whose count changed
+        self.pending = {}
+        self._task = None
+
+    def changed(self, room_id, user_ids):
+        for user_id in user_ids:
+            self.pending.setdefault(user_id, set()).add(room_id)
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.interval)
+        # Changes from here on schedule the next flush
+        self._task = None
+        pending, self.pending = self.pending, {}
+        for user_id, room_ids in pending.items():
+            try:
+                counts = await get_unread().acounts(user_id)
+                rooms = [[room, counts.get(room, 0)] for room in sorted(room_ids)]
+                await push_unread(user_id, rooms)
+            except Exception:
+                logger.exception("Pushing unread counts to user %s failed", user_id)
+
+
+unread_notifier = UnreadNotifier(chat_settings("CHAT_UNREAD")["PUSH_INTERVAL"])
+
+
+async def push_unread(user_id, rooms):
+    await get_channel_layer().group_send(
+        inbox_group(user_id), {"type": "unread_counts", "rooms": rooms}
+    )
+
+
+async def count_unread(room_id, sender_id):
+    """Count a new message as unread for the room's other members"""
+    room_id = int(room_id)
+    user_ids = await aget_room_member_ids(room_id) - {int(sender_id)}
+    if user_ids:
+        await get_unread().increment(room_id, user_ids)
+        unread_notifier.changed(room_id, user_ids)
+
+
+def _left_unread(user_id, room_id, message_id):
+    return Message.objects.filter(room_id=room_id, id__gt=message_id).exclude(
+        sender_id=user_id
+    )
+
+
+def _last_message_id(room_id):
+    return ChatRoom.objects.filter(id=room_id).values_list("last_message_id", flat=True)
+
+
+def mark_read(user_id, room_id, message_id):
+    """Set the user's counter after their watermark moved to message_id
+
+    Reading the newest message, the usual case, costs one query for the
+    room's last message id; otherwise what is left is counted. The user's
+    sockets are sent the new count.
+    """
+    room_id = int(room_id)
+    last = _last_message_id(room_id).first()
+    count = 0
+    if last is not None and message_id < last:
+        count = _left_unread(user_id, room_id, message_id).count()
+    get_unread().set(user_id, room_id, count)
+    async_to_sync(push_unread)(user_id, [[room_id, count]])
+    return count
+
+
+async def amark_read(user_id, room_id, message_id):
+    """Async variant of mark_read"""
+    room_id = int(room_id)
+    last = await _last_message_id(room_id).afirst()
+    count = 0
+    if last is not None and message_id < last:
+        count = await _left_unread(user_id, room_id, message_id).acount()
+    await get_unread().aset(user_id, room_id, count)
+    await push_unread(user_id, [[room_id, count]])
+    return count
+
+
+# Checkpointing
+
+
+def checkpoint_unread():
+    """Write the counters of users that changed to ReadState in one batch"""
+    unread = get_unread()
+    user_ids = unread.pop_dirty()
+    if not user_ids:
+        return 0
+
+    try:
+        counts = {user_id: unread.counts(user_id) for user_id in user_ids}
+        # Rooms deleted meanwhile would fail the whole batch
+        room_ids = {room_id for rooms in counts.values() for room_id in rooms}
+        existing = set(
+            ChatRoom.objects.filter(id__in=room_ids).values_list("id", flat=True)
+        )
+        ReadState.objects.bulk_create(
+            [
+                ReadState(user_id=user_id, room_id=room_id, unread_checkpoint=count)
+                for user_id, rooms in counts.items()
+                for room_id, count in rooms.items()
+                if room_id in existing
+            ],
+            batch_size=500,
+            update_conflicts=True,
+            unique_fields=["user", "room"],
+            update_fields=["unread_checkpoint"],
+        )
+    except Exception:
+        unread.add_dirty(user_ids)
+        raise
+    return len(user_ids)
+
+
+_checkpointer = None
+
+
+def ensure_unread_checkpointer():
+    """Start this worker's periodic checkpoint writer if it is not running"""
+    global _checkpointer
+    if _checkpointer is None or _checkpointer.done():
+        _checkpointer = asyncio.get_running_loop().create_task(_checkpoint_loop())
+
+
+async def _checkpoint_loop():
+    interval = chat_settings("CHAT_UNREAD")["CHECKPOINT_INTERVAL"]
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await database_sync_to_async(checkpoint_unread)()
+        except Exception:
+            logger.exception("Checkpointing unread counts failed")
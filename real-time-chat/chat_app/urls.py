@@ -9,8 +9,12 @@ urlpatterns = [
     path("join/<int:room_id>/", views.join_room, name="join-room"),
     path("leave/<int:room_id>/", views.leave_room, name="leave-room"),
     path("api/messages/<int:room_id>/", views.get_messages, name="get-messages"),
+    path("api/search/", views.search_messages, name="search-messages"),
     path(
         "api/messages/<int:message_id>/read/", views.mark_message_read, name="mark-read"
     ),
+    path("api/rooms/<int:room_id>/read/", views.mark_room_read, name="mark-room-read"),
+    path("api/inbox/", views.inbox, name="inbox"),
     path("api/online-users/", views.get_online_users, name="online-users"),
+    path("metrics/", views.metrics_view, name="metrics"),
 ]
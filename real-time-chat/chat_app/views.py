@@ -1,14 +1,38 @@
+import json
+
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth import get_user_model
 from django.views.generic import CreateView, ListView, DetailView
-from django.urls import reverse_lazy
-from django.http import JsonResponse, HttpResponseForbidden
-from django.db.models import Q, Count, Max
+from django.urls import reverse, reverse_lazy
+from django.http import HttpResponse, Http404, JsonResponse, HttpResponseForbidden
+from django.db.models import Q, Exists, F, OuterRef, Prefetch
 from django.utils import timezone
+from django.utils.crypto import constant_time_compare
+from django.utils.dateparse import parse_datetime
 from django.core.paginator import Paginator
-
-from .models import ChatRoom, Message, DirectMessage, UserStatus
+from django.views.decorators.http import require_POST
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+
+from . import metrics
+from .cache import get_online_user_ids, get_room_member_ids, is_room_member
+from .conf import chat_settings
+from .models import ChatRoom, Message, DirectMessage, ReadState, UserStatus
+from .archive import find_archived, keyset_page_with_archive
+from .history import get_recent_messages
+from .protocol import new_event
+from .pagination import (
+    AFTER,
+    BEFORE,
+    InvalidCursor,
+    decode_cursor,
+    decode_rank_cursor,
+    encode_cursor,
+    encode_rank_cursor,
+)
+from .search import find_messages
+from .unread import get_unread, mark_read
 from .forms import MessageForm, ChatRoomForm, DirectMessageForm
 
 User = get_user_model()
@@ -17,22 +41,60 @@ User = get_user_model()
 @login_required
 def chat_home(request):
     """Main chat dashboard"""
+    # Everything the template needs is annotated or prefetched here, so the
+    # number of queries does not grow with the number of rooms
+    membership = ChatRoom.participants.through.objects.filter(
+        chatroom=OuterRef("pk"), user=request.user
+    )
+
+    # Unread counts of the user's rooms, kept by the unread counters
+    unread = get_unread().counts(request.user.id)
+
     # get al public rooms and rooms user is part of
-    public_rooms = (
-        ChatRoom.objects.filter(Q(room_type="public") | Q(participants=request.user))
-        .distinct()
+    public_rooms = list(
+        ChatRoom.objects.exclude(room_type="direct")
+        .annotate(is_member=Exists(membership))
+        .filter(Q(room_type="public") | Q(is_member=True))
         .order_by("-created_at")
     )
 
-    # get direct message groups
+    # get the user's direct message rooms, most recently active first (from
+    # the room's last message summary)
     dm_groups = (
-        ChatRoom.objects.filter(room_type="direct")
-        .order_by("-messages__timestamp")
-        .distinct()
+        ChatRoom.objects.filter(room_type="direct", participants=request.user)
+        .prefetch_related(
+            Prefetch(
+                "participants",
+                queryset=User.objects.exclude(id=request.user.id).only(
+                    "id", "username"
+                ),
+                to_attr="peers",
+            )
+        )
+        .order_by(F("last_message_at").desc(nulls_last=True), "-created_at")
     )
 
     # get online users
-    online_users = User.objects.filter(is_online=True).exclude(id=request.user.id)
+    online_ids = get_online_user_ids()
+    online_users = list(
+        User.objects.filter(id__in=online_ids)
+        .exclude(id=request.user.id)
+        .only("id", "username")
+    )
+
+    for room in public_rooms:
+        room.unread_count = unread.get(room.id, 0) if room.is_member else 0
+
+    dm_room_ids = {}
+    for room in dm_groups:
+        room.unread_count = unread.get(room.id, 0)
+        for peer in room.peers:
+            peer.is_online = peer.id in online_ids
+            dm_room_ids[peer.id] = room.id
+
+    # Online users the user already has a DM with link straight to it
+    for online_user in online_users:
+        online_user.dm_room_id = dm_room_ids.get(online_user.id)
 
     # get user's status
     user_status, created = UserStatus.objects.get_or_create(user=request.user)
@@ -42,6 +104,8 @@ def chat_home(request):
         "dm_groups": dm_groups,
         "online_users": online_users,
         "user_status": user_status,
+        "room_count": request.user.room_count,
+        "message_count": request.user.message_count,
         "dm_form": DirectMessageForm(user=request.user),
         "room_form": ChatRoomForm(user=request.user),
     }
@@ -55,14 +119,18 @@ def chat_room(request, room_id):
     room = get_object_or_404(ChatRoom, id=room_id)
 
     # check if user can access this room
-    if room.room_type == "private" and request.user not in room.participants.all():
+    is_member = is_room_member(room.id, request.user.id)
+    if room.room_type == "private" and not is_member:
         return HttpResponseForbidden("You are not allowed to access this room")
 
-    # get messages for this room
-    messages = room.messages.all().order_by("timestamp")[:100]
+    # Messages are not rendered into the page; the room socket sends the
+    # newest ones in a history frame when it connects (see history.py)
 
-    # Get participants
-    participants = room.participants.all()
+    # Get participants, with their presence from the presence engine
+    online_ids = get_online_user_ids()
+    participants = list(room.participants.all())
+    for participant in participants:
+        participant.is_online = participant.id in online_ids
 
     # Update user's current room status
     status, created = UserStatus.objects.get_or_create(user=request.user)
@@ -71,8 +139,8 @@ def chat_room(request, room_id):
 
     context = {
         "room": room,
-        "messages": messages,
         "participants": participants,
+        "is_member": is_member,
         "message_form": MessageForm(),
     }
     return render(request, "chat_app/room.html", context)
@@ -100,7 +168,11 @@ def start_direct_message(request):
         if form.is_valid():
             other_user = form.cleaned_data["username"]
             dm = DirectMessage.get_or_create_direct_room(request.user, other_user)
-            return redirect("chat-room", room_id=dm.room.id)
+            # Either user may have left the room since
+            missing = {request.user.id, other_user.id} - get_room_member_ids(dm.room_id)
+            if missing:
+                dm.room.participants.add(*missing)
+            return redirect("chat-room", room_id=dm.room_id)
     else:
         form = DirectMessageForm(user=request.user)
 
@@ -123,32 +195,44 @@ def leave_room(request, room_id):
     return redirect("chat-home")
 
 
+def serialize_message(msg, is_read):
+    return {
+        "id": msg.id,
+        "content": msg.content,
+        "sender": msg.sender.username,
+        "sender_id": msg.sender_id,
+        "timestamp": msg.timestamp.isoformat(),
+        "seq": msg.seq,
+        "is_read": is_read(msg),
+    }
+
+
 @login_required
 def get_messages(request, room_id):
-    """API endpoint to get messages for a room (for pagination)"""
+    """API endpoint to get messages for a room (for pagination)
+
+    Pass ``cursor`` (empty for the newest page), ``before_id`` or
+    ``after_id`` for keyset pagination; ``page`` keeps numbered pages.
+    """
     room = get_object_or_404(ChatRoom, id=room_id)
 
-    if room.room_type == "private" and request.user not in room.participants.all():
+    if room.room_type == "private" and not is_room_member(room.id, request.user.id):
         return JsonResponse({"error": "Access denied"}, status=403)
 
+    messages = room.messages.select_related("sender")
+    is_read = ReadState.read_checker(room.id, get_room_member_ids(room.id))
+
+    if any(key in request.GET for key in ("cursor", "before_id", "after_id")):
+        return get_messages_by_cursor(request, room, messages, is_read)
+
     # Get messages with pagination
     page = request.GET.get("page", 1)
-    messages = room.messages.all().order_by("-timestamp")
+    messages = messages.order_by("-timestamp")
 
     paginator = Paginator(messages, 50)
     page_obj = paginator.get_page(page)
 
-    messages_data = [
-        {
-            "id": msg.id,
-            "content": msg.content,
-            "sender": msg.sender.username,
-            "sender_id": msg.sender.id,
-            "timestamp": msg.timestamp.isoformat(),
-            "is_read": msg.is_read,
-        }
-        for msg in page_obj
-    ]
+    messages_data = [serialize_message(msg, is_read) for msg in page_obj]
 
     return JsonResponse(
         {
@@ -161,31 +245,273 @@ def get_messages(request, room_id):
     )
 
 
+def serialize_recent(item, is_read):
+    """serialize_message for an entry of the recent messages ring buffer"""
+    message = Message(id=item["message_id"], sender_id=item["sender_id"])
+    return {
+        "id": item["message_id"],
+        "content": item["message"],
+        "sender": item["sender_username"],
+        "sender_id": item["sender_id"],
+        "timestamp": item["timestamp"],
+        "seq": item.get("seq"),
+        "is_read": is_read(message),
+    }
+
+
+def get_messages_by_cursor(request, room, messages, is_read):
+    """Keyset pagination: no COUNT(*), every page costs the same"""
+    try:
+        limit = max(1, min(int(request.GET.get("limit", 50)), 100))
+    except ValueError:
+        limit = 50
+
+    direction, timestamp, pk = BEFORE, None, None
+    try:
+        if request.GET.get("cursor"):
+            direction, timestamp, pk = decode_cursor(request.GET["cursor"])
+        elif request.GET.get("before_id") or request.GET.get("after_id"):
+            direction = BEFORE if request.GET.get("before_id") else AFTER
+            pk = int(request.GET.get("before_id") or request.GET["after_id"])
+            timestamp = (
+                messages.filter(id=pk).values_list("timestamp", flat=True).first()
+            )
+            if timestamp is None:
+                archived = find_archived(room.id, pk)
+                if archived is None:
+                    return JsonResponse({"error": "Message not found"}, status=404)
+                timestamp = archived.timestamp
+    except (InvalidCursor, ValueError):
+        return JsonResponse({"error": "Invalid cursor"}, status=400)
+
+    if direction == BEFORE and timestamp is None:
+        # The newest page comes from the ring buffer
+        recent, exhaustive = get_recent_messages(room.id)
+        # Exhaustive only covers the table; older messages may be archived
+        if len(recent) > limit or (
+            exhaustive and not room.archived_batches.exists()
+        ):
+            page = recent[-limit:]
+            next_cursor = None
+            if page and len(recent) > limit:
+                oldest = page[0]
+                next_cursor = encode_cursor(
+                    BEFORE, parse_datetime(oldest["timestamp"]), oldest["message_id"]
+                )
+            return JsonResponse(
+                {
+                    "messages": [serialize_recent(item, is_read) for item in page],
+                    "next_cursor": next_cursor,
+                    "has_more": next_cursor is not None,
+                }
+            )
+
+    page, next_cursor = keyset_page_with_archive(
+        messages, room.id, direction, timestamp, pk, limit
+    )
+
+    return JsonResponse(
+        {
+            "messages": [serialize_message(msg, is_read) for msg in page],
+            "next_cursor": next_cursor,
+            "has_more": next_cursor is not None,
+        }
+    )
+
+
+@login_required
+def search_messages(request):
+    """API endpoint for full-text search in the rooms the user can read
+
+    ``q`` is the search text (websearch syntax on PostgreSQL), ``room``
+    optionally limits it to one room, ``cursor`` continues from a previous
+    page. Results come best match first with highlighted snippets.
+    """
+    text = request.GET.get("q", "").strip()
+    if not text:
+        return JsonResponse({"error": "Missing search text"}, status=400)
+
+    try:
+        limit = max(1, min(int(request.GET.get("limit", 20)), 50))
+        room_id = int(request.GET["room"]) if request.GET.get("room") else None
+        after = (
+            decode_rank_cursor(request.GET["cursor"])
+            if request.GET.get("cursor")
+            else None
+        )
+    except InvalidCursor:
+        return JsonResponse({"error": "Invalid cursor"}, status=400)
+    except ValueError:
+        return JsonResponse({"error": "Invalid parameters"}, status=400)
+
+    results, has_more = find_messages(request.user, text, room_id, after, limit)
+
+    next_cursor = None
+    if has_more:
+        next_cursor = encode_rank_cursor(results[-1].rank, results[-1].id)
+
+    return JsonResponse(
+        {
+            "results": [
+                {
+                    "id": msg.id,
+                    "room_id": msg.room_id,
+                    "room": msg.room.name,
+                    "sender": msg.sender.username,
+                    "sender_id": msg.sender_id,
+                    "timestamp": msg.timestamp.isoformat(),
+                    "rank": msg.rank,
+                    "snippet": msg.snippet,
+                }
+                for msg in results
+            ],
+            "next_cursor": next_cursor,
+            "has_more": has_more,
+        }
+    )
+
+
 @login_required
 def mark_message_read(request, message_id):
-    """Mark a message as read"""
+    """Mark a message (and everything before it in the room) as read"""
     message = get_object_or_404(Message, id=message_id)
 
     # Check if user is in the room
-    if request.user not in message.room.participants.all():
+    if not is_room_member(message.room_id, request.user.id):
         return JsonResponse({"error": "Not in room"}, status=403)
 
-    message.mark_as_read(request.user)
+    if message.mark_as_read(request.user):
+        mark_read(request.user.id, message.room_id, message.id)
+        notify_read(message.room_id, request.user, message.id)
     return JsonResponse({"success": True})
 
 
+@login_required
+@require_POST
+def mark_room_read(request, room_id):
+    """Advance the user's read watermark in a room
+
+    Takes the highest message id the client has seen (``message_id``), so a
+    client can report any number of messages with one request.
+    """
+    if not is_room_member(room_id, request.user.id):
+        return JsonResponse({"error": "Not in room"}, status=403)
+
+    try:
+        payload = json.loads(request.body) if request.body else request.POST
+        message_id = int(payload["message_id"])
+    except (KeyError, TypeError, ValueError):
+        return JsonResponse({"error": "message_id is required"}, status=400)
+
+    message_id = ReadState.clamp(room_id, message_id)
+    if message_id is None:
+        return JsonResponse({"error": "No such message"}, status=400)
+
+    if ReadState.advance(request.user.id, room_id, message_id):
+        mark_read(request.user.id, room_id, message_id)
+        notify_read(room_id, request.user, message_id)
+    return JsonResponse({"success": True, "last_read_message_id": message_id})
+
+
+def notify_read(room_id, user, message_id):
+    """Tell the room's sockets that a user has read up to message_id"""
+    with metrics.group_send_seconds.time("read_receipt"):
+        async_to_sync(get_channel_layer().group_send)(
+            f"chat_{room_id}",
+            new_event(
+                "read_receipt",
+                user_id=user.id,
+                username=user.username,
+                message_id=message_id,
+            ),
+        )
+
+
+@login_required
+def inbox(request):
+    """API endpoint for the user's rooms with their unread counts
+
+    Rooms with unread messages come first, then by their last message.
+    Counts come from the unread counters, not from counting messages.
+    """
+    unread = get_unread().counts(request.user.id)
+    rooms = request.user.chat_rooms.only(
+        "id",
+        "name",
+        "room_type",
+        "last_message_id",
+        "last_message_at",
+        "last_message_preview",
+    )
+
+    def newest_unread_first(room):
+        last_at = room.last_message_at.timestamp() if room.last_message_at else 0
+        return (not unread.get(room.id), -last_at)
+
+    rooms_data = [
+        {
+            "id": room.id,
+            "name": room.name,
+            "room_type": room.room_type,
+            "unread": unread.get(room.id, 0),
+            "last_message_id": room.last_message_id,
+            "last_message_at": room.last_message_at.isoformat()
+            if room.last_message_at
+            else None,
+            "last_message_preview": room.last_message_preview,
+            "url": reverse("chat-room", args=[room.id]),
+        }
+        for room in sorted(rooms, key=newest_unread_first)
+    ]
+
+    return JsonResponse(
+        {
+            "rooms": rooms_data,
+            "total_unread": sum(room["unread"] for room in rooms_data),
+        }
+    )
+
+
 @login_required
 def get_online_users(request):
     """Get list of online users"""
-    online_users = User.objects.filter(is_online=True).exclude(id=request.user.id)
+    online_users = list(
+        User.objects.filter(id__in=get_online_user_ids()).exclude(id=request.user.id)
+    )
+    dm_room_ids = DirectMessage.room_ids_by_peer(
+        request.user, [user.id for user in online_users]
+    )
 
     users_data = [
         {
             "id": user.id,
             "username": user.username,
-            "is_online": user.is_online,
+            "is_online": True,
+            "dm_room_id": dm_room_ids.get(user.id),
         }
         for user in online_users
     ]
 
     return JsonResponse({"online_users": users_data})
+
+
+def metrics_view(request):
+    """This worker's metrics in the Prometheus text format
+
+    Readable by staff, or by a scraper sending
+    ``Authorization: Bearer <CHAT_METRICS["TOKEN"]>``.
+    """
+    if not metrics.enabled:
+        raise Http404("Metrics are disabled")
+
+    token = chat_settings("CHAT_METRICS")["TOKEN"]
+    authorization = request.headers.get("Authorization", "")
+    if not (
+        request.user.is_staff
+        or (token and constant_time_compare(authorization, f"Bearer {token}"))
+    ):
+        return HttpResponseForbidden()
+
+    return HttpResponse(
+        metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8"
+    )
@@ -0,0 +1,143 @@
+# chat_app/ws_auth.py
+from importlib import import_module
+from urllib.parse import parse_qs
+
+from channels.db import database_sync_to_async
+from channels.middleware import BaseMiddleware
+from channels.sessions import CookieMiddleware, SessionMiddleware
+from django.conf import settings
+from django.contrib.auth import (
+    BACKEND_SESSION_KEY,
+    HASH_SESSION_KEY,
+    SESSION_KEY,
+    get_user_model,
+    load_backend,
+)
+from django.contrib.auth.models import AnonymousUser
+from django.core import signing
+from django.utils.crypto import constant_time_compare, salted_hmac
+
+from .cache import ensure_invalidation_listener, users
+from .conf import chat_settings
+
+TICKET_SALT = "chat_app.ws_ticket"
+
+
+def _auth_digest(user):
+    # Tickets are signed, not encrypted, so they carry a digest of the
+    # session auth hash rather than the hash itself
+    return salted_hmac(TICKET_SALT, user.get_session_auth_hash()).hexdigest()
+
+
+def issue_ticket(user):
+    """Sign a ticket that authenticates the user's WebSocket handshakes"""
+    return signing.TimestampSigner(salt=TICKET_SALT).sign_object(
+        [user.id, _auth_digest(user)], compress=True
+    )
+
+
+def read_ticket(ticket):
+    """The user id and auth digest of a valid, unexpired ticket, or None"""
+    max_age = chat_settings("CHAT_WS_AUTH")["TICKET_MAX_AGE"]
+    try:
+        user_id, digest = signing.TimestampSigner(salt=TICKET_SALT).unsign_object(
+            ticket, max_age=max_age
+        )
+    except (signing.BadSignature, ValueError):
+        return None
+    return user_id, digest
+
+
+def _active_user(user_id):
+    user = get_user_model()._default_manager.filter(pk=user_id).first()
+    if user is None or not user.is_active:
+        return None
+    # Shared with session_user, which also only caches active users
+    users.set(user_id, user)
+    return user
+
+
+async def aticket_user(ticket):
+    """The user a valid ticket was issued to, or None
+
+    The user comes from the same per-worker cache as session_user, so a
+    cached user costs no query. Deactivating the user or changing their
+    password drops them from the cache and invalidates their tickets.
+    """
+    claims = read_ticket(ticket)
+    if claims is None:
+        return None
+    user_id, digest = claims
+    ensure_invalidation_listener()
+    user = users.get(user_id)
+    if user is None:
+        user = await database_sync_to_async(_active_user)(user_id)
+    if user is None or not constant_time_compare(digest, _auth_digest(user)):
+        return None
+    return user
+
+
+def session_user(session):
+    """channels.auth.get_user with the user row cached per worker
+
+    The session is still read, so logging out or a flushed session takes
+    effect at once; a password change invalidates the cached user.
+    """
+    try:
+        user_id = get_user_model()._meta.pk.to_python(session[SESSION_KEY])
+        backend_path = session[BACKEND_SESSION_KEY]
+    except KeyError:
+        return AnonymousUser()
+    if backend_path not in settings.AUTHENTICATION_BACKENDS:
+        return AnonymousUser()
+
+    ensure_invalidation_listener()
+    user = users.get(user_id)
+    if user is None:
+        user = load_backend(backend_path).get_user(user_id)
+        if user is None:
+            return AnonymousUser()
+        users.set(user_id, user)
+
+    session_hash = session.get(HASH_SESSION_KEY)
+    if not (
+        session_hash
+        and constant_time_compare(session_hash, user.get_session_auth_hash())
+    ):
+        return AnonymousUser()
+    return user
+
+
+def session_logs_in(session, user):
+    """Whether the stored session behind ``session`` still logs ``user`` in"""
+    if session.session_key is None:
+        return False
+    # scope["session"] is a LazyObject; load a fresh store of the engine
+    store = import_module(settings.SESSION_ENGINE).SessionStore(session.session_key)
+    return session_user(store).id == user.id
+
+
+class WebSocketAuthMiddleware(BaseMiddleware):
+    """Sets scope["user"] from a ``ticket`` query parameter or the session
+
+    A valid ticket for a cached user skips the session and user queries
+    entirely, which is what keeps a reconnect storm after a deploy off the
+    database. scope["session_auth"] tells whether the session logged the
+    user in; only those sockets are handed new tickets.
+    """
+
+    async def __call__(self, scope, receive, send):
+        scope = dict(scope)
+        query = parse_qs(scope.get("query_string", b"").decode())
+        user = await aticket_user(query["ticket"][0]) if "ticket" in query else None
+        scope["session_auth"] = False
+        if user is None:
+            user = await database_sync_to_async(session_user)(scope["session"])
+            scope["session_auth"] = user.is_authenticated
+        scope["user"] = user
+        return await super().__call__(scope, receive, send)
+
+
+def WebSocketAuthMiddlewareStack(inner):
+    """Drop-in for channels.auth.AuthMiddlewareStack"""
+    return CookieMiddleware(SessionMiddleware(WebSocketAuthMiddleware(inner)))
@@ -5,11 +5,14 @@ from django.utils.translation import gettext_lazy as _
 
 class User(AbstractUser):
     email = models.EmailField(_("email address"), unique=True)
-    is_online = models.BooleanField(default=False)
     last_seen = models.DateTimeField(auto_now=True)
     profile_picture = models.ImageField(
         upload_to="profile_pictures/", null=True, blank=True
     )
+    # Kept up to date by chat_app/counters.py; reconcile_counters recounts them
+    message_count = models.PositiveBigIntegerField(default=0, editable=False)
+    room_count = models.PositiveIntegerField(default=0, editable=False)
+    direct_room_count = models.PositiveIntegerField(default=0, editable=False)
 
     USERNAME_FIELD = "email"
     REQUIRED_FIELDS = ["username"]
@@ -5,6 +5,7 @@ from django.contrib.auth.views import LoginView, LogoutView
 from django.views.generic import CreateView
 from django.urls import reverse_lazy
 from django.contrib import messages
+from chat_app.cache import get_online_user_ids
 from .forms import CustomUserCreationForm, CustomAuthenticationForm
 
 
@@ -26,9 +27,7 @@ class CustomLoginView(LoginView):
     template_name = "core/login.html"
 
     def get_success_url(self):
-        # update the user status to online
-        self.request.user.is_online = True
-        self.request.user.save()
+        # Presence is tracked by the WebSocket connections, not on login
         return reverse_lazy("profile")
 
     def form_invalid(self, form):
@@ -37,13 +36,6 @@ class CustomLoginView(LoginView):
 
 
 class CustomLogoutView(LogoutView):
-    def dispatch(self, request, *args, **kwargs):
-        # update the user status to offline
-        if request.user.is_authenticated:
-            request.user.is_online = False
-            request.user.save()
-        return super().dispatch(request, *args, **kwargs)
-
     def get_next_page(self):
         messages.info(self.request, "You have been logged out")
         return reverse_lazy("login")
@@ -52,13 +44,12 @@ class CustomLogoutView(LogoutView):
 @login_required
 def profile_view(request):
     user = request.user
-    # Calculate counts in the view
-    direct_messages_count = user.chat_rooms.filter(room_type="direct").count()
-    # If you have 'group' rooms, you might want this too:
-    group_rooms_count = user.chat_rooms.filter(room_type="group").count()
-
+    # Counts are kept on the user (see chat_app/counters.py)
     context = {
-        "direct_messages_count": direct_messages_count,
-        "group_rooms_count": group_rooms_count,
+        # Presence comes from the user's open sockets (see chat_app/presence.py)
+        "is_online": user.id in get_online_user_ids(),
+        "direct_messages_count": user.direct_room_count,
+        "group_rooms_count": user.room_count - user.direct_room_count,
+        "rooms": user.chat_rooms.all()[:6],
     }
     return render(request, "core/profile.html", context)
@@ -1,21 +1,96 @@
 // static/js/chat_websocket.js
+
+// Compact binary frames (chat.msgpack subprotocol): [tag, ...fields]
+// Needs the msgpack-javascript bundle (window.MessagePack) on the page.
+const SERVER_FRAMES = {
+    1: ['message', ['message_id', 'sender_id', 'sender_username', 'timestamp', 'message', 'seq']],
+    2: ['typing', ['user_id', 'username', 'is_typing']],
+    3: ['user_status', ['user_id', 'username', 'is_online']],
+    4: ['user_online_status', ['user_id', 'username', 'is_online']],
+    5: ['read_receipt', ['user_id', 'username', 'message_id']],
+    6: ['typing_set', ['origin', 'typing']],
+    7: ['history', ['messages', 'read_up_to']],
+    8: ['presence', ['online', 'offline']],
+    9: ['resync', ['last_message_id']],
+    10: ['replay', ['messages', 'read_up_to']],
+    11: ['unread', ['rooms']],
+    12: ['ticket', ['ticket', 'expires_in']],
+    13: ['throttled', ['retry_after']],
+};
+const CLIENT_FRAMES = {
+    message: [1, ['message', 'sender_id']],
+    typing: [2, ['is_typing']],
+    read: [3, ['message_id']],
+    watch: [4, ['user_ids']],
+    unwatch: [5, ['user_ids']],
+};
+
+// Signed ticket from the last socket; reconnecting with it skips the
+// session lookup on the server
+let wsTicket = null;
+
+function rememberTicket(data) {
+    wsTicket = {ticket: data.ticket, expiresAt: Date.now() + data.expires_in * 1000};
+}
+
+function withTicket(url) {
+    if (!wsTicket || wsTicket.expiresAt < Date.now() + 5000) {
+        return url;
+    }
+    const separator = url.includes('?') ? '&' : '?';
+    return `${url}${separator}ticket=${encodeURIComponent(wsTicket.ticket)}`;
+}
+
+function decodeBinaryFrame(buffer) {
+    const [tag, ...values] = window.MessagePack.decode(new Uint8Array(buffer));
+    return binaryFrameData(tag, values);
+}
+
+function binaryFrameData(tag, values) {
+    const [type, fields] = SERVER_FRAMES[tag];
+    const data = {type};
+    fields.forEach((field, i) => data[field] = values[i]);
+    if (type === 'message') {
+        data.timestamp = new Date(data.timestamp).toISOString();
+    } else if (type === 'history' || type === 'replay') {
+        data.messages = data.messages.map(message => binaryFrameData(1, message));
+    }
+    return data;
+}
+
+function encodeBinaryFrame(data) {
+    const [tag, fields] = CLIENT_FRAMES[data.type];
+    return window.MessagePack.encode([tag, ...fields.map(field => data[field])]);
+}
+
 class ChatWebSocket {
-    constructor(roomId, userId) {
+    constructor(roomId, userId, options = {}) {
         this.roomId = roomId;
         this.userId = userId;
+        this.binary = Boolean(options.binary && window.MessagePack);
         this.socket = null;
         this.typingTimeout = null;
         this.typingUsers = new Set();
         this.messageCallbacks = [];
         this.typingCallbacks = [];
         this.statusCallbacks = [];
+        this.resyncCallbacks = [];
+        this.throttledCallbacks = [];
+        // Highest message sequence number seen, to resume from on reconnect
+        this.lastSeq = 0;
     }
 
     connect() {
         const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
-        const url = `${protocol}//${window.location.host}/ws/chat/${this.roomId}/`;
+        let url = `${protocol}//${window.location.host}/ws/chat/${this.roomId}/`;
+        if (this.lastSeq) {
+            // Only the messages after it are sent (a replay frame)
+            url += `?last_seq=${this.lastSeq}`;
+        }
 
-        this.socket = new WebSocket(url);
+        url = withTicket(url);
+        this.socket = this.binary ? new WebSocket(url, ['chat.msgpack']) : new WebSocket(url);
+        this.socket.binaryType = 'arraybuffer';
 
         this.socket.onopen = (e) => {
             console.log('Chat WebSocket connected');
@@ -23,14 +98,15 @@ class ChatWebSocket {
         };
 
         this.socket.onmessage = (e) => {
-            const data = JSON.parse(e.data);
+            const data = typeof e.data === 'string' ? JSON.parse(e.data) : decodeBinaryFrame(e.data);
             this.handleMessage(data);
         };
 
         this.socket.onclose = (e) => {
             console.log('Chat WebSocket disconnected, reconnecting...');
             this.onClose(e);
-            setTimeout(() => this.connect(), 3000);
+            // Jittered, so a restarted server is not hit by every client at once
+            setTimeout(() => this.connect(), 1000 + Math.random() * 4000);
         };
 
         this.socket.onerror = (err) => {
@@ -45,36 +121,58 @@ class ChatWebSocket {
         }
     }
 
-    sendMessage(content) {
+    send(data) {
         if (this.socket && this.socket.readyState === WebSocket.OPEN) {
-            this.socket.send(JSON.stringify({
-                type: 'message',
-                message: content,
-                sender_id: this.userId,
-            }));
+            // The server only speaks binary if it accepted the subprotocol
+            const binary = this.binary && this.socket.protocol === 'chat.msgpack';
+            this.socket.send(binary ? encodeBinaryFrame(data) : JSON.stringify(data));
         }
     }
 
+    sendMessage(content) {
+        this.send({
+            type: 'message',
+            message: content,
+            sender_id: this.userId,
+        });
+    }
+
     sendTypingIndicator(isTyping) {
-        if (this.socket && this.socket.readyState === WebSocket.OPEN) {
-            this.socket.send(JSON.stringify({
-                type: 'typing',
-                is_typing: isTyping,
-            }));
-        }
+        this.send({
+            type: 'typing',
+            is_typing: isTyping,
+        });
     }
 
     handleMessage(data) {
         switch (data.type) {
+            case 'history':
+            case 'replay':
+                data.messages.forEach(message => this.handleMessage({type: 'message', ...message}));
+                break;
             case 'message':
+                this.lastSeq = Math.max(this.lastSeq, data.seq || 0);
                 this.messageCallbacks.forEach(callback => callback(data));
                 break;
             case 'typing':
+            case 'typing_set':
                 this.typingCallbacks.forEach(callback => callback(data));
                 break;
             case 'user_status':
                 this.statusCallbacks.forEach(callback => callback(data));
                 break;
+            case 'resync':
+                // Messages after data.last_message_id were dropped because
+                // the socket fell behind; fetch them from the messages API
+                this.resyncCallbacks.forEach(callback => callback(data));
+                break;
+            case 'ticket':
+                rememberTicket(data);
+                break;
+            case 'throttled':
+                // The last message was dropped by the rate limit
+                this.throttledCallbacks.forEach(callback => callback(data));
+                break;
         }
     }
 
@@ -90,6 +188,14 @@ class ChatWebSocket {
         this.statusCallbacks.push(callback);
     }
 
+    onResync(callback) {
+        this.resyncCallbacks.push(callback);
+    }
+
+    onThrottled(callback) {
+        this.throttledCallbacks.push(callback);
+    }
+
     onOpen(callback) {
         if (callback) callback();
     }
@@ -122,21 +228,44 @@ class OnlineStatusSocket {
     constructor() {
         this.socket = null;
         this.callbacks = [];
+        this.unreadCallbacks = [];
+        this.watching = new Set();
     }
 
     connect() {
         const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
         const url = `${protocol}//${window.location.host}/ws/online/`;
 
-        this.socket = new WebSocket(url);
+        this.socket = new WebSocket(withTicket(url));
 
         this.socket.onopen = (e) => {
             console.log('Online status WebSocket connected');
+            if (this.watching.size) {
+                this.send({type: 'watch', user_ids: Array.from(this.watching)});
+            }
         };
 
         this.socket.onmessage = (e) => {
             const data = JSON.parse(e.data);
-            this.callbacks.forEach(callback => callback(data));
+            if (data.type === 'ticket') {
+                rememberTicket(data);
+                return;
+            }
+            if (data.type === 'unread') {
+                // [room_id, count] pairs of the rooms whose count changed
+                data.rooms.forEach(([roomId, count]) => this.unreadCallbacks.forEach(
+                    callback => callback(roomId, count)));
+                return;
+            }
+            if (data.type !== 'presence') {
+                this.callbacks.forEach(callback => callback(data));
+                return;
+            }
+            // Batched diffs: one callback per changed user
+            data.online.forEach(userId => this.callbacks.forEach(
+                callback => callback({user_id: userId, is_online: true})));
+            data.offline.forEach(userId => this.callbacks.forEach(
+                callback => callback({user_id: userId, is_online: false})));
         };
 
         this.socket.onclose = (e) => {
@@ -155,7 +284,28 @@ class OnlineStatusSocket {
         }
     }
 
+    send(data) {
+        if (this.socket && this.socket.readyState === WebSocket.OPEN) {
+            this.socket.send(JSON.stringify(data));
+        }
+    }
+
+    // Subscribe to the presence of the users the page displays
+    watch(userIds) {
+        userIds.forEach(userId => this.watching.add(userId));
+        this.send({type: 'watch', user_ids: userIds});
+    }
+
+    unwatch(userIds) {
+        userIds.forEach(userId => this.watching.delete(userId));
+        this.send({type: 'unwatch', user_ids: userIds});
+    }
+
     onStatusChange(callback) {
         this.callbacks.push(callback);
     }
+
+    onUnread(callback) {
+        this.unreadCallbacks.push(callback);
+    }
 }
\ No newline at end of file